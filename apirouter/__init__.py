@@ -1 +1,6 @@
 # -*- coding: utf-8 -*-
+import os
+
+
+# Directory for state that should survive restarts, like the discovery cache.
+STATE_DIR = os.environ.get('APIROUTER_STATE_DIR') or os.path.expanduser('~/.drift/apirouter')
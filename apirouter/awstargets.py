@@ -7,13 +7,23 @@ import os
 import socket
 import logging
 import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 import requests
+from botocore.config import Config
+from botocore.exceptions import InvalidRetryConfigurationError
 from requests.utils import urlparse
 
 from driftconfig.util import get_drift_config
 
+from apirouter.probes import run_probes
+from apirouter.discoverycache import get_cache
+from apirouter import metrics
+from apirouter.healthstate import get_health_state
+
 
 log = logging.getLogger(__name__)
 
@@ -21,10 +31,145 @@ log = logging.getLogger(__name__)
 HEALTHCHECK_TIMEOUT = 1.0  # Timeout for target health check ping.
 HEALTHCHECK_PORT = 8080  # HTTP server port on targets.
 
+# Reasons a probe failed, found in the error message. The message itself has addresses and
+# timings that change from probe to probe, so only the reason goes into the discovery.
+PROBE_ERRORS = ('timeout', 'dns lookup failed', 'connection refused', 'connection reset', 'no route to host')
 
-def _get_ec2_targets_from_aws(tier_name):
+# Seconds to cache lookups of things that rarely change.
+VPC_CACHE_TTL = 3600.0
+VPC_ENDPOINT_CACHE_TTL = 3600.0
+REST_API_CACHE_TTL = 600.0
+STAGE_CACHE_TTL = 600.0
+ROUTER_COUNT_CACHE_TTL = 60.0
 
-    conf = get_drift_config(tier_name=tier_name)
+ROUTER_SERVICE_NAME = 'drift-apirouter'  # 'service-name' tag of api-router instances.
+
+ASG_BATCH_SIZE = 50  # Max instance ids per describe_auto_scaling_instances call.
+DISCOVERY_WORKERS = 8  # Max number of concurrent AWS calls during discovery.
+
+# Timeouts and retries for AWS calls. The 'adaptive' retry mode backs off and slows down
+# the client when AWS throttles it. It needs botocore 1.15 or later.
+AWS_CONNECT_TIMEOUT = 2.0  # Seconds to wait for a connection to an AWS endpoint.
+AWS_READ_TIMEOUT = 10.0  # Seconds to wait for a response from an AWS endpoint.
+AWS_MAX_ATTEMPTS = 5  # Attempts per call, including the first one.
+
+AWS_RETRY_MODE = 'adaptive'
+
+
+def _get_boto_config(retry_mode=AWS_RETRY_MODE):
+    """Return the config for boto3 clients, without 'retry_mode' if botocore has no retry modes."""
+    retries = {'max_attempts': AWS_MAX_ATTEMPTS}
+    try:
+        Config(retries=dict(retries, mode=retry_mode))
+    except InvalidRetryConfigurationError:
+        log.warning("botocore has no retry modes. Using the legacy retries.")
+    else:
+        retries['mode'] = retry_mode
+    return Config(
+        connect_timeout=AWS_CONNECT_TIMEOUT,
+        read_timeout=AWS_READ_TIMEOUT,
+        retries=retries,
+        max_pool_connections=DISCOVERY_WORKERS * 2,
+    )
+
+
+BOTO_CONFIG = _get_boto_config()
+
+
+# boto3 clients are expensive to create so they are kept around between calls. The clients
+# are thread safe but creating them is not, hence the lock.
+_boto_clients = {}
+_boto_clients_lock = threading.Lock()
+
+
+def _get_boto_client(service_name, region_name):
+    """Return a boto3 client for 'service_name', reusing a previously created one if possible."""
+    key = (service_name, region_name)
+    with _boto_clients_lock:
+        if key not in _boto_clients:
+            _boto_clients[key] = boto3.client(service_name, region_name=region_name, config=BOTO_CONFIG)
+        return _boto_clients[key]
+
+
+# Number of calls and total seconds spent per AWS operation since the last reset.
+_call_timings = {}
+_call_timings_lock = threading.Lock()
+
+
+def _timed_call(name, fn, *args, **kw):
+    """Call 'fn' with 'args' and 'kw' and record how long it took under 'name'."""
+    t = time.time()
+    try:
+        return fn(*args, **kw)
+    finally:
+        elapsed = time.time() - t
+        log.debug("AWS call %s took %.3f seconds.", name, elapsed)
+        with _call_timings_lock:
+            timing = _call_timings.setdefault(name, {'count': 0, 'seconds': 0.0})
+            timing['count'] += 1
+            timing['seconds'] += elapsed
+
+
+def reset_call_timings():
+    """Return the AWS call timings recorded since the last reset and start over."""
+    global _call_timings
+    with _call_timings_lock:
+        timings, _call_timings = _call_timings, {}
+    return timings
+
+
+def _paginate(client, operation, result_key, **kw):
+    """Return all items in 'result_key' from all pages of 'operation' on 'client'."""
+    items = []
+    for page in _timed_call(operation, lambda: list(client.get_paginator(operation).paginate(**kw))):
+        items.extend(page.get(result_key, []))
+    return items
+
+
+def _map_concurrently(fn, items):
+    """Return a list of 'fn' called on each of 'items', using a thread pool if there are many."""
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(DISCOVERY_WORKERS, len(items))) as executor:
+        return list(executor.map(fn, items))
+
+
+def run_concurrently(*fns):
+    """
+    Call each of 'fns' in a thread of its own and return a list of the results, in order.
+    If any of them raises, the first exception in order is raised when all are done.
+    """
+    return _map_concurrently(lambda fn: fn(), fns)
+
+
+def _get_auto_scaling_instances(region_name, instance_ids):
+    """
+    Return a dict of instance id -> Auto Scaling instance info for 'instance_ids'. The ids
+    are looked up in batches, concurrently.
+    """
+    autoscaling = _get_boto_client('autoscaling', region_name=region_name)
+    instance_ids = list(instance_ids)
+    batches = [
+        instance_ids[i:i + ASG_BATCH_SIZE]
+        for i in range(0, len(instance_ids), ASG_BATCH_SIZE)
+    ]
+
+    def describe(batch):
+        return _paginate(
+            autoscaling, 'describe_auto_scaling_instances', 'AutoScalingInstances', InstanceIds=batch)
+
+    return {
+        auto_ec2['InstanceId']: auto_ec2
+        for auto_ec2s in _map_concurrently(describe, batches)
+        for auto_ec2 in auto_ec2s
+    }
+
+
+def _get_ec2_targets_from_aws(tier_name, conf=None):
+
+    if conf is None:
+        conf = get_drift_config(tier_name=tier_name)
     deployables = conf.table_store.get_table('deployables').find({'tier_name': tier_name})
     deployables = {d['deployable_name']: d for d in deployables}  # Turn into a dict
 
@@ -32,7 +177,8 @@ def _get_ec2_targets_from_aws(tier_name):
     if 'aws' not in conf.tier:
         raise RuntimeError("'aws' section missing from tier configuration.")
 
-    ec2_client = boto3.resource('ec2', region_name=conf.tier['aws']['region'])
+    region_name = conf.tier['aws']['region']
+    ec2_client = _get_boto_client('ec2', region_name=region_name)
     filters = {
         'instance-state-name': 'running',
         'tag:tier': conf.tier['tier_name'],
@@ -45,16 +191,14 @@ def _get_ec2_targets_from_aws(tier_name):
         return [{'Name': k, 'Values': [v]} for k, v in d.items()]
 
     log.info("Fetch EC2 instances that match %s", filterize(filters))
-    ec2_instances = list(ec2_client.instances.filter(Filters=filterize(filters)))
+    reservations, vpc = run_concurrently(
+        lambda: _paginate(ec2_client, 'describe_instances', 'Reservations', Filters=filterize(filters)),
+        lambda: _get_vpc_for_tier(region_name=region_name, tier_name=tier_name),
+    )
+    ec2_instances = [ec2 for reservation in reservations for ec2 in reservation['Instances']]
 
     # If the instances are part of an autoscaling group, make sure they are healthy and in service.
-    region_name = conf.tier['aws']['region']
-    vpc = _get_vpc_for_tier(region_name=region_name, tier_name=tier_name)
-    autoscaling = boto3.client('autoscaling', region_name=region_name)
-    auto_ec2s = autoscaling.describe_auto_scaling_instances(
-        InstanceIds=[ec2.instance_id for ec2 in ec2_instances]
-    )
-    auto_ec2s = {auto_ec2['InstanceId']: auto_ec2 for auto_ec2 in auto_ec2s['AutoScalingInstances']}
+    auto_ec2s = _get_auto_scaling_instances(region_name, [ec2['InstanceId'] for ec2 in ec2_instances])
     # auto_ec2s is a dict with instance id as key, and value is a dict with LifecycleState and HealthStatus key.
 
     api_targets = {}
@@ -62,18 +206,19 @@ def _get_ec2_targets_from_aws(tier_name):
         # Analyse the EC2 instances and see if they are supposed to be a target of the api router.
 
         def fold_tags(tags, key_name=None, value_name=None):
-            """Fold boto3 resource tags array into a dictionary."""
+            """Fold boto3 tags array into a dictionary."""
             return {tag['Key']: tag['Value'] for tag in tags}
 
-        tags = fold_tags(ec2.tags)
+        tags = fold_tags(ec2.get('Tags', []))
+        instance_id = ec2['InstanceId']
         api_status = tags.get('api-status')
         api_target = tags.get('api-target')
         api_port = tags.get('api-port')
         name = tags.get('Name')
 
         # Check if instance is being scaled in or out by autoscaling group.
-        if ec2.instance_id in auto_ec2s:
-            lifecycle_state = auto_ec2s[ec2.instance_id]['LifecycleState']
+        if instance_id in auto_ec2s:
+            lifecycle_state = auto_ec2s[instance_id]['LifecycleState']
 
             if lifecycle_state.startswith('Terminating'):
                 # The instances are normally equipped with a lifecycle hook that specifies
@@ -85,57 +230,57 @@ def _get_ec2_targets_from_aws(tier_name):
                 #
                 # To gracefully drain the connections, the instance is marked as 'backup'. This
                 # simply removes the instance from the round robin load balancing.
-                log.info("EC2 instance %s[%s] terminating. Marking it as 'backup' to drain connections.", name, ec2.instance_id[:7])
+                log.info("EC2 instance %s[%s] terminating. Marking it as 'backup' to drain connections.", name, instance_id[:7])
                 tags['api-param'] = 'backup'  # This will enable connection draining in Nginx.
             elif lifecycle_state != 'InService':
-                log.warning("EC2 instance %s[%s] not in service yet: %s", name, ec2.instance_id[:7], lifecycle_state)
+                log.warning("EC2 instance %s[%s] not in service yet: %s", name, instance_id[:7], lifecycle_state)
                 continue
 
-        if ec2.vpc_id != vpc['VpcId']:
-            log.warning("EC2 instance %s[%s] not in correct VPC. Fix tier tag!", name, ec2.instance_id[:7])
+        if ec2.get('VpcId') != vpc['VpcId']:
+            log.warning("EC2 instance %s[%s] not in correct VPC. Fix tier tag!", name, instance_id[:7])
             continue
 
         if not any([api_status, api_target, api_port]):
-            log.info("EC2 instance %s[%s] not in rotation, as it's not configured as api-target.", name, ec2.instance_id[:7])
+            log.info("EC2 instance %s[%s] not in rotation, as it's not configured as api-target.", name, instance_id[:7])
             continue
 
         if any([api_status, api_target, api_port]) and not all([api_status, api_target, api_port]):
-            log.warning("EC2 instance %s[%s] must define all api tags, not just some: %s.", name, ec2.instance_id[:7], tags)
+            log.warning("EC2 instance %s[%s] must define all api tags, not just some: %s.", name, instance_id[:7], tags)
             continue
 
         if not api_port.isnumeric():
-            log.warning("EC2 instance %s[%s] has bogus 'api-port' tag: %s.", name, ec2.instance_id[:7], api_port)
+            log.warning("EC2 instance %s[%s] has bogus 'api-port' tag: %s.", name, instance_id[:7], api_port)
             continue
 
         deployable = deployables.get(api_target)
         if not deployable:
-            log.warning("EC2 instance %s[%s]: No deployable defined for api-target '%s'.", name, ec2.instance_id[:7], api_target)
+            log.warning("EC2 instance %s[%s]: No deployable defined for api-target '%s'.", name, instance_id[:7], api_target)
             continue
 
         if api_status not in ['online', 'online2']:
-            log.info("EC2 instance %s[%s] not in rotation, api-status tag is '%s'.", name, ec2.instance_id[:7], api_status)
+            log.info("EC2 instance %s[%s] not in rotation, api-status tag is '%s'.", name, instance_id[:7], api_status)
             continue
 
         log.info(
             "EC2 instance %s[%s] in rotation. [%s:%s:%s]",
-            name, ec2.instance_id[:7], api_target, api_status, api_port
+            name, instance_id[:7], api_target, api_status, api_port
         )
 
         target = {
             'name': name,
-            'image_id': ec2.image_id,
-            'instance_id': ec2.id,
-            'instance_type': ec2.instance_type,
-            'launch_time': ec2.launch_time.isoformat() + 'Z',
-            'placement': ec2.placement,
-            'private_ip_address': ec2.private_ip_address,
-            'public_ip_address': ec2.public_ip_address,
-            'state_name': ec2.state['Name'],
-            'state_transition_reason': ec2.state_transition_reason,
-            'subnet_id': ec2.subnet_id,
+            'image_id': ec2['ImageId'],
+            'instance_id': instance_id,
+            'instance_type': ec2['InstanceType'],
+            'launch_time': ec2['LaunchTime'].isoformat() + 'Z',
+            'placement': ec2['Placement'],
+            'private_ip_address': ec2.get('PrivateIpAddress'),
+            'public_ip_address': ec2.get('PublicIpAddress'),
+            'state_name': ec2['State']['Name'],
+            'state_transition_reason': ec2.get('StateTransitionReason'),
+            'subnet_id': ec2.get('SubnetId'),
             'tags': tags,
-            'vpc_id': ec2.vpc_id,
-            'comment': "{} [{}] [{}]".format(name, ec2.instance_type, ec2.placement['AvailabilityZone']),
+            'vpc_id': ec2.get('VpcId'),
+            'comment': "{} [{}] [{}]".format(name, ec2['InstanceType'], ec2['Placement']['AvailabilityZone']),
         }
 
         api_targets.setdefault(api_target, []).append(target)
@@ -143,53 +288,165 @@ def _get_ec2_targets_from_aws(tier_name):
     return api_targets
 
 
-def _healthcheck_targets(api_targets):
-    """Pings targets in 'api_targets' for health and removes a new map of 'healhty_targets' as a result."""
-    healthy_targets = {}
+def _probe_target(target):
+    """Ping 'target' for health and return a tuple of 'status' and 'message'."""
+    # Ping the target for health. The assumption is that the target runs a plain
+    # http server on port 8080 and responds to / with a 200.
 
-    for api_target_name, targets in api_targets.items():
-        healthy_targets[api_target_name] = []
-        for target in targets[:]:
+    # HACK: There is no uniform healtch check path on targets. Trying out a few until
+    # this gets cleaned up:
+    # Try /healthcheck
+    url = 'http://{}:{}/healthcheck'.format(target['private_ip_address'], HEALTHCHECK_PORT)
+    status, message = _check_url(url)
+    if status != 200:
+        # Try /
+        url = 'http://{}:{}/'.format(target['private_ip_address'], HEALTHCHECK_PORT)
+        status, message = _check_url(url)
+
+    return status, message
+
+
+def _probe_reason(status, message):
+    """Return a short reason for a failed probe with 'status' and 'message', like 'http 503'."""
+    if status != 'error':
+        return 'http {}'.format(status)
+    message = str(message).lower()
+    for reason in PROBE_ERRORS:
+        if reason in message:
+            return reason
+    return 'error'
+
+
+def _target_key(target):
+    return target.get('instance_id') or target['private_ip_address']
+
+
+def healthcheck_tier(ec2_targets=None, api_endpoints=None, public_url=None, deadline=None, health_state=None):
+    """
+    Health check EC2 targets in 'ec2_targets' and API Gateway endpoints in 'api_endpoints'
+    concurrently. All probes run under a global 'deadline' (in seconds).
+
+    EC2 targets get 'health_status' set to 'ok' or the reason the probe failed, like
+    'timeout' or 'http 503'. API Gateway endpoints get 'health_status' set to the status
+    code or 'error', and 'message' set to 'ok' or the reason. The full error is logged.
+    Returns a new map of 'healthy_targets'.
+
+    If 'health_state' is set, EC2 targets are only probed when they are due and their
+    health is taken from the state. See apirouter.healthstate. New targets that didn't fit
+    in the probe budget have no state yet. Their 'health_status' is None, as without health
+    checks, until they are probed.
+    """
+    ec2_targets = ec2_targets or {}
+    api_endpoints = api_endpoints or []
+    probes = []
+
+    if health_state is not None:
+        keys = [_target_key(target) for targets in ec2_targets.values() for target in targets]
+        due = set(health_state.due(keys))
+        metrics.count('probes_skipped', len(keys) - len(due))
+
+    for api_target_name, targets in ec2_targets.items():
+        for i, target in enumerate(targets):
+            if health_state is not None and _target_key(target) not in due:
+                continue
             log.info("Checking health of %s", target['private_ip_address'])
-            # Ping the target for health. The assumption is that the target runs a plain
-            # http server on port 8080 and responds to / with a 200.
-
-            # HACK: There is no uniform healtch check path on targets. Trying out a few until
-            # this gets cleaned up:
-            # Try /healthcheck
-            url = 'http://{}:{}/healthcheck'.format(target['private_ip_address'], HEALTHCHECK_PORT)
-            status, message = _check_url(url)
-            if status != 200:
-                # Try /
-                url = 'http://{}:{}/'.format(target['private_ip_address'], HEALTHCHECK_PORT)
-                status, message = _check_url(url)
+            probes.append((
+                ('ec2', api_target_name, i),
+                target['private_ip_address'],
+                lambda target=target: _probe_target(target),
+            ))
+
+    for i, ep in enumerate(api_endpoints):
+        probes.append((
+            ('apigw', i),
+            urlparse(ep['url']).hostname,
+            lambda ep=ep: _do_api_gw_health_check(ep['url'], public_url),
+        ))
+
+    with metrics.span('healthcheck'):
+        results = run_probes(probes, deadline=deadline)
+    metrics.count('probes', len(probes))
+
+    healthy_targets = {}
+    for api_target_name, targets in ec2_targets.items():
+        healthy_targets[api_target_name] = []
+        for i, target in enumerate(targets):
+            key = ('ec2', api_target_name, i)
+            if key in results:
+                status, message = results[key]
+                if status != 200:
+                    log.info("Probe of %s[%s] failed: %s", api_target_name, target['private_ip_address'], message)
+                    message = _probe_reason(status, message)
+
+            if health_state is not None:
+                if key in results and health_state.update(_target_key(target), status == 200, message):
+                    metrics.count('health_transitions')
+                state = health_state.get(_target_key(target))
+                if state is None:
+                    target['health_status'] = None
+                    healthy_targets[api_target_name].append(target)
+                    continue
+                status, message = (200, 'ok') if state['healthy'] else ('error', state['message'])
 
             if status != 200:
                 log.warning(
                     "Target %s[%s]: Healthcheck failed: %s.",
                     api_target_name,
-                    url,
+                    target['private_ip_address'],
                     message,
                 )
                 target['health_status'] = message
+                metrics.count('unhealthy_targets')
             else:
                 target['health_status'] = 'ok'
                 healthy_targets[api_target_name].append(target)
 
+    for i, ep in enumerate(api_endpoints):
+        status, message = results[('apigw', i)]
+        if status != 200:
+            log.info("Probe of %s failed: %s", ep['url'], message)
+        ep['health_status'], ep['message'] = status, 'ok' if status == 200 else _probe_reason(status, message)
+
+    if health_state is not None:
+        health_state.prune(_target_key(target) for targets in ec2_targets.values() for target in targets)
+        health_state.save()
+
     return healthy_targets
 
 
+def healthcheck_targets(api_targets, api_endpoints=None, nginx=None, public_url=None):
+    """
+    Pings targets in 'api_targets', and API Gateway endpoints in 'api_endpoints' if set, for
+    health in one batch of probes, and returns a new map of 'healthy_targets' as a result.
+    The health state of the targets is kept between calls, using 'healthcheck_*' settings
+    from the 'nginx' config if set.
+    """
+    health_state = get_health_state()
+    health_state.configure(**{
+        key[len('healthcheck_'):]: value
+        for key, value in (nginx or {}).items()
+        if key.startswith('healthcheck_')
+    })
+    return healthcheck_tier(
+        ec2_targets=api_targets, api_endpoints=api_endpoints, public_url=public_url, health_state=health_state)
+
+
 def _get_vpc_for_tier(region_name, tier_name):
     """
     Returns first VPC that matches tag:tier='tier_name' or None if none found.
     The response format can be seen here:
     https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/ec2.html#EC2.Client.describe_vpcs
     """
-    log.info("Getting VPC for tier %s", tier_name)
-    client = boto3.client('ec2', region_name=region_name)
-    vpcs = client.describe_vpcs(Filters=[{'Name': 'tag:tier', 'Values': [tier_name]}])
-    if vpcs['Vpcs']:
-        return vpcs['Vpcs'][0]
+    def fetch():
+        log.info("Getting VPC for tier %s", tier_name)
+        client = _get_boto_client('ec2', region_name=region_name)
+        vpcs = _timed_call(
+            'describe_vpcs', client.describe_vpcs, Filters=[{'Name': 'tag:tier', 'Values': [tier_name]}])
+        if vpcs['Vpcs']:
+            return vpcs['Vpcs'][0]
+
+    key = 'vpc/{}/{}'.format(region_name, tier_name)
+    return get_cache().get(key, fetch, ttl=VPC_CACHE_TTL)
 
 
 # See "Invoking Your Private API Using Endpoint-Specific Public DNS Hostnames" here:
@@ -207,14 +464,18 @@ def _get_public_api_gw_url(region_name, tier_name, stage_name=None):
     if not vpc:
         return
 
-    client = boto3.client('ec2', region_name=region_name)
-    query = [
-        {'Name': 'service-name', 'Values': ['com.amazonaws.eu-west-1.execute-api']},
-        {'Name': 'vpc-id', 'Values': [vpc['VpcId']]}
-    ]
-    endpoints = client.describe_vpc_endpoints(Filters=query)
-    if endpoints['VpcEndpoints']:
-        vpc_ep = endpoints['VpcEndpoints'][0]
+    def fetch():
+        client = _get_boto_client('ec2', region_name=region_name)
+        query = [
+            {'Name': 'service-name', 'Values': ['com.amazonaws.eu-west-1.execute-api']},
+            {'Name': 'vpc-id', 'Values': [vpc['VpcId']]}
+        ]
+        return _paginate(client, 'describe_vpc_endpoints', 'VpcEndpoints', Filters=query)
+
+    key = 'vpc-endpoints/{}/{}'.format(region_name, vpc['VpcId'])
+    endpoints = get_cache().get(key, fetch, ttl=VPC_ENDPOINT_CACHE_TTL)
+    if endpoints:
+        vpc_ep = endpoints[0]
         url = 'https://{vpce_id}.execute-api.{region}.vpce.amazonaws.com/{stage}'.format(
             vpce_id=vpc_ep['VpcEndpointId'],
             region=region_name,
@@ -226,34 +487,49 @@ def _get_public_api_gw_url(region_name, tier_name, stage_name=None):
 def _get_api_endpoints(region_name, tier_name, deployable_names, stage_name=None):
     # Returns info on AWS API Gateway endpoints that match 'deployable_names'.
     stage_name = stage_name or 'main'
-    client = boto3.client('apigateway', region_name=region_name)
+    client = _get_boto_client('apigateway', region_name=region_name)
     api_names = {
         '{}-{}'.format(tier_name, deployable_name): deployable_name
         for deployable_name in deployable_names
     }
     endpoints = []
 
+    cache = get_cache()
+
     log.info("Get API endpoints for tier %s", tier_name)
-    for api in client.get_rest_apis(limit=500)['items']:
-        if api['name'] in api_names:
-            # Make sure this API got the expected stage name
-            for stage in client.get_stages(restApiId=api['id'])['item']:
-                if stage['stageName'] == stage_name:
-                    break
-            else:
-                log.warning("Found API Gateway '%s' but no stage named '%s'.", api['name'], stage_name)
-                continue
+    rest_apis = cache.get(
+        'rest-apis/{}'.format(region_name),
+        lambda: _paginate(client, 'get_rest_apis', 'items', PaginationConfig={'PageSize': 500}),
+        ttl=REST_API_CACHE_TTL,
+    )
+    rest_apis = [api for api in rest_apis if api['name'] in api_names]
 
-            url = 'https://{id}.execute-api.{region_name}.amazonaws.com/{stage_name}'.format(
-                id=api['id'], region_name=region_name, stage_name=stage_name
-                )
+    def get_stages(api):
+        return cache.get(
+            'stages/{}/{}'.format(region_name, api['id']),
+            lambda: _timed_call('get_stages', client.get_stages, restApiId=api['id'])['item'],
+            ttl=STAGE_CACHE_TTL,
+        )
 
-            ep = {
-                'deployable_name': api_names[api['name']],
-                'url': url,
-                'api': api,
-            }
-            endpoints.append(ep)
+    for api, stages in zip(rest_apis, _map_concurrently(get_stages, rest_apis)):
+        # Make sure this API got the expected stage name
+        for stage in stages:
+            if stage['stageName'] == stage_name:
+                break
+        else:
+            log.warning("Found API Gateway '%s' but no stage named '%s'.", api['name'], stage_name)
+            continue
+
+        url = 'https://{id}.execute-api.{region_name}.amazonaws.com/{stage_name}'.format(
+            id=api['id'], region_name=region_name, stage_name=stage_name
+            )
+
+        ep = {
+            'deployable_name': api_names[api['name']],
+            'url': url,
+            'api': api,
+        }
+        endpoints.append(ep)
 
     return endpoints
 
@@ -304,12 +580,13 @@ def get_name_server():
             return s.groups()[0]
 
 
-def get_api_endpoints_for_tier(tier_name, check_health=False, public_url=None):
+def get_api_endpoints_for_tier(tier_name, check_health=False, public_url=None, conf=None):
     """
     Returns a dict of API Gateway endpoints for all deployables in tier 'tier_name' and
     the health status if 'health_check' is set.
     If 'public_url' is set the health check will try to use the public api gw endpoint
     to ping the target.
+    If 'conf' is set it is used instead of loading the tier config.
 
     Abridged example of response:
 
@@ -320,7 +597,7 @@ def get_api_endpoints_for_tier(tier_name, check_health=False, public_url=None):
             "api": {
                 "id": "spliffdnkgen",
                 "name": "DEVNORTH-drift-base",
-                "createdDate": datetime.datetime(2018, 10, 24, 13, 21, 59, tzinfo=tzlocal()),
+                "createdDate": "2018-10-24 13:21:59+00:00",
                 "apiKeySource": "HEADER",
                 "endpointConfiguration": {
                     "types": [
@@ -330,14 +607,15 @@ def get_api_endpoints_for_tier(tier_name, check_health=False, public_url=None):
                 "policy": "..."
             },
             "health_status": "error",
-            "message": "DNS lookup failed"
+            "message": "dns lookup failed"
         }
     }
 
     Note, if endpoint health is good 'health_status' is the status code (usually 200).
 
     """
-    conf = get_drift_config(tier_name=tier_name)
+    if conf is None:
+        conf = get_drift_config(tier_name=tier_name)
     deployables = conf.table_store.get_table('deployables').find({'tier_name': tier_name})
     deployable_names = [deployable['deployable_name'] for deployable in deployables]
     endpoints = _get_api_endpoints(
@@ -347,19 +625,18 @@ def get_api_endpoints_for_tier(tier_name, check_health=False, public_url=None):
     )
 
     if check_health:
-        for ep in endpoints:
-            status, message = _do_api_gw_health_check(ep['url'], public_url)
-            ep['health_status'] = status
-            ep['message'] = message
+        healthcheck_tier(api_endpoints=endpoints, public_url=public_url)
 
     return {ep['deployable_name']: ep for ep in endpoints}
 
 
-def get_ec2_targets_for_tier(tier_name, check_health=False):
+def get_ec2_targets_for_tier(tier_name, check_health=False, conf=None):
     """
     Returns a dict of EC2 instances for all deployables in tier 'tier_name' that are tagged
     as targets.
-    Health is checked if 'check_health' is set.
+    Health is checked if 'check_health' is set. Targets are only probed when due, see
+    apirouter.healthstate.
+    If 'conf' is set it is used instead of loading the tier config.
 
 
     Abridged example of response:
@@ -391,13 +668,49 @@ def get_ec2_targets_for_tier(tier_name, check_health=False):
         ]
     }
     """
-    ec2_targets = _get_ec2_targets_from_aws(tier_name=tier_name)
+    if conf is None:
+        conf = get_drift_config(tier_name=tier_name)
+    ec2_targets = _get_ec2_targets_from_aws(tier_name=tier_name, conf=conf)
     if check_health:
-        _healthcheck_targets(ec2_targets)
+        nginx = conf.table_store.get_table('nginx').get({'tier_name': tier_name})
+        healthcheck_targets(ec2_targets, nginx=nginx)
 
     return ec2_targets
 
 
+def get_public_url_for_tier(tier_name, conf=None):
+    """
+    Return the public API Gateway url for tier 'tier_name', or None if its VPC has no
+    endpoint for it. The API Gateway health checks fall back to it.
+    """
+    if conf is None:
+        conf = get_drift_config(tier_name=tier_name)
+    return _get_public_api_gw_url(region_name=conf.tier['aws']['region'], tier_name=conf.tier['tier_name'])
+
+
+def get_router_count(tier_name, conf=None):
+    """
+    Return the number of running api-router instances in tier 'tier_name', found by their
+    'service-name' tag. It's at least 1, as this one is running.
+    """
+    if conf is None:
+        conf = get_drift_config(tier_name=tier_name)
+    region_name = conf.tier['aws']['region']
+
+    def fetch():
+        log.info("Counting api-router instances in tier %s", tier_name)
+        client = _get_boto_client('ec2', region_name=region_name)
+        reservations = _paginate(client, 'describe_instances', 'Reservations', Filters=[
+            {'Name': 'instance-state-name', 'Values': ['running']},
+            {'Name': 'tag:tier', 'Values': [tier_name]},
+            {'Name': 'tag:service-name', 'Values': [ROUTER_SERVICE_NAME]},
+        ])
+        return sum(len(reservation['Instances']) for reservation in reservations)
+
+    key = 'routers/{}/{}'.format(region_name, tier_name)
+    return max(1, get_cache().get(key, fetch, ttl=ROUTER_COUNT_CACHE_TTL) or 0)
+
+
 def _dump():
     tier_name = os.environ['DRIFT_TIER']
 
@@ -410,8 +723,9 @@ def _dump():
         print("VPC has public endpoint for execute-api service calls:")
         print(public_url)
 
-    endpoints = get_api_endpoints_for_tier(tier_name, check_health=True, public_url=public_url)
-    ec2_targets = get_ec2_targets_for_tier(tier_name, check_health=True)
+    endpoints = get_api_endpoints_for_tier(tier_name)
+    ec2_targets = get_ec2_targets_for_tier(tier_name)
+    healthcheck_tier(ec2_targets, list(endpoints.values()), public_url=public_url)
 
     print("AWS API Gateways:")
     for ep in endpoints.values():
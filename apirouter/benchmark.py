@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Config Generation Benchmark
+
+Times each stage of the config generation pipeline against synthetic tiers of different
+sizes, and records peak memory. Discovery is stubbed with synthetic EC2 targets and
+nothing is sent to Nginx.
+
+Results can be written to a json file and compared between commits:
+
+    python -m apirouter.benchmark run --size small --size medium -o before.json
+    python -m apirouter.benchmark run --size small --size medium -o after.json
+    python -m apirouter.benchmark compare before.json after.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+import platform
+import subprocess
+import tracemalloc
+from collections import OrderedDict
+from unittest import mock
+
+import click
+from driftconfig.testhelpers import create_test_domain
+from driftconfig.util import get_drift_config
+import driftconfig.relib
+
+from apirouter import nginxconf
+from apirouter.fragments import FragmentRenderer
+
+
+log = logging.getLogger(__name__)
+
+
+SIZES = OrderedDict([
+    ('small', {'tenants': 10, 'api_keys': 100, 'deployables': 5, 'ec2_targets': 10}),
+    ('medium', {'tenants': 1000, 'api_keys': 1000, 'deployables': 50, 'ec2_targets': 200}),
+    ('large', {'tenants': 50000, 'api_keys': 10000, 'deployables': 200, 'ec2_targets': 2000}),
+])
+
+TENANTS_PER_PRODUCT = 50
+CUSTOM_KEY_RATIO = 10  # Every n-th api key is a custom key.
+REGRESSION_THRESHOLD = 0.2  # Relative slowdown reported as a regression by 'compare'.
+
+
+def make_config(size):
+    """
+    Return a Drift config for a single tier with the number of tenants, api keys and
+    deployables given in 'size'. Rows are added directly to the tables as the test domain
+    helpers don't scale to large configs, and neither do the integrity checks, so they are
+    turned off while the rows are added.
+    """
+    with mock.patch.object(driftconfig.relib, 'CHECK_INTEGRITY', []):
+        return _make_config(size)
+
+
+def _make_config(size):
+    ts = create_test_domain({'num_deployables': 1})
+    tier_name = ts.get_table('tiers').find()[0]['tier_name']
+
+    deployable_names = ['bench-svc-{}'.format(i) for i in range(size['deployables'])]
+    for i, deployable_name in enumerate(deployable_names):
+        ts.get_table('deployable-names').add({'deployable_name': deployable_name, 'display_name': deployable_name})
+        ts.get_table('deployables').add({'tier_name': tier_name, 'deployable_name': deployable_name, 'is_active': True})
+        ts.get_table('routing').add({
+            'tier_name': tier_name,
+            'deployable_name': deployable_name,
+            'requires_api_key': i % 2 == 0,
+        })
+
+    ts.get_table('organizations').add({
+        'organization_name': 'bench', 'short_name': 'bench', 'display_name': 'Benchmark'})
+    num_products = max(1, size['tenants'] // TENANTS_PER_PRODUCT)
+    product_names = ['bench-prod-{}'.format(i) for i in range(num_products)]
+    for product_name in product_names:
+        ts.get_table('products').add({
+            'product_name': product_name,
+            'organization_name': 'bench',
+            'deployables': deployable_names,
+        })
+
+    for i in range(size['tenants']):
+        tenant_name = 'bench-tenant-{}'.format(i)
+        product_name = product_names[i % num_products]
+        ts.get_table('tenant-names').add({
+            'tenant_name': tenant_name,
+            'product_name': product_name,
+            'organization_name': 'bench',
+            'tier_name': tier_name,
+        })
+        ts.get_table('tenants').add({
+            'tier_name': tier_name,
+            'deployable_name': deployable_names[0],
+            'tenant_name': tenant_name,
+            'state': 'active',
+        })
+
+    for i in range(size['api_keys']):
+        if i % CUSTOM_KEY_RATIO == 0:
+            key = {'api_key_name': 'bench-custom-{:08x}'.format(i), 'key_type': 'custom'}
+        else:
+            product_name = product_names[i % num_products]
+            key = {'api_key_name': '{}-{:08x}'.format(product_name, i), 'product_name': product_name, 'key_type': 'product'}
+        ts.get_table('api-keys').add(key)
+
+    ts.get_table('nginx').add({'tier_name': tier_name})
+    return get_drift_config(ts=ts, tier_name=tier_name)
+
+
+def make_ec2_targets(conf, count):
+    """Return 'count' synthetic EC2 targets spread over the deployables in 'conf'."""
+    deployables = conf.table_store.get_table('deployables').find({'tier_name': conf.tier['tier_name']})
+    deployable_names = [d['deployable_name'] for d in deployables if d['deployable_name'].startswith('bench-')]
+    ec2_targets = {}
+    for i in range(count):
+        deployable_name = deployable_names[i % len(deployable_names)]
+        ec2_targets.setdefault(deployable_name, []).append({
+            'name': '{}-{}'.format(conf.tier['tier_name'], deployable_name),
+            'instance_id': 'i-{:017x}'.format(i),
+            'instance_type': 't3.small',
+            'private_ip_address': '10.{}.{}.{}'.format(i // 65536, (i // 256) % 256, i % 256),
+            'placement': {'AvailabilityZone': 'eu-west-1a'},
+            'tags': {
+                'api-status': 'online',
+                'api-target': deployable_name,
+                'api-port': '10080',
+                'api-param': 'weight=100',
+            },
+            'comment': '{} [t3.small] [eu-west-1a]'.format(deployable_name),
+            'health_status': 'ok',
+        })
+    return ec2_targets
+
+
+class Timer(object):
+    """Records the best time of each stage over several runs."""
+
+    def __init__(self):
+        self.stages = OrderedDict()
+
+    def time(self, stage, fn, *args, **kw):
+        t = time.perf_counter()
+        ret = fn(*args, **kw)
+        elapsed = time.perf_counter() - t
+        self.stages[stage] = min(elapsed, self.stages.get(stage, elapsed))
+        return ret
+
+
+def run_pipeline(conf, ec2_targets, timer, config_dir):
+    """Run the config pipeline once for 'conf', timing each stage with 'timer'."""
+    tier_name = conf.tier['tier_name']
+    patchers = [
+        mock.patch.object(nginxconf, 'get_ec2_targets_for_tier', lambda **kw: ec2_targets),
+        mock.patch.object(nginxconf, 'get_api_endpoints_for_tier', lambda **kw: {}),
+        mock.patch.object(subprocess, 'call', lambda cmd: 0),
+        mock.patch.object(time, 'sleep', lambda seconds: None),
+        mock.patch.dict(nginxconf.platform, {
+            'nginx_config_dir': os.path.join(config_dir, 'apirouter'),
+            'nginx_config': os.path.join(config_dir, 'nginx.conf'),
+        }),
+    ]
+    for patcher in patchers:
+        patcher.start()
+    try:
+        discovery = timer.time('discover', nginxconf.discover_tier, tier_name, check_health=False, conf=conf)
+        timer.time('fingerprint', nginxconf.fingerprint_inputs, tier_name, conf, discovery)
+        data = timer.time('prepare', nginxconf._prepare_info, tier_name, conf=conf, discovery=discovery)
+
+        renderer = FragmentRenderer(nginxconf._get_template('nginx.fragments.jinja'))
+        fragments = timer.time('render_fragments', renderer.render, nginxconf._get_fragments(data))
+        config = timer.time(
+            'render_config', nginxconf._get_template('nginx.conf.jinja').render, fragment=fragments.get, **data)
+        status = timer.time('status', nginxconf._generate_status, data)
+        nginx_config = {'config': config, 'fragments': fragments, 'changes': renderer.changes, 'data': data, 'status': status}
+        timer.time('apply', nginxconf.apply_nginx_config, nginx_config, skip_if_same=False)
+
+        # A single target changes, as in most cycles that aren't skipped.
+        target = next(iter(ec2_targets.values()))[0]
+        target['tags']['api-param'] = 'backup' if target['tags']['api-param'] != 'backup' else 'weight=100'
+        data = nginxconf._prepare_info(tier_name, conf=conf, discovery=discovery)
+        fragments = timer.time('render_incremental', renderer.render, nginxconf._get_fragments(data))
+        config = nginxconf._get_template('nginx.conf.jinja').render(fragment=fragments.get, **data)
+        nginx_config = {'config': config, 'fragments': fragments, 'changes': renderer.changes, 'data': data, 'status': status}
+        timer.time('apply_incremental', nginxconf.apply_nginx_config, nginx_config, skip_if_same=False)
+    finally:
+        for patcher in reversed(patchers):
+            patcher.stop()
+
+
+def peak_memory(conf, ec2_targets):
+    """Return the peak memory in bytes allocated while running the pipeline once."""
+    config_dir = tempfile.mkdtemp()
+    tracemalloc.start()
+    try:
+        run_pipeline(conf, ec2_targets, Timer(), config_dir)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        shutil.rmtree(config_dir)
+
+
+def run_benchmark(size_name, repeat=3):
+    """Run the benchmark for size 'size_name' and return the result as a dict."""
+    size = SIZES[size_name]
+    t = time.perf_counter()
+    conf = make_config(size)
+    ec2_targets = make_ec2_targets(conf, size['ec2_targets'])
+    log.info("Config for size '%s' built in %.1f seconds.", size_name, time.perf_counter() - t)
+
+    timer = Timer()
+    for i in range(repeat):
+        config_dir = tempfile.mkdtemp()
+        try:
+            run_pipeline(conf, ec2_targets, timer, config_dir)
+        finally:
+            shutil.rmtree(config_dir)
+
+    return OrderedDict([
+        ('size', size_name),
+        ('params', size),
+        ('stages', timer.stages),
+        ('total', sum(timer.stages.values())),
+        ('peak_memory', peak_memory(conf, ec2_targets)),
+    ])
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL,
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(before, after, threshold=None):
+    """
+    Compare two benchmark result documents. Returns a list of (size, stage, before, after,
+    ratio, regressed) tuples for stages found in both.
+    """
+    threshold = REGRESSION_THRESHOLD if threshold is None else threshold
+    before_by_size = {result['size']: result for result in before['results']}
+    rows = []
+    for result in after['results']:
+        base = before_by_size.get(result['size'])
+        if not base:
+            continue
+        stages = list(result['stages'].items()) + [('total', result['total']), ('peak_memory', result['peak_memory'])]
+        base_stages = dict(base['stages'], total=base['total'], peak_memory=base['peak_memory'])
+        for stage, value in stages:
+            if stage not in base_stages or not base_stages[stage]:
+                continue
+            ratio = value / base_stages[stage]
+            rows.append((result['size'], stage, base_stages[stage], value, ratio, ratio > 1 + threshold))
+    return rows
+
+
+@click.group()
+@click.option('--log-level', '-l', default='WARNING', help='Logging level.')
+def cli(log_level):
+    logging.basicConfig(level=log_level)
+
+
+@cli.command()
+@click.option('--size', '-s', multiple=True, type=click.Choice(list(SIZES)), help='Tier size. Can be repeated.')
+@click.option('--repeat', '-r', default=3, help='Runs per size. The best time of each stage is reported.')
+@click.option('--output', '-o', type=click.Path(), help='Write the results as json to this file.')
+def run(size, repeat, output):
+    """Run the benchmark."""
+    results = []
+    for size_name in size or ('small', 'medium'):
+        result = run_benchmark(size_name, repeat=repeat)
+        results.append(result)
+        print("Size '{}' {}:".format(size_name, json.dumps(result['params'])))
+        for stage, elapsed in result['stages'].items():
+            print("    {:<20} {:>10.2f} ms".format(stage, elapsed * 1000))
+        print("    {:<20} {:>10.2f} ms".format('total', result['total'] * 1000))
+        print("    {:<20} {:>10.1f} MB".format('peak memory', result['peak_memory'] / 1e6))
+
+    if output:
+        doc = OrderedDict([
+            ('commit', _git_commit()),
+            ('python', sys.version.split()[0]),
+            ('machine', platform.machine()),
+            ('created', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+            ('results', results),
+        ])
+        with open(output, 'w') as f:
+            json.dump(doc, f, indent=4)
+        print("Results written to {}.".format(output))
+
+
+@cli.command()
+@click.argument('before', type=click.File())
+@click.argument('after', type=click.File())
+@click.option('--threshold', '-t', default=REGRESSION_THRESHOLD, help='Relative slowdown that counts as a regression.')
+def compare(before, after, threshold):
+    """Compare two result files. Exits with 1 if any stage regressed."""
+    rows = compare_results(json.load(before), json.load(after), threshold=threshold)
+    regressed = False
+    for size, stage, base, value, ratio, is_regression in rows:
+        print("{:<8} {:<20} {:>12.4g} {:>12.4g} {:>7.2f}x{}".format(
+            size, stage, base, value, ratio, '  REGRESSION' if is_regression else ''))
+        regressed = regressed or is_regression
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == '__main__':
+    cli()
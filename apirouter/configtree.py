@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Nginx Config Tree
+
+The generated config is written as a directory of include files, one directory per
+release:
+
+    <root>/releases/<release id>/nginx.conf
+    <root>/releases/<release id>/maps/tenants.conf
+    <root>/releases/<release id>/upstreams/<deployable>.conf
+    <root>/releases/<release id>/locations/<deployable>.conf
+    <root>/releases/<release id>/caches/<deployable>.conf
+    <root>/current -> releases/<release id>
+    <root>/fingerprint
+
+A release is staged in its own directory and is only made live by atomically replacing
+the 'current' symlink. The main Nginx config file is a symlink to 'current/nginx.conf'.
+Files that are unchanged since the current release are hard linked instead of written
+so they keep their inode.
+
+The 'fingerprint' file holds a hash of the inputs of the current release, along with the
+release id, so a cycle can skip rendering when nothing changed.
+"""
+import os
+import shutil
+import logging
+
+
+log = logging.getLogger(__name__)
+
+
+KEEP_RELEASES = 5  # Number of old releases to keep around.
+
+
+def release_dir(root, release_id):
+    return os.path.join(root, 'releases', release_id)
+
+
+def current_release(root):
+    """Return the id of the current release in 'root', or None if there is none."""
+    current = os.path.join(root, 'current')
+    if os.path.islink(current):
+        return os.path.basename(os.readlink(current))
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def write_release(root, release_id, files):
+    """
+    Write 'files', a dict of relative file path and contents, as release 'release_id' in
+    'root'. The files are written to a temporary directory which is renamed to the release
+    directory when all files are safely on disk.
+
+    Returns the release directory and a list of files that differ from the current release.
+    Files that only differ by references to the release directory are not listed.
+    """
+    target_dir = release_dir(root, release_id)
+    current = os.path.join(root, 'current')
+    current_dir = os.path.realpath(current) if os.path.islink(current) else None
+    changed = []
+
+    if os.path.isdir(target_dir):
+        # Identical release written before.
+        return target_dir, changed
+
+    staging_dir = os.path.join(root, 'releases', '.{}.{}.tmp'.format(release_id, os.getpid()))
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+    os.makedirs(staging_dir)
+
+    dirs = {staging_dir}
+    for path, text in files.items():
+        filename = os.path.join(staging_dir, path)
+        dirname = os.path.dirname(filename)
+        if dirname not in dirs:
+            os.makedirs(dirname, exist_ok=True)
+            dirs.add(dirname)
+
+        current_file = os.path.join(current, path)
+        current_text = _read(current_file)
+        if current_text == text:
+            os.link(os.path.realpath(current_file), filename)
+            continue
+
+        if current_text is None or current_dir is None or current_text.replace(current_dir, target_dir) != text:
+            changed.append(path)
+        with open(filename, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+
+    for dirname in dirs:
+        _fsync_dir(dirname)
+
+    os.rename(staging_dir, target_dir)
+    _fsync_dir(os.path.dirname(target_dir))
+    return target_dir, changed
+
+
+def activate_release(root, release_id, nginx_config):
+    """
+    Make 'release_id' the current release by atomically replacing the 'current' symlink in
+    'root'. Makes sure 'nginx_config' is a symlink to the current 'nginx.conf'.
+    """
+    current = os.path.join(root, 'current')
+    tmp_link = current + '.tmp'
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(os.path.join('releases', release_id), tmp_link)
+    os.replace(tmp_link, current)
+    _fsync_dir(root)
+
+    target = os.path.join(current, 'nginx.conf')
+    if not (os.path.islink(nginx_config) and os.readlink(nginx_config) == target):
+        log.warning("Pointing %s to %s.", nginx_config, target)
+        tmp_link = nginx_config + '.tmp'
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(target, tmp_link)
+        os.replace(tmp_link, nginx_config)
+
+
+def discard_release(root, release_id):
+    """Remove release 'release_id' from 'root' unless it's the current one."""
+    if release_id != current_release(root):
+        shutil.rmtree(release_dir(root, release_id), ignore_errors=True)
+
+
+def read_fingerprint(root):
+    """
+    Return the input fingerprint stored for the current release in 'root', or None if
+    there is none or it was written for a different release.
+    """
+    text = _read(os.path.join(root, 'fingerprint'))
+    if not text:
+        return None
+    fingerprint, _, release_id = text.strip().partition(' ')
+    if release_id == current_release(root):
+        return fingerprint
+
+
+def write_fingerprint(root, fingerprint):
+    """Store the input 'fingerprint' for the current release in 'root'."""
+    release_id = current_release(root)
+    if release_id is None:
+        return
+    filename = os.path.join(root, 'fingerprint')
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        f.write('{} {}\n'.format(fingerprint, release_id))
+    os.replace(tmp_filename, filename)
+
+
+def prune_releases(root, keep=None):
+    """Remove all but the 'keep' most recent releases in 'root'. The current one is always kept."""
+    keep = KEEP_RELEASES if keep is None else keep
+    releases_dir = os.path.join(root, 'releases')
+    if not os.path.isdir(releases_dir):
+        return
+
+    current = current_release(root)
+    releases = [
+        name for name in os.listdir(releases_dir)
+        if name != current and not name.startswith('.')
+    ]
+    releases.sort(key=lambda name: os.path.getmtime(os.path.join(releases_dir, name)), reverse=True)
+    for name in releases[keep:]:
+        log.info("Removing old config release %s.", name)
+        shutil.rmtree(os.path.join(releases_dir, name), ignore_errors=True)
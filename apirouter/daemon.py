@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+API Router Daemon
+
+Runs the discovery -> render -> apply cycle in a long running process. The Drift config,
+boto3 clients and the compiled Nginx template are kept in memory between cycles.
+
+If an event source is given, Auto Scaling lifecycle events are applied to the targets
+from the last discovery as they arrive and the config is re-rendered right away. The
+periodic full discovery remains as a safety net, and runs every 'interval' seconds
+however many events arrive.
+
+If 'snapshots' is given the discovery is shared with the other routers of the tier. Only
+the leader discovers targets, the others use its snapshot. The lease is given up when the
+daemon stops.
+
+Send SIGHUP to the process to reload the Drift config, flush the discovery cache and
+force an immediate refresh.
+"""
+import time
+import random
+import signal
+import logging
+import threading
+
+from driftconfig.util import get_drift_config, get_default_drift_config
+
+from apirouter.nginxconf import discover_tier, run_cycle, APPLIED, DAEMON_INTERVAL, DAEMON_JITTER
+from apirouter.lifecycle import parse_event, apply_event, CHANGED, SWEEP
+from apirouter import discoverycache, metrics
+
+
+log = logging.getLogger(__name__)
+
+
+CONFIG_REFRESH_INTERVAL = 300.0  # Seconds between reloading the Drift config.
+EVENT_POLL_TIMEOUT = 5.0  # Max seconds to block on the event source.
+
+
+class Daemon(object):
+    """
+    Refresh the api router config for 'tier_name' every 'interval' seconds plus a random
+    'jitter', and whenever 'event_source' reports a change to the targets.
+    """
+
+    def __init__(self, tier_name, interval=None, jitter=None, check_health=True, event_source=None,
+                 profile=None, snapshots=None):
+        self.tier_name = tier_name
+        self.interval = DAEMON_INTERVAL if interval is None else interval
+        self.jitter = DAEMON_JITTER if jitter is None else jitter
+        self.check_health = check_health
+        self.event_source = event_source
+        self.profile = profile  # Profile the first cycle and write the stats to this file.
+        self.snapshots = snapshots  # Shares the discovery with the other routers, if set.
+        self.events_received = None  # When the first event since the last cycle arrived.
+
+        self.ts = None
+        self.config_loaded = 0
+        self.discovery = None
+        self.last_sweep = 0  # When the targets were last discovered.
+        self.sweep_due = True
+        self.flush_cache = False
+        self.running = False
+        self._wakeup = threading.Event()
+
+    def load_config(self):
+        """Load the Drift config table store into memory."""
+        t = time.time()
+        self.ts = get_default_drift_config()
+        self.config_loaded = time.time()
+        log.info("Drift config loaded in %.2f seconds.", self.config_loaded - t)
+
+    def refresh(self, reload_config=False):
+        """Wake up the daemon and run a full cycle immediately."""
+        if reload_config:
+            self.config_loaded = 0
+            self.flush_cache = True
+        self.sweep_due = True
+        self._wakeup.set()
+
+    def stop(self):
+        self.running = False
+        self._wakeup.set()
+
+    def discover(self, conf):
+        """Discover the targets, or fetch them from the leader's snapshot."""
+        def discover():
+            return discover_tier(self.tier_name, check_health=self.check_health, conf=conf)
+        if self.snapshots is None:
+            return discover()
+        return self.snapshots.get_discovery(discover)
+
+    def run_once(self):
+        """
+        Run a cycle. Targets are discovered if a full sweep is due, else the targets from
+        the last discovery are used as amended by lifecycle events.
+        """
+        if self.ts is None or time.time() - self.config_loaded > CONFIG_REFRESH_INTERVAL:
+            with metrics.span('config_load'):
+                self.load_config()
+
+        if self.flush_cache:
+            discoverycache.invalidate()
+            self.flush_cache = False
+
+        conf = get_drift_config(ts=self.ts, tier_name=self.tier_name)
+        if self.sweep_due or self.discovery is None:
+            with metrics.span('discover'):
+                self.discovery = self.discover(conf)
+            self.last_sweep = time.time()
+            self.sweep_due = False
+            metrics.gauge('sweep', 1)
+        else:
+            metrics.gauge('sweep', 0)
+
+        ret = run_cycle(
+            tier_name=self.tier_name,
+            check_health=self.check_health,
+            conf=conf,
+            discovery=self.discovery,
+        )
+        if self.events_received is not None:
+            # Time from receiving a lifecycle event until the config reflecting it is live.
+            metrics.gauge('event_latency_ms', round((time.time() - self.events_received) * 1000, 1))
+            self.events_received = None
+        if ret in APPLIED and self.event_source is not None:
+            # The events polled so far are in the live config, or covered by its sweep.
+            try:
+                self.event_source.ack()
+            except Exception:
+                log.exception("Failed to ack lifecycle events.")
+        return ret
+
+    def handle_events(self, messages):
+        """Apply lifecycle event 'messages' to the targets. Returns True if a cycle should run."""
+        changed = False
+        for message in messages:
+            event = parse_event(message)
+            if event is None or self.discovery is None:
+                continue
+            log.info("Lifecycle event: %s", event)
+            if self.events_received is None:
+                self.events_received = time.time()
+            ret = apply_event(self.discovery['ec2_targets'], event)
+            if ret == SWEEP:
+                self.sweep_due = True
+            changed = changed or ret in (CHANGED, SWEEP)
+        return changed
+
+    def wait(self, timeout):
+        """
+        Wait for 'timeout' seconds, or until a signal or a lifecycle event arrives. However
+        the wait ends, a full sweep is due if the last one is 'interval' seconds old.
+        """
+        self._wait(timeout)
+        if time.time() - self.last_sweep >= self.interval:
+            self.sweep_due = True
+
+    def _wait(self, timeout):
+        deadline = time.time() + timeout
+        while self.running and not self._wakeup.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+
+            if self.event_source is None:
+                self._wakeup.wait(remaining)
+                continue
+
+            try:
+                messages = self.event_source.poll(timeout=min(remaining, EVENT_POLL_TIMEOUT))
+            except Exception:
+                log.exception("Failed to poll lifecycle events.")
+                self._wakeup.wait(min(remaining, EVENT_POLL_TIMEOUT))
+                continue
+
+            if self.handle_events(messages):
+                return
+
+    def run(self):
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.refresh(reload_config=True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        log.info(
+            "Daemon started for tier %s. Refreshing every %s+%s seconds.",
+            self.tier_name, self.interval, self.jitter,
+        )
+
+        self.running = True
+        while self.running:
+            self._wakeup.clear()
+            t = time.time()
+            try:
+                with metrics.cycle(self.tier_name) as cycle_metrics:
+                    if self.profile:
+                        ret = metrics.profile_call(self.profile, self.run_once)
+                        self.profile = None
+                    else:
+                        ret = self.run_once()
+                    cycle_metrics.result = ret
+                log.info("Cycle done in %.2f seconds: %s", time.time() - t, ret)
+            except Exception:
+                log.exception("Cycle failed.")
+                self.sweep_due = True
+
+            self.wait(self.interval + random.uniform(0, self.jitter))
+
+        if self.snapshots is not None:
+            try:
+                self.snapshots.release()
+            except Exception:
+                log.exception("Failed to release the snapshot lease.")
+        log.info("Daemon stopped.")
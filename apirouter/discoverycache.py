@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Discovery Cache
+
+Keeps the result of slow-changing AWS lookups, like VPCs, VPC endpoints and API Gateway
+REST APIs and stages, for a while so they are not fetched on every cycle. Each entry has
+its own time to live. The cache is written to a json file in the state directory so it
+survives restarts.
+
+Values are stored as they would look after a json round trip, so a cached value looks
+the same whether it was just fetched or loaded from disk.
+"""
+import os
+import json
+import time
+import logging
+import threading
+
+from apirouter import STATE_DIR
+
+
+log = logging.getLogger(__name__)
+
+
+CACHE_FILENAME = 'discovery-cache.json'
+DEFAULT_TTL = 300.0  # Seconds a cached value is kept if no ttl is given.
+
+
+class DiscoveryCache(object):
+    """
+    A key/value cache with a time to live for each entry. If 'path' is set the cache is
+    loaded from and saved to that file.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # Discovery threads may save at the same time.
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, OSError):
+            return
+        except ValueError:
+            log.warning("Discovery cache %s is corrupt. Ignoring it.", self.path)
+            return
+        with self._lock:
+            self._entries = entries
+
+    def save(self):
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                data = json.dumps(self._entries, indent=4, sort_keys=True)
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(tmp_path, 'w') as f:
+                    f.write(data)
+                os.replace(tmp_path, self.path)
+            except (IOError, OSError) as e:
+                log.warning("Can't write discovery cache to %s: %s", self.path, e)
+
+    def get(self, key, fetch, ttl=None):
+        """
+        Return the value for 'key' if it's in the cache and not expired. Else the value is
+        fetched by calling 'fetch', stored in the cache for 'ttl' seconds and returned.
+        A None value is returned but not stored.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry['expires'] > now:
+            self.hits += 1
+            return entry['value']
+
+        self.misses += 1
+        log.debug("Discovery cache miss for %s.", key)
+        value = fetch()
+        if value is None:
+            return None
+
+        value = json.loads(json.dumps(value, default=str))
+        ttl = DEFAULT_TTL if ttl is None else ttl
+        with self._lock:
+            self._entries[key] = {'value': value, 'expires': now + ttl}
+        self.save()
+        return value
+
+    def invalidate(self, prefix=None):
+        """Remove all entries from the cache, or only those with keys starting with 'prefix'."""
+        with self._lock:
+            if prefix is None:
+                self._entries = {}
+            else:
+                self._entries = {k: v for k, v in self._entries.items() if not k.startswith(prefix)}
+        log.info("Discovery cache invalidated: %s", prefix or 'all')
+        self.save()
+
+
+_cache = None
+
+
+def get_cache():
+    """Return the discovery cache for this process, backed by a file in STATE_DIR."""
+    global _cache
+    if _cache is None:
+        _cache = DiscoveryCache(os.path.join(STATE_DIR, CACHE_FILENAME))
+    return _cache
+
+
+def invalidate(prefix=None):
+    """Invalidate the discovery cache for this process. See DiscoveryCache.invalidate()."""
+    get_cache().invalidate(prefix)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental Config Rendering
+
+The Nginx config is split into independently rendered fragments. Each fragment is
+rendered from a macro in 'nginx.fragments.jinja' and cached by the hash of its inputs,
+so only fragments whose inputs changed are re-rendered.
+"""
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+ADDED = 'added'
+CHANGED = 'changed'
+REMOVED = 'removed'
+
+
+def digest(ob):
+    """Return a stable hash of the json serializable object 'ob'."""
+    s = json.dumps(ob, sort_keys=True, default=str)
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+class FragmentRenderer(object):
+    """
+    Renders fragments using macros from 'template' and keeps the result around between
+    calls to render().
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.cache = {}  # Fragment name -> (input digest, text)
+        self.changes = OrderedDict()  # Fragment name -> ADDED, CHANGED or REMOVED.
+
+    def render(self, fragments):
+        """
+        Render 'fragments', a list of (name, macro name, kwargs) tuples. Returns an ordered
+        dict of fragment name and text.
+
+        'self.changes' is updated with the names of fragments that were added, changed or
+        removed since the last call.
+        """
+        ret = OrderedDict()
+        changes = OrderedDict()
+
+        for name, macro_name, kwargs in fragments:
+            input_digest = digest([macro_name, kwargs])
+            cached = self.cache.get(name)
+            if cached and cached[0] == input_digest:
+                ret[name] = cached[1]
+                continue
+
+            text = str(getattr(self.template.module, macro_name)(**kwargs))
+            if cached is None:
+                changes[name] = ADDED
+            elif cached[1] != text:
+                changes[name] = CHANGED
+            self.cache[name] = (input_digest, text)
+            ret[name] = text
+
+        for name in list(self.cache):
+            if name not in ret:
+                changes[name] = REMOVED
+                del self.cache[name]
+
+        for name, change in changes.items():
+            log.info("Config fragment %s %s.", name, change)
+
+        self.changes = changes
+        return ret
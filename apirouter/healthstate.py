@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Target Health State
+
+Keeps track of the health of each EC2 target between cycles, keyed by instance id, so
+targets don't need to be probed on every cycle.
+
+A target changes state only after 'rise' consecutive successful probes or 'fall'
+consecutive failed probes, so a flapping target doesn't toggle the config back and
+forth. Targets that are steadily healthy are probed every 'healthy_interval' seconds.
+Targets whose state is in flux are probed every 'transition_interval' seconds, and
+targets that are down are probed with an exponential backoff. At most 'probe_budget'
+probes are run per cycle, new and changing targets first.
+
+The state is saved as json in the state directory so it survives restarts.
+"""
+import os
+import json
+import time
+import logging
+
+from apirouter import STATE_DIR
+
+
+log = logging.getLogger(__name__)
+
+
+STATE_FILENAME = 'health-state.json'
+
+# Default settings. Can be overridden in the 'nginx' config with a 'healthcheck_' prefix,
+# for example 'healthcheck_rise'.
+DEFAULT_SETTINGS = {
+    'rise': 2,  # Consecutive successful probes for a target to become healthy.
+    'fall': 3,  # Consecutive failed probes for a target to become unhealthy.
+    'healthy_interval': 60.0,  # Seconds between probes of a steadily healthy target.
+    'transition_interval': 5.0,  # Seconds between probes of a target whose state is in flux.
+    'backoff_min': 10.0,  # Seconds until the first re-probe of an unhealthy target.
+    'backoff_max': 300.0,  # Max seconds between probes of an unhealthy target.
+    'probe_budget': 100,  # Max probes per cycle.
+}
+
+
+class HealthState(object):
+    """Health state of targets, loaded from and saved to 'path' if set."""
+
+    def __init__(self, path=None, **settings):
+        self.path = path
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.configure(**settings)
+        self.targets = {}  # Instance id -> state dict
+        if path:
+            self.load()
+
+    def configure(self, **settings):
+        """Update the settings. Unknown settings and None values are ignored."""
+        for key, value in settings.items():
+            if key in DEFAULT_SETTINGS and value is not None:
+                self.settings[key] = type(DEFAULT_SETTINGS[key])(value)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.targets = json.load(f)
+        except (IOError, OSError):
+            pass
+        except ValueError:
+            log.warning("Health state %s is corrupt. Ignoring it.", self.path)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(self.targets, f, indent=4, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            log.warning("Can't write health state to %s: %s", self.path, e)
+
+    def get(self, key):
+        return self.targets.get(key)
+
+    def due(self, keys, now=None):
+        """
+        Return the keys in 'keys' that should be probed now, most urgent first and no more
+        than the probe budget. Keys not seen before are always the most urgent.
+        """
+        now = time.time() if now is None else now
+        due = []
+        for key in keys:
+            state = self.targets.get(key)
+            if state is None:
+                due.append((0, 0.0, key))
+            elif state['next_probe'] <= now:
+                in_flux = (state['failures'] if state['healthy'] else state['successes']) > 0
+                due.append((1 if in_flux else 2, state['next_probe'], key))
+
+        due.sort()
+        budget = self.settings['probe_budget']
+        if len(due) > budget:
+            log.info("Probe budget of %s reached. %s targets postponed.", budget, len(due) - budget)
+        return [key for _, _, key in due[:budget]]
+
+    def update(self, key, ok, message=None, now=None):
+        """
+        Record the result of probing target 'key'. Returns True if the target changed
+        state. A target seen for the first time gets the state of its first probe.
+        """
+        now = time.time() if now is None else now
+        settings = self.settings
+        state = self.targets.get(key)
+        if state is None:
+            state = self.targets[key] = {
+                'healthy': ok,
+                'successes': 0,
+                'failures': 0,
+                'changed': now,
+            }
+        healthy = state['healthy']
+
+        if ok:
+            state['successes'] += 1
+            state['failures'] = 0
+            if not state['healthy'] and state['successes'] >= settings['rise']:
+                state['healthy'] = True
+                state['changed'] = now
+        else:
+            state['failures'] += 1
+            state['successes'] = 0
+            if state['healthy'] and state['failures'] >= settings['fall']:
+                state['healthy'] = False
+                state['changed'] = now
+
+        state['message'] = 'ok' if ok else message
+        state['last_probe'] = now
+
+        if not state['healthy'] and not ok:
+            # Back off exponentially while the target stays down.
+            backoff = settings['backoff_min'] * 2 ** max(0, state['failures'] - settings['fall'])
+            interval = min(settings['backoff_max'], backoff)
+        elif ok != state['healthy'] or now - state['changed'] < settings['healthy_interval']:
+            interval = settings['transition_interval']
+        else:
+            interval = settings['healthy_interval']
+        state['next_probe'] = now + interval
+
+        if state['healthy'] != healthy:
+            log.warning("Target %s is now %s.", key, 'healthy' if state['healthy'] else 'unhealthy')
+            return True
+        return False
+
+    def prune(self, keys):
+        """Forget targets that are not in 'keys'."""
+        keys = set(keys)
+        for key in list(self.targets):
+            if key not in keys:
+                del self.targets[key]
+
+
+_health_state = None
+
+
+def get_health_state():
+    """Return the health state for this process, backed by a file in STATE_DIR."""
+    global _health_state
+    if _health_state is None:
+        _health_state = HealthState(os.path.join(STATE_DIR, STATE_FILENAME))
+    return _health_state
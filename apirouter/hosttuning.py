@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Host Tuning
+
+Derives the Nginx worker and socket settings from the machine the config is generated on,
+so each instance type gets settings that fit it:
+
+    worker_processes      One per CPU this process may run on.
+    worker_cpu_affinity   'auto', binding each worker to a CPU, if there is one per CPU.
+    worker_rlimit_nofile  What the kernel allows: 'fs.nr_open' and a share of 'fs.file-max'
+                          for each worker. The Nginx master raises the workers' limit to
+                          it, so the limit of this process doesn't matter.
+    worker_connections    Client and target connections, each an open file, leaving some
+                          files for logs and the cache, and no more than a share of the
+                          memory allows.
+    reuseport             A listen socket for each worker, so the kernel spreads new
+                          connections over them. Then 'multi_accept' is turned on, as
+                          one worker can't take connections from the others.
+    accept_mutex          Only where there is neither 'reuseport' nor EPOLLEXCLUSIVE.
+    backlog               The listen backlog, no bigger than 'net.core.somaxconn'.
+
+Each setting can be set in the 'nginx' config, but limits the host can't honor are
+lowered to what it can.
+"""
+import os
+import sys
+import logging
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+WORKER_CONNECTIONS = 30000  # Max connections per worker, if the host allows.
+LISTEN_BACKLOG = 4096  # Listen backlog, if 'somaxconn' allows.
+CONNECTION_FILE_SHARE = 0.9  # Share of the open files for connections, the rest for other files.
+CONNECTION_MEMORY = 16 * 1024  # Rough memory of an active connection, with its buffers.
+MEMORY_SHARE = 0.5  # Share of the memory the connections may take.
+FILE_MAX_SHARE = 0.5  # Share of the system wide open files limit the workers may take.
+
+PROC_FILES = {
+    'somaxconn': '/proc/sys/net/core/somaxconn',
+    'file_max': '/proc/sys/fs/file-max',
+    'nr_open': '/proc/sys/fs/nr_open',
+}
+
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            return int(f.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def _memory_bytes():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _cpu_count():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_host_info():
+    """
+    Return what the tuning is derived from: 'cpus', 'memory' in bytes, and 'somaxconn',
+    'file_max' and 'nr_open' from the kernel. Values that can't be read on this platform
+    are None.
+    """
+    info = OrderedDict([
+        ('platform', sys.platform),
+        ('cpus', _cpu_count()),
+        ('memory', _memory_bytes()),
+    ])
+    for name, path in PROC_FILES.items():
+        info[name] = _read_int(path)
+    return info
+
+
+def _lowest(*values):
+    return min(value for value in values if value is not None)
+
+
+def _override(nginx, key, value, limit):
+    # Return the value of 'key' from the 'nginx' config, or 'value' if not set. A setting
+    # over 'limit' is lowered to it. Settings that aren't numbers, like 'auto', are left to
+    # Nginx.
+    setting = nginx.get(key)
+    if setting is None:
+        return value
+    if isinstance(setting, str) and not setting.strip().isdigit():
+        return setting
+    setting = int(setting)
+    if limit is not None and setting > limit:
+        log.warning("Host can't honor %s %s. Using %s.", key, setting, limit)
+        return limit
+    return setting
+
+
+def _number(setting, default):
+    # Return 'setting' if it's a number, else 'default', which Nginx is assumed to use.
+    return setting if isinstance(setting, int) else default
+
+
+def get_tuning(host, nginx=None):
+    """
+    Return the Nginx worker and socket settings for 'host', as returned by get_host_info(),
+    with settings from the 'nginx' config applied.
+    """
+    nginx = nginx or {}
+    cpus = host['cpus'] or 1
+    workers = _override(nginx, 'worker_processes', cpus, None)
+    worker_count = _number(workers, cpus)  # 'auto' is one per CPU.
+
+    # Open files per worker.
+    file_max = host['file_max'] and int(host['file_max'] * FILE_MAX_SHARE) // worker_count
+    nofile_limit = _lowest(host['nr_open'], file_max, sys.maxsize)
+    nofile = _lowest(nofile_limit, 2 * WORKER_CONNECTIONS)
+    nofile = _override(nginx, 'worker_rlimit_nofile', nofile, nofile_limit)
+    nofile_count = _number(nofile, nofile_limit)
+
+    # Connections per worker, client and target connections both count.
+    memory = host['memory'] and int(host['memory'] * MEMORY_SHARE) // worker_count // CONNECTION_MEMORY
+    connections = _lowest(WORKER_CONNECTIONS, int(nofile_count * CONNECTION_FILE_SHARE), memory)
+    connections = _override(nginx, 'worker_connections', connections, _lowest(nofile_count, memory))
+
+    # Listen sockets. SO_REUSEPORT load balancing is Linux only, where Nginx also has
+    # EPOLLEXCLUSIVE, so the accept mutex is only needed elsewhere. The backlog is left
+    # to Nginx if 'somaxconn' is not known.
+    linux = host['platform'].startswith('linux')
+    reuseport = bool(nginx.get('reuseport', linux and worker_count > 1))
+    accept_mutex = bool(nginx.get('accept_mutex', worker_count > 1 and not reuseport and not linux))
+    multi_accept = bool(nginx.get('multi_accept', reuseport))
+    backlog = host['somaxconn'] and _lowest(host['somaxconn'], LISTEN_BACKLOG)
+    backlog = _override(nginx, 'listen_backlog', backlog, host['somaxconn'])
+
+    listen_params = []
+    if reuseport:
+        listen_params.append('reuseport')
+    if backlog:
+        listen_params.append('backlog={}'.format(backlog))
+
+    return OrderedDict([
+        ('worker_processes', workers),
+        ('worker_cpu_affinity', nginx.get('worker_cpu_affinity', 'auto' if 1 < worker_count == cpus else None)),
+        ('worker_rlimit_nofile', nofile),
+        ('worker_connections', connections),
+        ('multi_accept', multi_accept),
+        ('accept_mutex', accept_mutex),
+        ('reuseport', reuseport),
+        ('listen_backlog', backlog),
+        ('listen_params', ' '.join(listen_params)),
+    ])
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Auto Scaling Lifecycle Events
+
+Event driven target discovery. Auto Scaling lifecycle notifications and EC2 state change
+notifications are read from an event source and applied to the targets from the last
+full discovery, so the api router can react to scale-in and scale-out right away.
+
+An event source is any object with a 'poll(timeout)' method that returns a list of
+messages, and an 'ack()' method, called once the messages polled so far are applied. A
+message is either a dict or a json string.
+"""
+import os
+import json
+import time
+import queue
+import logging
+from urllib.parse import urlparse
+
+import boto3
+
+
+log = logging.getLogger(__name__)
+
+
+# Outcome of applying an event to targets.
+CHANGED = 'changed'  # Targets were updated, config should be re-rendered.
+SWEEP = 'sweep'  # A full discovery is needed to pick up the change.
+
+# Normalized actions.
+TERMINATING = 'terminating'
+TERMINATED = 'terminated'
+LAUNCHING = 'launching'
+RUNNING = 'running'
+
+# EC2 instance states from state-change notifications and what they mean for the targets.
+EC2_STATES = {
+    'pending': LAUNCHING,
+    'running': RUNNING,
+    'shutting-down': TERMINATED,
+    'stopping': TERMINATED,
+    'stopped': TERMINATED,
+    'terminated': TERMINATED,
+}
+
+
+def parse_event(message):
+    """
+    Normalize an Auto Scaling or EC2 notification in 'message' to a dict with 'instance_id'
+    and 'action'. Returns None if the message is not of interest.
+
+    Supports Auto Scaling lifecycle hook notifications and Auto Scaling notifications, both
+    raw and wrapped in an SNS envelope, and the corresponding CloudWatch/EventBridge events.
+    """
+    if not isinstance(message, dict):
+        try:
+            message = json.loads(message)
+        except ValueError:
+            log.warning("Ignoring malformed event: %r", message)
+            return
+
+    # Unwrap SNS envelope.
+    if message.get('Type') == 'Notification' and 'Message' in message:
+        return parse_event(message['Message'])
+
+    # Unwrap EventBridge event.
+    detail_type = message.get('detail-type')
+    if detail_type:
+        detail = message.get('detail', {})
+        if detail_type == 'EC2 Instance State-change Notification':
+            action = EC2_STATES.get(detail.get('state'))
+            instance_id = detail.get('instance-id')
+        else:
+            transition = detail.get('LifecycleTransition') or detail_type
+            action = _transition_to_action(transition)
+            instance_id = detail.get('EC2InstanceId')
+    else:
+        transition = message.get('LifecycleTransition') or message.get('Event') or ''
+        action = _transition_to_action(transition)
+        instance_id = message.get('EC2InstanceId')
+
+    if action and instance_id:
+        return {'instance_id': instance_id, 'action': action}
+
+
+def _transition_to_action(transition):
+    transition = transition.lower()
+    if 'terminating' in transition or 'terminate lifecycle' in transition:
+        return TERMINATING
+    elif 'terminate' in transition:
+        return TERMINATED
+    elif 'launch' in transition:
+        return LAUNCHING
+
+
+def apply_event(ec2_targets, event):
+    """
+    Apply the normalized 'event' to 'ec2_targets' as returned by get_ec2_targets_for_tier().
+    Returns CHANGED if 'ec2_targets' was modified, SWEEP if a full discovery is needed or
+    None if nothing needs to be done.
+    """
+    if event['action'] in (LAUNCHING, RUNNING):
+        # A new instance needs to be described and health checked before it goes into
+        # rotation.
+        return SWEEP
+
+    for api_target_name, targets in ec2_targets.items():
+        for target in targets:
+            if target['instance_id'] != event['instance_id']:
+                continue
+
+            if event['action'] == TERMINATING:
+                if target['tags'].get('api-param') == 'backup':
+                    return
+                log.info(
+                    "EC2 instance %s[%s] terminating. Marking it as 'backup' to drain connections.",
+                    target['name'], target['instance_id'][:7]
+                )
+                target['tags'] = dict(target['tags'], **{'api-param': 'backup'})
+            else:
+                log.info("EC2 instance %s[%s] terminated. Taking it out of rotation.", target['name'], target['instance_id'][:7])
+                targets.remove(target)
+
+            return CHANGED
+
+
+class QueueEventSource(object):
+    """Event source reading from a 'queue.Queue'. Useful as a stand-in for testing."""
+
+    def __init__(self, q):
+        self.queue = q
+
+    def poll(self, timeout):
+        messages = []
+        try:
+            messages.append(self.queue.get(timeout=timeout))
+            while True:
+                messages.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return messages
+
+    def ack(self):
+        pass
+
+
+class FileEventSource(object):
+    """
+    Event source reading json messages from a local file, one per line. New lines appended
+    to the file are picked up, and the file is reopened if it's rotated or truncated.
+
+    Lines already in the file when the source is created are skipped, as the first full
+    discovery covers them. A file created or replaced later is read from the start.
+    """
+    POLL_INTERVAL = 0.2
+
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+        self.inode = None
+        self.skip_existing = True
+
+    def _open(self):
+        skip_existing, self.skip_existing = self.skip_existing, False
+        if not os.path.exists(self.path):
+            return
+        st = os.stat(self.path)
+        if self.f is not None and st.st_ino == self.inode and st.st_size >= self.f.tell():
+            return
+
+        # File was replaced or truncated.
+        if self.f is not None:
+            self.f.close()
+        self.f = open(self.path, 'r')
+        self.inode = st.st_ino
+        if skip_existing:
+            self.f.seek(0, os.SEEK_END)
+
+    def poll(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            self._open()
+            lines = self.f.readlines() if self.f else []
+            messages = [line for line in lines if line.strip()]
+            if messages or time.time() >= deadline:
+                return messages
+            time.sleep(min(self.POLL_INTERVAL, max(deadline - time.time(), 0)))
+
+    def ack(self):
+        pass
+
+
+class SqsEventSource(object):
+    """
+    Event source reading from an SQS queue using long polling. Messages are only deleted
+    from the queue when acked, so the ones a failed cycle or a crash didn't apply are
+    received again after the visibility timeout of the queue.
+    """
+    MAX_WAIT = 20  # Max long polling wait time supported by SQS.
+    BATCH_SIZE = 10  # Max messages per receive and delete call supported by SQS.
+
+    def __init__(self, queue_url, region_name=None):
+        self.queue_url = queue_url
+        if region_name is None:
+            # Queue url is of the form https://sqs.<region>.amazonaws.com/<account>/<name>
+            region_name = urlparse(queue_url).hostname.split('.')[1]
+        self.client = boto3.client('sqs', region_name=region_name)
+        self.receipts = []  # Receipt handles of the messages not acked yet.
+
+    def poll(self, timeout):
+        ret = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=self.BATCH_SIZE,
+            WaitTimeSeconds=int(min(max(timeout, 0), self.MAX_WAIT)),
+        )
+        messages = ret.get('Messages', [])
+        self.receipts.extend(message['ReceiptHandle'] for message in messages)
+        return [message['Body'] for message in messages]
+
+    def ack(self):
+        while self.receipts:
+            batch = self.receipts[:self.BATCH_SIZE]
+            self.client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(i), 'ReceiptHandle': receipt} for i, receipt in enumerate(batch)],
+            )
+            del self.receipts[:len(batch)]
+
+
+def create_event_source(url):
+    """Create an event source from 'url'. It's either an SQS queue url or a file path."""
+    parts = urlparse(url)
+    if parts.scheme in ('http', 'https') and parts.hostname.startswith('sqs.'):
+        return SqsEventSource(url)
+    elif parts.scheme == 'file':
+        return FileEventSource(parts.path)
+    elif not parts.scheme:
+        return FileEventSource(url)
+    raise RuntimeError("Unsupported event source url: {}".format(url))
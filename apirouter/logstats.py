@@ -0,0 +1,602 @@
+# -*- coding: utf-8 -*-
+"""
+Access Log Stats
+
+Reads the Nginx access log, which is written in the 'jsonlog' format from
+nginx.conf.jinja, and summarizes the traffic in it.
+
+cache_stats() counts the response cache status of requests by location prefix, from the
+tail of the log.
+
+LogAnalyzer keeps rolling latency percentiles, error rate and throughput per route,
+tenant, api key and upstream server. Latencies are kept in histograms with logarithmic
+buckets and each dimension tracks a limited number of keys, so memory use is bounded no
+matter how much traffic is analyzed. LogTailer feeds it the lines added to the log since
+the last read, and follows the log through logrotate. The read position and the rolling
+stats are saved in the state directory, so they carry over between runs from cron. Old
+logs, plain or gzipped, can be analyzed from the command line:
+
+    python -m apirouter.logstats /var/log/nginx/access.log.2.gz /var/log/nginx/access.log.1
+"""
+import os
+import re
+import sys
+import gzip
+import json
+import math
+import time
+import logging
+import multiprocessing
+from collections import OrderedDict
+
+import click
+
+from apirouter import STATE_DIR
+
+
+log = logging.getLogger(__name__)
+
+
+LOG_TAIL_BYTES = 4 * 1024 * 1024  # How much of the end of the access log to read.
+LOG_READ_BYTES = 8 * 1024 * 1024  # How far back from the end of the log to start tailing it.
+ANALYZE_PART_BYTES = 16 * 1024 * 1024  # Logs are analyzed in parts of this size.
+
+TRAFFIC_WINDOW = 300.0  # Seconds of traffic covered by the rolling stats.
+TRAFFIC_SLOT = 60.0  # The window moves in steps of this many seconds.
+MAX_KEYS = 200  # Max keys tracked per dimension. Traffic for other keys goes under OTHER_KEY.
+OTHER_KEY = '_other'
+TRAFFIC_STATE_FILENAME = 'traffic-state.json'
+
+HISTOGRAM_GROWTH = 1.1  # Ratio between histogram bucket bounds. Percentiles are within 5%.
+PERCENTILES = (50, 95, 99)
+
+# Dimensions the traffic is broken down by.
+DIMENSIONS = ('route', 'tenant', 'api_key', 'upstream')
+
+# Cache statuses of responses that were served from the cache.
+CACHE_HIT_STATUSES = {'HIT', 'STALE', 'UPDATING', 'REVALIDATED'}
+
+
+def tail_lines(path, max_bytes=None):
+    """Return the complete lines in the last 'max_bytes' of the file at 'path'."""
+    max_bytes = LOG_TAIL_BYTES if max_bytes is None else max_bytes
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - max_bytes))
+        data = f.read()
+    lines = data.decode('utf-8', 'replace').splitlines()
+    if size > max_bytes and lines:
+        lines = lines[1:]  # Most likely cut in half.
+    return lines
+
+
+def _match_prefix(uri, prefixes):
+    # 'prefixes' are sorted longest first, like Nginx matches prefix locations.
+    for prefix in prefixes:
+        if uri.startswith(prefix):
+            return prefix
+
+
+def cache_stats(path, prefixes, max_bytes=None):
+    """
+    Return cache stats of requests in the access log at 'path' whose uri starts with one of
+    'prefixes', keyed by prefix. Each is a dict with the number of 'requests', the number
+    of cache 'hits', the 'hit_ratio' and a count of each cache status.
+
+    Returns None if the log can't be read.
+    """
+    try:
+        lines = tail_lines(path, max_bytes)
+    except (IOError, OSError) as e:
+        log.info("Can't read access log %s: %s", path, e)
+        return None
+
+    prefixes = sorted(prefixes, key=len, reverse=True)
+    stats = {prefix: {'requests': 0, 'hits': 0, 'hit_ratio': None, 'statuses': {}} for prefix in prefixes}
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue  # Nginx doesn't json escape all values.
+        status = entry.get('cache_status')
+        request = entry.get('request', '').split()
+        if not status or len(request) < 2:
+            continue
+        prefix = _match_prefix(request[1], prefixes)
+        if prefix is None:
+            continue
+
+        stat = stats[prefix]
+        stat['requests'] += 1
+        stat['statuses'][status] = stat['statuses'].get(status, 0) + 1
+        if status in CACHE_HIT_STATUSES:
+            stat['hits'] += 1
+
+    for stat in stats.values():
+        if stat['requests']:
+            stat['hit_ratio'] = round(stat['hits'] / stat['requests'], 3)
+    return stats
+
+
+_log_growth = math.log(HISTOGRAM_GROWTH)
+
+
+def bucket_index(ms):
+    """Return the index of the histogram bucket for a latency of 'ms' milliseconds."""
+    return 0 if ms < 1.0 else int(math.log(ms) / _log_growth) + 1
+
+
+class Histogram(object):
+    """Latency histogram in milliseconds, with logarithmic buckets."""
+
+    def __init__(self):
+        self.buckets = {}  # Bucket index -> count
+        self.count = 0
+
+    def add(self, index):
+        """Count a latency in bucket 'index', see bucket_index()."""
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+
+    def percentile(self, p):
+        """Return the 'p' percentile in milliseconds, or None if the histogram is empty."""
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                break
+        if index == 0:
+            return 0.0
+        # The geometric middle of the bucket.
+        return round(HISTOGRAM_GROWTH ** (index - 0.5), 1)
+
+    def to_dict(self):
+        return {str(index): count for index, count in self.buckets.items()}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.buckets = {int(index): count for index, count in data.items()}
+        histogram.count = sum(histogram.buckets.values())
+        return histogram
+
+
+class TrafficStats(object):
+    """Request count, errors and latency of one key."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0  # 5xx responses
+        self.latency = Histogram()
+
+    def add(self, index, error):
+        """Count a request with latency in histogram bucket 'index', or None if unknown."""
+        self.requests += 1
+        if error:
+            self.errors += 1
+        if index is not None:
+            self.latency.add(index)
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.errors += other.errors
+        self.latency.merge(other.latency)
+
+    def to_dict(self):
+        return {'requests': self.requests, 'errors': self.errors, 'latency': self.latency.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.requests = data['requests']
+        stats.errors = data['errors']
+        stats.latency = Histogram.from_dict(data['latency'])
+        return stats
+
+    def summary(self, seconds):
+        summary = OrderedDict([
+            ('requests', self.requests),
+            ('rps', round(self.requests / seconds, 2)),
+            ('error_rate', round(self.errors / self.requests, 4) if self.requests else None),
+        ])
+        for p in PERCENTILES:
+            summary['p{}_ms'.format(p)] = self.latency.percentile(p)
+        return summary
+
+
+# Picks the analyzed fields out of a 'jsonlog' line, which is much faster than parsing
+# the json. Lines that don't match are parsed as json.
+_line_re = re.compile(
+    r'"timestamp":\s*"(?P<timestamp>[^"]*)".*?'
+    r'"drift_api_key":\s*"(?P<drift_api_key>[^"]*)".*?'
+    r'"host":\s*"(?P<host>[^"]*)",\s*'
+    r'"request":\s*"(?P<request>[^"]*)".*?'
+    r'"response_code":\s*(?P<response_code>\d+),.*?'
+    r'"request_time":\s*(?P<request_time>[\d.]+),\s*'
+    r'"upstream_response_time":\s*"(?P<upstream_response_time>[^"]*)",\s*'
+    r'"upstream_addr":\s*"(?P<upstream_addr>[^"]*)"'
+)
+
+
+def parse_line(line):
+    """
+    Return the fields of access log 'line' that are analyzed, as a tuple of timestamp,
+    status, request time and upstream response time in milliseconds, and a tuple of keys
+    in the order of DIMENSIONS. Returns None if the line can't be parsed.
+    """
+    m = _line_re.search(line)
+    try:
+        entry = m.groupdict() if m else json.loads(line)
+        timestamp = float(entry['timestamp'])
+        status = int(entry['response_code'])
+        request_time = float(entry['request_time']) * 1000
+    except (ValueError, KeyError, TypeError):
+        return None
+
+    request = entry.get('request', '').split()
+    path = request[1] if len(request) > 1 else ''
+    host = entry.get('host', '')
+    api_key = entry.get('drift_api_key', '')
+
+    # On retries, the upstream fields list each server tried. The last one answered.
+    upstream = entry.get('upstream_addr', '').replace(' : ', ', ').rpartition(', ')[2]
+    upstream_time = entry.get('upstream_response_time', '').replace(' : ', ', ').rpartition(', ')[2]
+    try:
+        upstream_time = float(upstream_time) * 1000
+    except ValueError:
+        upstream_time = None
+
+    keys = (
+        '/' + path.lstrip('/').partition('/')[0].partition('?')[0],
+        host.partition('.')[0] if '.' in host else None,
+        api_key.partition(':')[0] or None,  # Without the client version.
+        upstream or None,
+    )
+    return timestamp, status, request_time, upstream_time, keys
+
+
+class LogAnalyzer(object):
+    """
+    Rolling traffic stats over the last 'window' seconds, per key in each of DIMENSIONS.
+    If 'window' is None, all traffic is included.
+    """
+
+    def __init__(self, window=TRAFFIC_WINDOW, slot=TRAFFIC_SLOT, max_keys=MAX_KEYS):
+        self.window = window
+        self.slot = slot if window else None
+        self.max_keys = max_keys
+        self.slots = {}  # Slot number -> list of dicts of key -> TrafficStats, one per dimension
+        self.newest_slot = None
+        self.first_seen = None
+        self.last_seen = None
+        self.lines = 0
+        self.bad_lines = 0
+
+    def _get_slot(self, timestamp):
+        number = int(timestamp // self.slot) if self.slot else 0
+        slot = self.slots.get(number)
+        if slot is not None:
+            return slot
+
+        if self.slot and self.newest_slot is not None:
+            keep = int(math.ceil(self.window / self.slot))
+            if number <= self.newest_slot - keep:
+                return None  # Older than the window.
+            if number > self.newest_slot:
+                for old in [n for n in self.slots if n <= number - keep]:
+                    del self.slots[old]
+        if self.newest_slot is None or number > self.newest_slot:
+            self.newest_slot = number
+        slot = self.slots[number] = [{} for dimension in DIMENSIONS]
+        return slot
+
+    def add_line(self, line):
+        self.lines += 1
+        parsed = parse_line(line)
+        if parsed is None:
+            self.bad_lines += 1
+            return
+        timestamp, status, request_time, upstream_time, keys = parsed
+        slot = self._get_slot(timestamp)
+        if slot is None:
+            return
+
+        if self.first_seen is None or timestamp < self.first_seen:
+            self.first_seen = timestamp
+        if self.last_seen is None or timestamp > self.last_seen:
+            self.last_seen = timestamp
+
+        error = status >= 500
+        index = bucket_index(request_time)
+        # The upstream dimension is last, and gets the upstream response time.
+        indexes = (index, index, index, None if upstream_time is None else bucket_index(upstream_time))
+        for stats, key, index in zip(slot, keys, indexes):
+            if key is None:
+                continue
+            key_stats = stats.get(key)
+            if key_stats is None:
+                if len(stats) >= self.max_keys:
+                    key = OTHER_KEY
+                key_stats = stats.get(key)
+                if key_stats is None:
+                    key_stats = stats[key] = TrafficStats()
+            key_stats.add(index, error)
+
+    def add_lines(self, lines):
+        for line in lines:
+            self.add_line(line)
+
+    def merge(self, other):
+        """Add the stats in analyzer 'other' to this one."""
+        for number, other_slot in sorted(other.slots.items()):
+            timestamp = number * other.slot if other.slot else 0
+            slot = self._get_slot(timestamp)
+            if slot is None:
+                continue
+            for stats, other_stats in zip(slot, other_slot):
+                for key, key_stats in other_stats.items():
+                    if key not in stats and len(stats) >= self.max_keys:
+                        key = OTHER_KEY
+                    stats.setdefault(key, TrafficStats()).merge(key_stats)
+
+        for seen, pick in (('first_seen', min), ('last_seen', max)):
+            values = [value for value in (getattr(self, seen), getattr(other, seen)) if value is not None]
+            setattr(self, seen, pick(values) if values else None)
+        self.lines += other.lines
+        self.bad_lines += other.bad_lines
+
+    def to_dict(self):
+        """Return the stats as a dict that can be saved as json, see load()."""
+        return {
+            'slots': {
+                str(number): [{key: stats.to_dict() for key, stats in dimension.items()} for dimension in slot]
+                for number, slot in self.slots.items()
+            },
+            'newest_slot': self.newest_slot,
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen,
+            'lines': self.lines,
+            'bad_lines': self.bad_lines,
+        }
+
+    def load(self, data):
+        """Replace the stats with the ones in 'data', as returned by to_dict()."""
+        self.slots = {
+            int(number): [{key: TrafficStats.from_dict(stats) for key, stats in dimension.items()} for dimension in slot]
+            for number, slot in data['slots'].items()
+        }
+        for name in ('newest_slot', 'first_seen', 'last_seen', 'lines', 'bad_lines'):
+            setattr(self, name, data[name])
+
+    def summary(self, now=None):
+        """
+        Return the stats of the traffic in the window ending at 'now' as a dict of
+        dimension -> key -> stats, most requests first, along with the time range covered.
+        """
+        if self.window:
+            now = time.time() if now is None else now
+            start = now - self.window
+            slots = [slot for number, slot in sorted(self.slots.items()) if (number + 1) * self.slot > start]
+            seconds = min(self.window, max(1.0, now - max(start, self.first_seen or start)))
+        else:
+            slots = [slot for number, slot in sorted(self.slots.items())]
+            seconds = max(1.0, (self.last_seen or 0) - (self.first_seen or 0))
+
+        summary = OrderedDict([
+            ('window_seconds', round(seconds, 1)),
+            ('lines', self.lines),
+            ('bad_lines', self.bad_lines),
+        ])
+        for i, dimension in enumerate(DIMENSIONS):
+            merged = {}
+            for slot in slots:
+                for key, stats in slot[i].items():
+                    if key not in merged and len(merged) >= self.max_keys:
+                        key = OTHER_KEY
+                    merged.setdefault(key, TrafficStats()).merge(stats)
+            summary[dimension] = OrderedDict(
+                (key, stats.summary(seconds))
+                for key, stats in sorted(merged.items(), key=lambda item: -item[1].requests)
+            )
+        return summary
+
+
+def open_log(path):
+    """Open access log 'path' for reading lines, gzipped if it ends with '.gz'."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, 'r', encoding='utf-8', errors='replace')
+
+
+class LogTailer(object):
+    """
+    Reads lines added to the log at 'path' since the last read. The first read starts at
+    most 'initial_bytes' from the end. If the log was rotated since the last read, the
+    rest of the old log is read from '<path>.1' first.
+    """
+
+    def __init__(self, path, initial_bytes=LOG_READ_BYTES):
+        self.path = path
+        self.initial_bytes = initial_bytes
+        self.inode = None
+        self.offset = None
+
+    def _read_from(self, path, offset, skip_partial=False):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            if skip_partial:
+                offset += len(f.readline())
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # Still being written.
+                offset += len(line)
+                yield line.decode('utf-8', 'replace')
+        self.offset = offset
+
+    def read(self):
+        """Yield the lines added since the last read."""
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            log.info("Can't read access log %s: %s", self.path, e)
+            return
+
+        if self.inode is not None and st.st_ino != self.inode:
+            rotated = self.path + '.1'
+            try:
+                if os.stat(rotated).st_ino == self.inode:
+                    for line in self._read_from(rotated, self.offset):
+                        yield line
+            except OSError:
+                pass
+            self.offset = 0
+        elif self.offset is not None and st.st_size < self.offset:
+            self.offset = 0  # Truncated.
+
+        skip_partial = False
+        if self.offset is None:
+            self.offset = max(0, st.st_size - self.initial_bytes)
+            skip_partial = self.offset > 0
+        self.inode = st.st_ino
+        for line in self._read_from(self.path, self.offset, skip_partial):
+            yield line
+
+
+def _analyze_part(args):
+    """
+    Return a LogAnalyzer with all traffic in the lines of 'path' that start between byte
+    'start' and 'end'. If 'end' is None the whole file is read, which can be gzipped.
+    """
+    path, start, end, max_keys = args
+    analyzer = LogAnalyzer(window=None, max_keys=max_keys)
+    if end is None:
+        with open_log(path) as f:
+            analyzer.add_lines(f)
+        return analyzer
+
+    with open(path, 'rb') as f:
+        if start:
+            # Skip to the start of the first line that starts at or after 'start'.
+            f.seek(start - 1)
+            f.readline()
+        data = f.read(max(0, end - f.tell()))
+        if data and not data.endswith(b'\n'):
+            data += f.readline()  # The rest of the last line.
+    analyzer.add_lines(data.decode('utf-8', 'replace').splitlines())
+    return analyzer
+
+
+def analyze_files(paths, jobs=1, max_keys=MAX_KEYS):
+    """
+    Return a LogAnalyzer with all traffic in the access logs in 'paths', plain or gzipped.
+    Plain logs are split in parts of ANALYZE_PART_BYTES, and with 'jobs' > 1 the parts and
+    gzipped logs are analyzed in that many processes.
+    """
+    parts = []
+    for path in paths:
+        size = os.path.getsize(path)
+        if path.endswith('.gz'):
+            parts.append((path, 0, None, max_keys))
+        else:
+            parts.extend(
+                (path, start, min(start + ANALYZE_PART_BYTES, size), max_keys)
+                for start in range(0, size, ANALYZE_PART_BYTES)
+            )
+
+    analyzer = LogAnalyzer(window=None, max_keys=max_keys)
+    if jobs > 1 and len(parts) > 1:
+        with multiprocessing.Pool(min(jobs, len(parts))) as pool:
+            for part in pool.imap_unordered(_analyze_part, parts):
+                analyzer.merge(part)
+    else:
+        for part in parts:
+            analyzer.merge(_analyze_part(part))
+    return analyzer
+
+
+_tailers = {}
+
+
+def _load_traffic_state(path, state_path):
+    # Return the LogTailer and LogAnalyzer for the access log at 'path', with the read
+    # position and stats from 'state_path' if it has them for this log.
+    tailer, analyzer = LogTailer(path), LogAnalyzer()
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+        if state['path'] == path:
+            tailer.inode = state['inode']
+            tailer.offset = state['offset']
+            analyzer.load(state['analyzer'])
+    except (IOError, OSError):
+        pass
+    except (ValueError, KeyError, TypeError):
+        log.warning("Traffic state %s is corrupt. Ignoring it.", state_path)
+        tailer, analyzer = LogTailer(path), LogAnalyzer()
+    return tailer, analyzer
+
+
+def _save_traffic_state(path, state_path, tailer, analyzer):
+    state = {
+        'path': path,
+        'inode': tailer.inode,
+        'offset': tailer.offset,
+        'analyzer': analyzer.to_dict(),
+    }
+    tmp_path = '{}.{}.tmp'.format(state_path, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(state_path), exist_ok=True)
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, state_path)
+    except (IOError, OSError) as e:
+        log.warning("Can't write traffic state to %s: %s", state_path, e)
+
+
+def update_traffic_stats(path, state_path=None):
+    """
+    Read the lines added to the access log at 'path' since the last call into a rolling
+    LogAnalyzer, and return its summary. The read position and the stats are saved to
+    'state_path', by default in STATE_DIR, so the next run from cron carries on from them.
+    """
+    state_path = state_path or os.path.join(STATE_DIR, TRAFFIC_STATE_FILENAME)
+    key = (path, state_path)
+    if key not in _tailers:
+        _tailers[key] = _load_traffic_state(path, state_path)
+    tailer, analyzer = _tailers[key]
+    analyzer.add_lines(tailer.read())
+    _save_traffic_state(path, state_path, tailer, analyzer)
+    return analyzer.summary()
+
+
+@click.command()
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True))
+@click.option('--jobs', '-j', default=os.cpu_count() or 1, help='Number of processes to use.')
+@click.option('--max-keys', '-k', default=MAX_KEYS, help='Max keys tracked per dimension.')
+@click.option('--top', '-t', default=10, help='Keys to show per dimension. 0 shows all.')
+def cli(paths, jobs, max_keys, top):
+    """Analyze the traffic in access logs, plain or gzipped, and print the stats as json."""
+    t = time.perf_counter()
+    analyzer = analyze_files(paths, jobs=jobs, max_keys=max_keys)
+    elapsed = time.perf_counter() - t
+
+    summary = analyzer.summary()
+    if top:
+        for dimension in DIMENSIONS:
+            summary[dimension] = OrderedDict(list(summary[dimension].items())[:top])
+    json.dump(summary, sys.stdout, indent=4)
+    sys.stdout.write('\n')
+    sys.stderr.write("{} lines analyzed in {:.2f}s.\n".format(analyzer.lines, elapsed))
+
+
+if __name__ == '__main__':
+    cli()
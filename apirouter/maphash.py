@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Map Hash Sizing
+
+Nginx puts the exact keys of each 'map' block in a hash, built with ngx_hash_init() when
+the config is loaded. All maps share the 'map_hash_max_size' and 'map_hash_bucket_size'
+settings. Each key takes a hash element of a pointer, its length and the key, aligned to
+a pointer, and the elements of a bucket must fit in 'map_hash_bucket_size'. Nginx tries
+hash sizes from about the number of keys up to 'map_hash_max_size' and picks the first
+one where no bucket overflows.
+
+If a key is too long for the bucket size Nginx refuses to start. If no hash size up to
+the max fits, it warns and builds the hash with the max size and bigger buckets. Too big
+values waste memory, as every worker has a copy of each hash, and lookups touch more
+cache lines.
+
+This module simulates ngx_hash_init() on the keys of the generated maps to pick the
+settings, and to check them.
+"""
+import logging
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+POINTER_SIZE = 8  # 64 bit Nginx.
+CACHELINE_SIZE = 64  # Buckets are aligned to, and 'map_hash_bucket_size' rounded up to, this.
+MAX_BUCKET_SIZE = 65536 - CACHELINE_SIZE  # Nginx can't build a bucket bigger than this.
+HASH_MASK = 2 ** 64 - 1  # ngx_uint_t
+
+HEADROOM = 1.1  # The max size is this much bigger than the biggest hash.
+MIN_MAX_SIZE = 512  # Smallest 'map_hash_max_size' to use.
+MAX_SIZE_STEP = 128  # 'map_hash_max_size' is a multiple of this.
+BUCKET_SIZE_CHOICES = 4  # Number of bucket sizes tried, each double the last.
+MEMORY_SLACK = 1.25  # A bigger bucket size must save more than this much memory to be used.
+SEARCH_STEP = 1.02  # Growth of the hash size when searching for one that fits.
+SEARCH_LIMIT = 32  # Hash sizes are searched up to this times the number of keys.
+CHECK_ATTEMPTS = 10  # Times the max size is raised when a map doesn't fit in it.
+
+
+def _align(size, boundary):
+    return (size + boundary - 1) // boundary * boundary
+
+
+def hash_key(key):
+    """Return the ngx_hash_key_lc() hash of 'key'."""
+    h = 0
+    for c in key.lower().encode('utf-8'):
+        h = (h * 31 + c) & HASH_MASK
+    return h
+
+
+def element_size(key):
+    """Return the size of the hash element for 'key', NGX_HASH_ELT_SIZE."""
+    return POINTER_SIZE + _align(len(key.encode('utf-8')) + 2, POINTER_SIZE)
+
+
+def hash_items(keys):
+    """
+    Return a list of (hash, element size) tuples for 'keys'. Nginx lowercases the keys, and
+    refuses to load a map with the same key twice, so duplicates are left out and returned
+    as well, in a tuple of items and duplicates.
+    """
+    seen = set()
+    items = []
+    duplicates = []
+    for key in keys:
+        lower = key.lower()
+        if lower in seen:
+            duplicates.append(key)
+            continue
+        seen.add(lower)
+        items.append((hash_key(lower), element_size(lower)))
+    return items, duplicates
+
+
+def _fits(items, size, bucket_size):
+    # Nginx keeps a pointer at the end of each bucket.
+    room = bucket_size - POINTER_SIZE
+    loads = [0] * size
+    for key_hash, elt_size in items:
+        i = key_hash % size
+        load = loads[i] + elt_size
+        if load > room:
+            return False
+        loads[i] = load
+    return True
+
+
+def _start_size(items, bucket_size, max_size=None):
+    # Where ngx_hash_init() starts looking. With a big max size only the last 1000 sizes
+    # are tried.
+    if max_size is not None and max_size > 10000 and items and max_size // len(items) < 100:
+        return max_size - 1000
+    return len(items) // ((bucket_size - POINTER_SIZE) // (2 * POINTER_SIZE)) or 1
+
+
+def hash_memory(items, size):
+    """Return the bytes taken by a hash of 'items' with 'size' buckets."""
+    loads = {}
+    for key_hash, elt_size in items:
+        i = key_hash % size
+        loads[i] = loads.get(i, POINTER_SIZE) + elt_size
+    buckets = sum(_align(load, CACHELINE_SIZE) for load in loads.values())
+    return size * POINTER_SIZE + buckets + CACHELINE_SIZE
+
+
+def build_hash(items, max_size, bucket_size):
+    """
+    Simulate ngx_hash_init() building a hash of 'items' with 'max_size' and 'bucket_size'.
+    Returns a tuple of the hash size and a problem, or None. A problem that starts with
+    "error" means Nginx won't load the config.
+    """
+    bucket_size = _align(bucket_size, CACHELINE_SIZE)
+    if bucket_size > MAX_BUCKET_SIZE:
+        return None, "error: map_hash_bucket_size {} is too large".format(bucket_size)
+    longest = max([elt_size for _, elt_size in items] or [0])
+    if bucket_size < longest + POINTER_SIZE:
+        return None, "error: a key needs map_hash_bucket_size {}".format(_align(longest + POINTER_SIZE, CACHELINE_SIZE))
+
+    for size in range(_start_size(items, bucket_size, max_size), max_size + 1):
+        if _fits(items, size, bucket_size):
+            return size, None
+
+    # Nginx goes ahead with the max size, ignoring the bucket size.
+    if not _fits(items, max_size, MAX_BUCKET_SIZE):
+        return None, "error: map_hash_max_size {} is too small".format(max_size)
+    return max_size, "map_hash_max_size {} or map_hash_bucket_size {} is too small".format(max_size, bucket_size)
+
+
+def smallest_hash(items, bucket_size):
+    """
+    Return a small hash size that fits 'items' with 'bucket_size', or None if none was found.
+    The sizes are searched in steps, so it's not necessarily the smallest one.
+    """
+    size = _start_size(items, bucket_size)
+    limit = max(SEARCH_LIMIT * len(items), MIN_MAX_SIZE)
+    while size <= limit:
+        if _fits(items, size, bucket_size):
+            return size
+        size = max(size + 1, int(size * SEARCH_STEP))
+    return None
+
+
+def _round_max_size(size):
+    return max(MIN_MAX_SIZE, _align(int(size * HEADROOM), MAX_SIZE_STEP))
+
+
+def _check_hashes(hashes, max_size, bucket_size):
+    ret = OrderedDict()
+    for name, (items, duplicates) in hashes.items():
+        size, problem = build_hash(items, max_size, bucket_size)
+        if duplicates:
+            problem = "error: duplicate keys {}".format(', '.join(sorted(duplicates)[:5]))
+        ret[name] = {
+            'entries': len(items),
+            'hash_size': size,
+            'hash_bytes': hash_memory(items, size) if size else None,
+            'problem': problem,
+        }
+    return ret
+
+
+def check_map_hashes(maps, max_size, bucket_size):
+    """
+    Simulate building the hashes of 'maps', a dict of map name -> list of hash keys, with
+    'max_size' and 'bucket_size'. Returns a dict of map name -> dict with the number of
+    'entries', the 'hash_size', the 'hash_bytes' and a 'problem', or None. A problem that
+    starts with "error" means Nginx won't load the config.
+    """
+    hashes = OrderedDict((name, hash_items(keys)) for name, keys in maps.items())
+    return _check_hashes(hashes, max_size, bucket_size)
+
+
+def _fit_max_size(hashes, max_size, bucket_size):
+    # Raise 'max_size' until Nginx finds a hash size that fits each map below it. It
+    # usually does right away, but with big maps Nginx only tries the last 1000 sizes.
+    for _ in range(CHECK_ATTEMPTS):
+        checked = _check_hashes(hashes, max_size, bucket_size)
+        if not any(check['problem'] and not check['problem'].startswith('error') for check in checked.values()):
+            break
+        max_size = _round_max_size(max_size)
+    return max_size, checked
+
+
+def get_map_hash_settings(maps, max_size=None, bucket_size=None):
+    """
+    Return a dict with 'max_size' and 'bucket_size' for the hashes of 'maps', a dict of map
+    name -> list of hash keys, and the result of check_map_hashes() in 'maps'. Problems are
+    logged, as errors if Nginx would not load the config.
+
+    Settings that are not given are computed. Bucket sizes from the smallest one that fits
+    the longest key and up are tried, with the max size set with some headroom above the
+    hash sizes needed. Bigger buckets take less memory, as the hashes get fewer buckets,
+    but lookups touch more cache lines. The smallest bucket size that takes no more than
+    MEMORY_SLACK times the least memory is picked.
+    """
+    hashes = OrderedDict((name, hash_items(keys)) for name, keys in maps.items())
+    if bucket_size is None:
+        longest = max([elt_size for items, _ in hashes.values() for _, elt_size in items] or [0])
+        smallest_bucket = max(CACHELINE_SIZE, _align(longest + POINTER_SIZE, CACHELINE_SIZE))
+        bucket_sizes = [
+            smallest_bucket * 2 ** i for i in range(BUCKET_SIZE_CHOICES)
+            if smallest_bucket * 2 ** i <= MAX_BUCKET_SIZE
+        ]
+    else:
+        bucket_sizes = [bucket_size]
+
+    if max_size is None or len(bucket_sizes) > 1:
+        # Simulating Nginx exactly is slow for big maps, so the settings are picked with
+        # estimates, and only checked exactly at the end.
+        candidates = []  # (memory, bucket size, max size)
+        for size in bucket_sizes:
+            hash_sizes = [smallest_hash(items, size) for items, _ in hashes.values()]
+            if None in hash_sizes:
+                continue
+            candidate_max_size = max_size or _round_max_size(max(hash_sizes + [1]))
+            memory = sum(
+                hash_memory(items, max(hash_size, _start_size(items, size, candidate_max_size)))
+                for (items, _), hash_size in zip(hashes.values(), hash_sizes)
+            )
+            candidates.append((memory, size, candidate_max_size))
+
+        if candidates:
+            least = min(memory for memory, _, _ in candidates)
+            _, bucket_size, candidate_max_size = [c for c in candidates if c[0] <= least * MEMORY_SLACK][0]
+        else:
+            # The keys don't spread well at all. Let Nginx make the best of it.
+            log.warning("Found no map hash size that fits the keys.")
+            bucket_size = bucket_sizes[-1]
+            candidate_max_size = _round_max_size(SEARCH_LIMIT * max(len(items) for items, _ in hashes.values()))
+
+    if max_size is None:
+        max_size, checked = _fit_max_size(hashes, candidate_max_size, bucket_size)
+    else:
+        checked = _check_hashes(hashes, max_size, bucket_size)
+
+    for name, check in checked.items():
+        if check['problem'] and check['problem'].startswith('error'):
+            log.error("Nginx will fail to build map %s: %s", name, check['problem'])
+        elif check['problem']:
+            log.warning("Map %s is not optimal: %s", name, check['problem'])
+
+    return {'max_size': max_size, 'bucket_size': bucket_size, 'maps': checked}
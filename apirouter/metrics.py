@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Cycle Metrics
+
+Collects timing spans and counts for each discovery -> render -> apply cycle and emits
+them as a single json record when the cycle is done.
+
+The record is printed as a '@cee:' line, which the rsyslog config in 'aws/rsyslog.d'
+parses as json. It can also be written to a Prometheus node exporter textfile and sent
+to StatsD.
+
+Code in the cycle reports through the module level functions span(), count() and
+gauge(), which do nothing when no cycle is being measured.
+"""
+import os
+import sys
+import json
+import time
+import pstats
+import socket
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+log = logging.getLogger(__name__)
+
+
+CEE_COOKIE = '@cee: '  # rsyslog mmjsonparse only parses messages with this prefix.
+METRIC_PREFIX = 'apirouter'
+
+# Exporters configured with configure().
+_exporters = {
+    'json': True,
+    'textfile': None,
+    'statsd': None,
+}
+
+_current = None
+
+
+class CycleMetrics(object):
+    """Timing spans and counts for a single cycle on 'tier_name'."""
+
+    def __init__(self, tier_name):
+        self.tier_name = tier_name
+        self.started = time.time()
+        self.duration = None
+        self.result = None
+        self.spans = OrderedDict()  # Span name -> seconds
+        self.counts = OrderedDict()  # Count name -> number
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t
+            with self._lock:
+                self.spans[name] = self.spans.get(name, 0.0) + elapsed
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.counts[name] = value
+
+    def record(self):
+        """Return the metrics as a json serializable dict."""
+        return OrderedDict([
+            ('event', 'apirouter.cycle'),
+            ('tier', self.tier_name),
+            ('started', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started))),
+            ('duration_ms', round((self.duration or 0.0) * 1000, 1)),
+            ('result', self.result),
+            ('spans_ms', OrderedDict((name, round(seconds * 1000, 1)) for name, seconds in self.spans.items())),
+            ('counts', self.counts),
+        ])
+
+
+def configure(json_record=True, textfile=None, statsd=None):
+    """
+    Configure where cycle metrics go. 'json_record' prints the '@cee:' record to stdout,
+    'textfile' is a Prometheus textfile path and 'statsd' is a "host:port" string.
+    """
+    _exporters['json'] = json_record
+    _exporters['textfile'] = textfile
+    _exporters['statsd'] = statsd
+
+
+@contextmanager
+def cycle(tier_name):
+    """Measure a cycle on 'tier_name'. The metrics are exported when the block exits."""
+    global _current
+    metrics = CycleMetrics(tier_name)
+    _current = metrics
+    t = time.perf_counter()
+    try:
+        yield metrics
+    except Exception:
+        metrics.result = 'error'
+        raise
+    finally:
+        metrics.duration = time.perf_counter() - t
+        _current = None
+        export(metrics)
+
+
+def current():
+    """Return the metrics of the cycle being measured, or None."""
+    return _current
+
+
+@contextmanager
+def span(name):
+    """Time the block as span 'name' of the current cycle."""
+    metrics = _current
+    if metrics is None:
+        yield
+    else:
+        with metrics.span(name):
+            yield
+
+
+def count(name, value=1):
+    """Add 'value' to count 'name' of the current cycle."""
+    metrics = _current
+    if metrics is not None:
+        metrics.count(name, value)
+
+
+def gauge(name, value):
+    """Set count 'name' of the current cycle to 'value'."""
+    metrics = _current
+    if metrics is not None:
+        metrics.gauge(name, value)
+
+
+def export(metrics):
+    """Send 'metrics' to the configured exporters. Errors are logged, not raised."""
+    if _exporters['json']:
+        sys.stdout.write(CEE_COOKIE + json.dumps(metrics.record(), default=str) + '\n')
+        sys.stdout.flush()
+
+    if _exporters['textfile']:
+        try:
+            write_textfile(_exporters['textfile'], metrics)
+        except (IOError, OSError) as e:
+            log.warning("Can't write metrics to %s: %s", _exporters['textfile'], e)
+
+    if _exporters['statsd']:
+        try:
+            send_statsd(_exporters['statsd'], metrics)
+        except (IOError, OSError, ValueError) as e:
+            log.warning("Can't send metrics to StatsD at %s: %s", _exporters['statsd'], e)
+
+
+def _metric_name(name):
+    return ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def format_textfile(metrics):
+    """Return 'metrics' in the Prometheus text exposition format."""
+    tier = metrics.tier_name
+    lines = [
+        '# HELP {0}_cycle_duration_seconds Duration of the last cycle.'.format(METRIC_PREFIX),
+        '# TYPE {0}_cycle_duration_seconds gauge'.format(METRIC_PREFIX),
+        '{}_cycle_duration_seconds{{tier="{}",result="{}"}} {:.6f}'.format(
+            METRIC_PREFIX, tier, metrics.result, metrics.duration or 0.0),
+        '# HELP {0}_cycle_timestamp_seconds Start time of the last cycle.'.format(METRIC_PREFIX),
+        '# TYPE {0}_cycle_timestamp_seconds gauge'.format(METRIC_PREFIX),
+        '{}_cycle_timestamp_seconds{{tier="{}"}} {:.3f}'.format(METRIC_PREFIX, tier, metrics.started),
+        '# HELP {0}_span_duration_seconds Duration of each stage of the last cycle.'.format(METRIC_PREFIX),
+        '# TYPE {0}_span_duration_seconds gauge'.format(METRIC_PREFIX),
+    ]
+    for name, seconds in metrics.spans.items():
+        lines.append('{}_span_duration_seconds{{tier="{}",span="{}"}} {:.6f}'.format(METRIC_PREFIX, tier, name, seconds))
+    for name, value in metrics.counts.items():
+        lines.append('{}_{}{{tier="{}"}} {}'.format(METRIC_PREFIX, _metric_name(name), tier, float(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path, metrics):
+    """Write 'metrics' to the Prometheus textfile at 'path', atomically."""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(format_textfile(metrics))
+    os.replace(tmp_path, path)
+
+
+def format_statsd(metrics):
+    """Return 'metrics' as a list of StatsD lines."""
+    prefix = '{}.{}'.format(METRIC_PREFIX, _metric_name(metrics.tier_name))
+    lines = ['{}.cycle:{:.1f}|ms'.format(prefix, (metrics.duration or 0.0) * 1000)]
+    lines.append('{}.result.{}:1|c'.format(prefix, _metric_name(str(metrics.result))))
+    for name, seconds in metrics.spans.items():
+        lines.append('{}.span.{}:{:.1f}|ms'.format(prefix, _metric_name(name), seconds * 1000))
+    for name, value in metrics.counts.items():
+        lines.append('{}.{}:{:g}|g'.format(prefix, _metric_name(name), float(value)))
+    return lines
+
+
+def send_statsd(address, metrics):
+    """Send 'metrics' to the StatsD server at 'address' ("host:port") over UDP."""
+    host, _, port = address.rpartition(':')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for line in format_statsd(metrics):
+            sock.sendto(line.encode('utf-8'), (host or '127.0.0.1', int(port)))
+    finally:
+        sock.close()
+
+
+def profile_call(path, fn, *args, **kw):
+    """Call 'fn' with 'args' and 'kw' under cProfile and dump the stats to 'path'."""
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args, **kw)
+    finally:
+        profiler.dump_stats(path)
+        stats = pstats.Stats(profiler, stream=sys.stderr)
+        stats.sort_stats('cumulative').print_stats(20)
+        log.warning("Profile of cycle written to %s.", path)
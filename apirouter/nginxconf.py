@@ -9,15 +9,25 @@ See https://github.com/Homebrew/homebrew-nginx and https://homebrew-nginx.marcqu
 import os
 import os.path
 import sys
+import math
 import logging
 import subprocess
 import json
 import time
+import hashlib
+from collections import OrderedDict
 
 import click
 from jinja2 import Environment, PackageLoader
 from driftconfig.util import get_drift_config
 from apirouter.awstargets import get_ec2_targets_for_tier, get_api_endpoints_for_tier, get_name_server
+from apirouter.awstargets import get_router_count, get_public_url_for_tier, healthcheck_targets
+from apirouter.awstargets import reset_call_timings, run_concurrently
+from apirouter.fragments import FragmentRenderer, digest
+from apirouter import configtree, discoverycache, metrics, logstats, maphash, hosttuning
+from apirouter.upstreams import (
+    get_upstream_servers, get_balancing, format_server_params, upstream_api_url, UpstreamApi,
+)
 
 
 log = logging.getLogger(__name__)
@@ -29,8 +39,10 @@ if sys.platform.startswith("linux"):
         'etc': '/etc',
         'pid': '/run/nginx.pid',
         'log': '/var/log',
+        'cache': '/var/cache',
         'root': '/usr/share/nginx',
         'nginx_config': '/etc/nginx/nginx.conf',
+        'nginx_config_dir': '/etc/nginx/apirouter',
         'nameserver': get_name_server(),
     }
 elif sys.platform == 'darwin':
@@ -38,8 +50,10 @@ elif sys.platform == 'darwin':
         'etc': '/usr/local/etc',
         'pid': '/usr/local/var/run/nginx.pid',
         'log': '/usr/local/var/log',
+        'cache': '/usr/local/var/cache',
         'root': '/usr/local/share/nginx',
         'nginx_config': '/usr/local/etc/nginx/nginx.conf',
+        'nginx_config_dir': '/usr/local/etc/nginx/apirouter',
         'nameserver': get_name_server(),
     }
 else:
@@ -48,38 +62,162 @@ else:
 platform['os'] = sys.platform
 
 HEALTHCHECK_TIMEOUT = 1.0  # Timeout for target health check ping.
-
-
-def _prepare_info(tier_name, check_health=True):
-    conf = get_drift_config(tier_name=tier_name)
+DAEMON_INTERVAL = 10.0  # Seconds between full refresh cycles in daemon mode.
+DAEMON_JITTER = 2.0  # Max random seconds added to the daemon interval.
+APPLIED = (0, "skipped", "upstreams updated")  # Results of run_cycle() where the config is live.
+UPSTREAM_ZONE_SIZE = '64k'  # Shared memory zone size for each upstream group.
+
+# Upstream keepalive defaults. Can be set for the tier in the 'nginx' config as
+# 'upstream_keepalive', 'upstream_keepalive_requests' and 'upstream_keepalive_timeout',
+# and per route in the 'routing' config as 'keepalive', 'keepalive_requests' and
+# 'keepalive_timeout'. Set 'keepalive' to 0 to disable.
+UPSTREAM_KEEPALIVE = 32  # Idle connections kept open to the upstream, per worker.
+UPSTREAM_KEEPALIVE_REQUESTS = 1000  # Requests served over a connection before it's closed.
+UPSTREAM_KEEPALIVE_TIMEOUT = '60s'  # Must be shorter than the idle timeout of the targets.
+
+# Response cache defaults. A route enables caching with a list of policies in 'cache' in
+# the 'routing' config, each a dict with 'path', the prefix below the route to cache,
+# 'ttl', 'key', a list of CACHE_KEY_VARIABLES names, 'stale_while_revalidate' and
+# 'ignore_auth'. The cache zone is sized with 'cache_zone_size', 'cache_max_size' and
+# 'cache_inactive' in the 'routing' config, or for the tier in the 'nginx' config.
+CACHE_TTL = '10s'  # How long a 200 response is cached.
+CACHE_KEY = ['tenant']  # Cache key components added to the request method and uri.
+CACHE_ZONE_SIZE = '10m'  # Shared memory for cache keys. 1m holds about 8000 keys.
+CACHE_MAX_SIZE = '1g'  # Max size of the cache on disk.
+CACHE_INACTIVE = '10m'  # Cached responses not used for this long are removed.
+
+CACHE_KEY_VARIABLES = {
+    'tenant': '$tenant_name',
+    'product': '$product_name',
+    'api_key': '$drift_api_key',
+    'host': '$host',
+    'auth': '$http_authorization',
+}
+
+# Rate and connection limits are set in 'rate_limits' in the 'nginx' config, keyed by
+# product name or 'default', for each of RATE_LIMIT_SCOPES. Rates, bursts and connection
+# counts are for the whole tier and are divided between the api-routers in it.
+RATE_LIMIT_SCOPES = OrderedDict([
+    ('tenant', '$tenant_name'),
+    ('product', '$product_name'),
+    ('api_key', '$limit_api_key'),  # The api key, or empty if there is none.
+])
+RATE_LIMIT_ZONE_SIZE = '10m'  # Shared memory for each zone. 1m holds about 16000 keys.
+
+CUSTOM_API_KEY = '_custom_api_key'  # What custom api keys map to. They are good for any product.
+
+VARIABLE_VALUE_SIZE = 16  # sizeof(ngx_http_variable_value_t), for estimating map memory.
+
+# Drift config tables the config is generated from. True if the table is filtered by tier.
+CONFIG_TABLES = OrderedDict([
+    ('tenant-names', False),
+    ('tenants', True),
+    ('products', False),
+    ('deployables', True),
+    ('routing', False),
+    ('api-keys', False),  # Keys are not tier specific.
+    ('nginx', True),
+])
+
+
+def discover_tier(tier_name, check_health=True, conf=None):
+    """
+    Discover EC2 targets and API Gateway endpoints for tier 'tier_name'.
+    Returns a dict with 'ec2_targets' and 'api_endpoints', and 'router_count' if rate limits
+    are configured for the tier.
+
+    The EC2 targets, API Gateway endpoints, router count and the public API Gateway url are
+    independent of each other and are discovered concurrently, so discovery takes about as
+    long as the slowest of them. The targets and endpoints are then health checked in one
+    batch of probes, under one deadline.
+    """
+    if conf is None:
+        conf = get_drift_config(tier_name=tier_name)
+
+    def discover(name, fn):
+        def call():
+            with metrics.span('discover.' + name):
+                return fn(tier_name=tier_name, conf=conf)
+        return call
+
+    calls = OrderedDict([
+        ('ec2', get_ec2_targets_for_tier),
+        ('apigw', get_api_endpoints_for_tier),
+    ])
+    nginx = conf.table_store.get_table('nginx').get({'tier_name': tier_name})
+    if nginx and nginx.get('rate_limits'):
+        calls['routers'] = get_router_count
+    if check_health:
+        calls['public_url'] = get_public_url_for_tier
+
+    reset_call_timings()
+    results = dict(zip(calls, run_concurrently(*[discover(name, fn) for name, fn in calls.items()])))
+    ec2_targets, api_endpoints = results['ec2'], results['apigw']
+    if check_health:
+        healthcheck_targets(
+            ec2_targets, list(api_endpoints.values()), nginx=nginx, public_url=results['public_url'])
+    discovery = {
+        'ec2_targets': ec2_targets,
+        'api_endpoints': api_endpoints,
+    }
+    if 'routers' in results:
+        discovery['router_count'] = results['routers']
+        metrics.gauge('router_count', discovery['router_count'])
+    metrics.gauge('ec2_targets', sum(len(targets) for targets in ec2_targets.values()))
+    metrics.gauge('api_endpoints', len(api_endpoints))
+
+    timings = reset_call_timings()
+    if timings:
+        log.info("AWS calls: %s", ", ".join(
+            "{} {}x {:.2f}s".format(name, timing['count'], timing['seconds'])
+            for name, timing in sorted(timings.items(), key=lambda item: -item[1]['seconds'])
+        ))
+    for name, timing in timings.items():
+        metrics.count('aws_calls', timing['count'])
+        metrics.gauge('aws.' + name, round(timing['seconds'] * 1000, 1))
+
+    return discovery
+
+
+def _prepare_info(tier_name, check_health=True, conf=None, discovery=None):
+    if conf is None:
+        conf = get_drift_config(tier_name=tier_name)
     ts = conf.table_store
 
+    # The tables are scanned once each and indexed by key, so the cost is linear in the
+    # size of the config.
+    products = {product['product_name']: product for product in ts.get_table('products').find()}
+    tenant_names = {}  # Tenant name -> product name
+    product_tenants = {}  # Product name -> list of tenant names
+    for tenant_master in ts.get_table('tenant-names').find():
+        tenant_names[tenant_master['tenant_name']] = tenant_master['product_name']
+        product_tenants.setdefault(tenant_master['product_name'], []).append(tenant_master['tenant_name'])
+
     # Map tenant to product, and include only active tenants on active products
     # for this tier.
     tenant_map = {}
-    tenant_names = ts.get_table('tenant-names')
-    tenants = ts.get_table('tenants').find({'tier_name': tier_name, 'state': 'active'})
-    for tenant in tenants:
-        tenant_master = tenant_names.get({'tenant_name': tenant['tenant_name']})
-        product = tenant_names.get_foreign_row(tenant_master, 'products')
-        if product['state'] == 'active':
+    for tenant in ts.get_table('tenants').find({'tier_name': tier_name, 'state': 'active'}):
+        product = products.get(tenant_names.get(tenant['tenant_name']))
+        if product is None:
+            log.warning("Tenant %s has no product.", tenant['tenant_name'])
+        elif product['state'] == 'active':
             tenant_map[tenant['tenant_name']] = product
 
     # Make a product map that includes all its tenants, for convenience
     product_map = {}
-    for product in ts.get_table('products').find():
-        product_name = product['product_name']
-        tenants = ts.get_table('tenant-names').find({'product_name': product_name})
-        if tenants:
-            product_map[product_name] = product
-            product['tenants'] = [tenant['tenant_name'] for tenant in tenants]
+    for product_name, product in products.items():
+        if product_name in product_tenants:
+            # A copy, as the config rows must not change between cycles.
+            product_map[product_name] = dict(product, tenants=product_tenants[product_name])
 
     deployables = ts.get_table('deployables').find({'tier_name': tier_name})
     deployables = {d['deployable_name']: d for d in deployables}  # Turn into a dict
 
     # Prepare routes for EC2 targets and API gateway endpoints.
-    ec2_targets = get_ec2_targets_for_tier(tier_name=tier_name, check_health=check_health)
-    api_endpoints = get_api_endpoints_for_tier(tier_name=tier_name, check_health=check_health)
+    if discovery is None:
+        discovery = discover_tier(tier_name=tier_name, check_health=check_health, conf=conf)
+    ec2_targets = discovery['ec2_targets']
+    api_endpoints = discovery['api_endpoints']
 
     # Make sure the same deployable is not deployed both as an EC2 and an api gateway.
     common = set(ec2_targets) & set(api_endpoints)
@@ -93,8 +231,7 @@ def _prepare_info(tier_name, check_health=True):
     routes = {}
     for route in ts.get_table('routing').find():
         deployable_name = route['deployable_name']
-        deployable = ts.get_table('deployables').get(
-            {'tier_name': tier_name, 'deployable_name': deployable_name})
+        deployable = deployables.get(deployable_name)
         if deployable is not None:
             routes[deployable_name] = route.copy()
             routes[deployable_name]['api'] = route.get('api', deployable_name)
@@ -159,10 +296,20 @@ def _prepare_info(tier_name, check_health=True):
         ]
     },
     '''
-    api_keys = {}
-    for api_key in ts.get_table('api-keys').find({'tier_name': tier_name}):
-        if api_key['in_use'] and api_key['key_type'] == 'custom':
-            api_keys[api_key['api_key_name']] = ''
+    # Only keys that can be accepted on this tier go into the api key map: product keys for
+    # products with active tenants on the tier, and custom keys. Keys for other products
+    # would be rejected anyway. The keys are grouped by what they map to, custom keys last.
+    tier_products = set(product['product_name'] for product in tenant_map.values())
+    key_groups = {}  # Product name or CUSTOM_API_KEY -> set of key names
+    for api_key in ts.get_table('api-keys').find():
+        if api_key.get('in_use'):
+            product_name = api_key.get('product_name', CUSTOM_API_KEY)
+            if product_name in tier_products or product_name == CUSTOM_API_KEY:
+                key_groups.setdefault(product_name, set()).add(api_key['api_key_name'])
+    api_keys = OrderedDict(
+        (product_name, sorted(key_groups[product_name]))
+        for product_name in sorted(key_groups, key=lambda name: (name == CUSTOM_API_KEY, name))
+    )
 
     # This should come from the "new" nginx config table:
     nginx = ts.get_table('nginx').get({'tier_name': tier_name})
@@ -172,8 +319,19 @@ def _prepare_info(tier_name, check_health=True):
         'tenants': tenant_map,
         'products': product_map,
         'routes': routes,
+        'api_keys': api_keys,
         'nginx': nginx,
         'plat': platform,
+        'router_count': discovery.get('router_count', 1),
+        'tuning': hosttuning.get_tuning(hosttuning.get_host_info(), nginx),
+    }
+    ret['map_hash'] = _get_map_hash(ret)
+
+    # Response cache settings of routes with targets, used by both the status and the config.
+    ret['caches'] = {
+        name: _get_cache(name, route, nginx)
+        for name, route in routes.items()
+        if route['ec2_targets'] and route.get('cache')
     }
 
     return ret
@@ -189,18 +347,25 @@ def _generate_status(data):
             'api': route['api'],
             'requires_api_key': route['requires_api_key'],
             'is_active': route['deployable']['is_active'],
-            'upstream_servers':
-                [
-                    {
-                        'address': "{}:{}".format(target['private_ip_address'], target['tags']['api-port']),
-                        'status': target['tags']['api-status'],
-                        'health': target.get('health_status'),
-                        'version': target['tags'].get('drift:manifest:version'),
-                        ##'tags': target['tags'],
-                    }
-                ]
-                for target in route['ec2_targets']
+            'balancing': get_balancing(route, data['nginx']) or 'round_robin',
+            'upstream_servers': [
+                {
+                    'address': server['address'],
+                    'status': target['tags']['api-status'],
+                    'health': target.get('health_status'),
+                    'state': server['state'],
+                    'weight': server['params'].get('weight', '1'),
+                    'version': target['tags'].get('drift:manifest:version'),
+                    ##'tags': target['tags'],
+                }
+                for target, server in zip(route['ec2_targets'], get_upstream_servers(route, data['nginx']))
+            ],
         }
+        cache = data['caches'].get(name)
+        if cache:
+            service['cached_locations'] = [
+                '/' + '/'.join(filter(None, [route['api'], policy['path']])) for policy in cache['policies']
+            ]
         if not service['is_active'] and 'reason_inactive' in route['deployable']:
             service['reason_inactive'] = route['deployable']['reason_inactive']
 
@@ -217,6 +382,16 @@ def _generate_status(data):
 
     status = {
         'deployables': deployables,
+        'rate_limits': {
+            'router_count': data['router_count'],
+            'zones': _get_rate_limit_zones(data),
+        },
+        'tuning': data['tuning'],
+        'map_hash': {
+            'max_size': data['map_hash']['max_size'],
+            'bucket_size': data['map_hash']['bucket_size'],
+        },
+        'maps': _get_map_stats(data),
         'products': [
             {
                 'product_name': product['product_name'],
@@ -232,12 +407,299 @@ def _generate_status(data):
     return json.dumps(status, indent=4, default=str)
 
 
-def generate_nginx_config(tier_name, check_health=True):
-    data = _prepare_info(tier_name=tier_name, check_health=check_health)
-    env = Environment(loader=PackageLoader('apirouter', ''))
-    env.filters['jsonify'] = lambda ob: json.dumps(ob, indent=4)
+# Templates are compiled once, and rendered fragments cached, for subsequent runs in
+# daemon mode.
+_env = None
+_renderer = None
+
+
+def _get_template(name):
+    global _env
+    if _env is None:
+        _env = Environment(loader=PackageLoader('apirouter', ''))
+        _env.filters['jsonify'] = lambda ob: json.dumps(ob, indent=4)
+        _env.filters['server_params'] = format_server_params
+    return _env.get_template(name)
+
+
+def _get_renderer():
+    global _renderer
+    if _renderer is None:
+        _renderer = FragmentRenderer(_get_template('nginx.fragments.jinja'))
+    return _renderer
+
+
+def _is_proxy_route(route):
+    # Routes to websocket deployables use 'proxy_pass', others 'uwsgi_pass'.
+    return 'websocket' in route['deployable_name']
+
+
+def _get_keepalive(route, nginx):
+    """
+    Return upstream keepalive settings for 'route' as a dict with 'connections', 'requests'
+    and 'timeout', or None if keepalive is not used.
+
+    Only 'proxy_pass' routes use keepalive. Nginx doesn't keep uwsgi connections open.
+    """
+    if not _is_proxy_route(route):
+        return None
+
+    nginx = nginx or {}
+    connections = route.get('keepalive', nginx.get('upstream_keepalive', UPSTREAM_KEEPALIVE))
+    if not connections:
+        return None
+
+    return {
+        'connections': int(connections),
+        'requests': route.get(
+            'keepalive_requests', nginx.get('upstream_keepalive_requests', UPSTREAM_KEEPALIVE_REQUESTS)),
+        'timeout': route.get(
+            'keepalive_timeout', nginx.get('upstream_keepalive_timeout', UPSTREAM_KEEPALIVE_TIMEOUT)),
+    }
+
+
+def _get_cache(name, route, nginx):
+    """
+    Return the response cache settings for 'route' as a dict with the cache 'kind' ('proxy'
+    or 'uwsgi'), 'zone', its sizes and a list of 'policies', or None if nothing is cached.
+
+    Responses to requests with an Authorization header are not cached unless the policy
+    has 'auth' in its key or sets 'ignore_auth'.
+    """
+    if not route.get('cache'):
+        return None
+
+    nginx = nginx or {}
+    policies = []
+    for policy in route['cache']:
+        key = policy.get('key', CACHE_KEY)
+        unknown = set(key) - set(CACHE_KEY_VARIABLES)
+        if unknown:
+            log.warning("Unknown cache key component(s) %s for %s. Ignoring them.", ', '.join(unknown), name)
+        variables = ['$request_method', '$request_uri']
+        variables += [CACHE_KEY_VARIABLES[component] for component in key if component in CACHE_KEY_VARIABLES]
+        policies.append({
+            'path': policy.get('path', '').strip('/'),
+            'ttl': policy.get('ttl', CACHE_TTL),
+            'key': ':'.join(variables),
+            'stale': bool(policy.get('stale_while_revalidate')),
+            'bypass': None if 'auth' in key or policy.get('ignore_auth') else '$http_authorization',
+        })
+
+    def setting(key, default):
+        return route.get(key, nginx.get(key, default))
+
+    return {
+        'kind': 'proxy' if _is_proxy_route(route) else 'uwsgi',
+        'zone': name + '-cache',
+        'zone_size': setting('cache_zone_size', CACHE_ZONE_SIZE),
+        'max_size': setting('cache_max_size', CACHE_MAX_SIZE),
+        'inactive': setting('cache_inactive', CACHE_INACTIVE),
+        'policies': policies,
+    }
+
+
+def _per_router_rate(rate, router_count):
+    # Nginx rates are whole requests per second or per minute.
+    per_second = float(rate) / router_count
+    if per_second >= 1:
+        return '{}r/s'.format(int(math.ceil(per_second)))
+    return '{}r/m'.format(int(math.ceil(per_second * 60)))
+
+
+def _get_rate_limit_zones(data):
+    """
+    Return a list of rate and connection limit zones for the products in the tier. Products
+    with the same limits in a scope share a zone. Each zone is a dict with 'name', the
+    'variable' it's keyed on, the 'products' it applies to, and 'rate', 'burst' and
+    'connections' for this api-router, or None if not limited.
+
+    The 'rate_limits' config looks like this, with rates in requests per second:
+
+        {
+            "default": {"tenant": {"rate": 500, "burst": 1000, "connections": 200}},
+            "dg-superkaiju": {"api_key": {"rate": 100, "zone_size": "20m"}, "tenant": null}
+        }
+
+    Product limits override the default limits per scope.
+    """
+    rate_limits = (data['nginx'] or {}).get('rate_limits')
+    if not rate_limits:
+        return []
+
+    router_count = data['router_count']
+    products = sorted(set(product['product_name'] for product in data['tenants'].values()))
+    zones = []
+    for scope, variable in RATE_LIMIT_SCOPES.items():
+        groups = OrderedDict()  # Limits -> product names
+        for product_name in products:
+            limits = dict(rate_limits.get('default') or {})
+            limits.update(rate_limits.get(product_name) or {})
+            if limits.get(scope):
+                groups.setdefault(json.dumps(limits[scope], sort_keys=True), []).append(product_name)
+
+        for i, (limits, product_names) in enumerate(groups.items()):
+            limits = json.loads(limits)
+            rate = limits.get('rate')
+            burst = limits.get('burst', rate)
+            connections = limits.get('connections')
+            zones.append({
+                'name': '{}_{}'.format(scope, i),
+                'variable': variable,
+                'products': product_names,
+                'zone_size': limits.get('zone_size', RATE_LIMIT_ZONE_SIZE),
+                'rate': _per_router_rate(rate, router_count) if rate else None,
+                'burst': int(math.ceil(float(burst) / router_count)) if rate else None,
+                'connections': int(math.ceil(float(connections) / router_count)) if connections else None,
+            })
+
+    return zones
+
+
+def _get_map_keys(data):
+    """
+    Return the keys and values of each map in the config that has exact keys, as a dict of
+    the variable the map sets -> tuple of keys and values. Regex keys are not hashed, and
+    not included.
+    """
+    # The tenant map is a 'hostnames' map of "<tenant>.*" keys, which Nginx hashes by the
+    # first label.
+    tenants = {tenant_name: product['product_name'] for tenant_name, product in data['tenants'].items()}
+    products = sorted(set(tenants.values()))
+    key_names = [key_name for key_names in data['api_keys'].values() for key_name in key_names]
+    keyless = ['api-router', 'healthcheck'] + [
+        route['api'] for route in data['routes'].values()
+        if not route['requires_api_key'] and '/' not in route['api']
+    ]
+    key_checks = ['_unknown_tenant_name:' + CUSTOM_API_KEY] + [
+        '{}:{}'.format(product_name, value) for product_name in products for value in (product_name, CUSTOM_API_KEY)
+    ]
+    maps = OrderedDict([
+        ('product_name', ([tenant_name.split('.')[0] for tenant_name in tenants], list(tenants.values()))),
+        ('api_key_to_product', (key_names, list(data['api_keys']))),
+        ('endpoint_requires_api_key', (keyless, ['false'])),
+        ('bad_key', (key_checks, ['false'])),
+        ('reason', (['_api key not found'], ['API key not found.'])),
+    ])
+    zones = _get_rate_limit_zones(data)
+    if zones:
+        maps['limit_api_key'] = (['nokey'], [''])
+    for zone in zones:
+        maps['limit_' + zone['name']] = (zone['products'], [zone['variable']])
+    return maps
+
+
+# The map hash settings are only computed again when the map keys change.
+_map_hash_cache = {}
+
+
+def _get_map_hash(data):
+    """
+    Return 'map_hash_max_size' and 'map_hash_bucket_size' for the maps in the config, in a
+    dict with 'max_size' and 'bucket_size', and the hash of each map in 'maps'. The settings
+    are computed from the map keys, unless set in the 'nginx' config. See apirouter.maphash.
+    """
+    nginx = data['nginx'] or {}
+    maps = OrderedDict((name, keys) for name, (keys, _) in _get_map_keys(data).items())
+    max_size = nginx.get('map_hash_max_size')
+    bucket_size = nginx.get('map_hash_bucket_size')
+    key = digest([maps, max_size, bucket_size])
+    if key not in _map_hash_cache:
+        _map_hash_cache.clear()
+        _map_hash_cache[key] = maphash.get_map_hash_settings(maps, max_size, bucket_size)
+    return _map_hash_cache[key]
+
+
+def _get_map_stats(data):
+    """
+    Return the number of 'entries', the 'hash_size' and the 'estimated_bytes' of memory of
+    each map in the config that has exact keys, keyed by the variable the map sets.
+    """
+    stats = OrderedDict()
+    for name, (keys, values) in _get_map_keys(data).items():
+        hashed = data['map_hash']['maps'][name]
+        # Each distinct value is stored once.
+        value_bytes = sum(VARIABLE_VALUE_SIZE + len(value) for value in set(values))
+        stats[name] = OrderedDict([
+            ('entries', hashed['entries']),
+            ('hash_size', hashed['hash_size']),
+            ('estimated_bytes', (hashed['hash_bytes'] or 0) + value_bytes),
+        ])
+        if hashed['problem']:
+            stats[name]['problem'] = hashed['problem']
+    return stats
+
+
+def _get_fragments(data):
+    """
+    Return a list of config fragments to render from 'data'. Each fragment is a tuple of
+    fragment name, macro name and the macro arguments. The arguments are kept to a minimum
+    as a fragment is re-rendered whenever they change.
+    """
+    tenants = {tenant_name: product['product_name'] for tenant_name, product in data['tenants'].items()}
+    keyless = {
+        name: {'api': route['api'], 'requires_api_key': route['requires_api_key']}
+        for name, route in data['routes'].items()
+    }
+    # With pass-through keys the api key map is the first link of a chain of maps, see
+    # nginx.conf.jinja.
+    passthrough = (data['nginx'] or {}).get('api_key_passthrough')
+    api_key_variable = 'config_api_key_to_product' if passthrough else 'api_key_to_product'
+    fragments = [
+        ('maps/tenants', 'tenant_map', {'tenants': tenants}),
+        ('maps/apikeys', 'api_key_map', {'api_keys': data['api_keys'], 'variable': api_key_variable}),
+        ('maps/keyless', 'keyless_map', {'routes': keyless}),
+        ('maps/keycheck', 'key_check_map', {'products': sorted(set(tenants.values()))}),
+    ]
+    zones = _get_rate_limit_zones(data)
+    fragments.append(('ratelimits/zones', 'rate_limit_zones', {'zones': zones}))
+    fragments.append(('ratelimits/server', 'rate_limits', {'zones': zones}))
+
+    for name, route in data['routes'].items():
+        # Locations only care whether there are any targets, not which ones.
+        location_route = dict(route, ec2_targets=bool(route['ec2_targets']))
+        keepalive = _get_keepalive(route, data['nginx'])
+        cache = data['caches'].get(name)
+        fragments.append(('locations/' + name, 'locations', {
+            'name': name,
+            'route': location_route,
+            'plat': data['plat'],
+            'keepalive': keepalive,
+            'cache': cache,
+        }))
+        if cache:
+            fragments.append(('caches/' + name, 'cache_zone', {
+                'name': name,
+                'cache': cache,
+                'plat': data['plat'],
+            }))
+        if route['ec2_targets']:
+            fragments.append(('upstreams/' + name, 'upstream', {
+                'name': name,
+                'servers': get_upstream_servers(route, data['nginx']),
+                'zone_size': (data['nginx'] or {}).get('upstream_zone_size', UPSTREAM_ZONE_SIZE),
+                'balancing': get_balancing(route, data['nginx']),
+                'keepalive': keepalive,
+            }))
+
+    return fragments
+
+
+def generate_nginx_config(tier_name, check_health=True, conf=None, discovery=None):
+    """
+    Generate Nginx config for tier 'tier_name'. If 'discovery' is set, it is used instead
+    of discovering targets. See discover_tier() for its format.
+
+    Only the config fragments whose inputs changed since the last call are re-rendered.
+    'changes' in the return value lists the fragments that were added, changed or removed.
+    """
+    data = _prepare_info(tier_name=tier_name, check_health=check_health, conf=conf, discovery=discovery)
+    renderer = _get_renderer()
+    fragments = renderer.render(_get_fragments(data))
     ret = {
-        'config': env.get_template('nginx.conf.jinja').render(**data),
+        'config': _get_template('nginx.conf.jinja').render(fragment=fragments.get, **data),
+        'fragments': fragments,
+        'changes': renderer.changes,
         'data': data,
         'status': _generate_status(data),
     }
@@ -254,20 +716,191 @@ def write_status_doc(status):
         f.write(status)
 
 
+def update_log_stats():
+    """
+    Add traffic stats from the access log to the status doc: the cache hit ratio of each
+    cached location, and rolling latency, error rate and throughput per route, tenant, api
+    key and upstream server. Done every cycle, as the status doc is only written when the
+    config changes.
+    """
+    filename = os.path.join(platform['root'], 'api-router', 'status.json')
+    try:
+        with open(filename) as f:
+            status = json.load(f)
+    except (IOError, OSError, ValueError):
+        return
+
+    access_log = os.path.join(platform['log'], 'nginx', 'access.log')
+    prefixes = [prefix for service in status['deployables'] for prefix in service.get('cached_locations', [])]
+    if prefixes:
+        status['cache'] = logstats.cache_stats(access_log, prefixes)
+    status['traffic'] = logstats.update_traffic_stats(access_log)
+    write_status_doc(json.dumps(status, indent=4, default=str))
+
+
 def apply_nginx_config(nginx_config, skip_if_same=True):
-    """Apply the Nginx config on the local machine and trigger a reload."""
-    if os.path.exists(platform['nginx_config']):
-        with open(platform['nginx_config'], 'r') as f:
-            if nginx_config['config'] == f.read() and skip_if_same:
-                return "skipped"
-
-    with open(platform['nginx_config'], 'w') as f:
-        f.write(nginx_config['config'])
-    ret = subprocess.call(['sudo', 'nginx', '-t'])
+    """
+    Apply the Nginx config on the local machine and trigger a reload.
+
+    The config is written as a new release of include files which is validated with
+    'nginx -t' before it's swapped in. See apirouter.configtree for details.
+    """
+    root = platform['nginx_config_dir']
+    release_id = hashlib.sha1(nginx_config['config'].encode('utf-8')).hexdigest()[:12]
+    previous_release = configtree.current_release(root)
+    if skip_if_same and previous_release == release_id:
+        return "skipped"
+
+    # The main config file includes the fragments from the release directory.
+    target_dir = configtree.release_dir(root, release_id)
+    files = OrderedDict(
+        (name + '.conf', text) for name, text in nginx_config['fragments'].items()
+    )
+    files['nginx.conf'] = _get_template('nginx.conf.jinja').render(
+        fragment=lambda name: '    include {};'.format(os.path.join(target_dir, name + '.conf')),
+        **nginx_config['data']
+    )
+    with metrics.span('write_release'):
+        target_dir, changed = configtree.write_release(root, release_id, files)
+    log.info("Config release %s written. Changed files: %s", release_id, ', '.join(changed))
+    metrics.gauge('files_changed', len(changed))
+
+    with metrics.span('nginx_test'):
+        ret = subprocess.call(['sudo', 'nginx', '-t', '-c', os.path.join(target_dir, 'nginx.conf')])
     if ret != 0:
+        configtree.discard_release(root, release_id)
         return ret
-    ret = subprocess.call(['sudo', 'nginx', '-s', 'reload'])
-    time.sleep(1)
+
+    configtree.activate_release(root, release_id, platform['nginx_config'])
+    configtree.prune_releases(root)
+
+    if changed:
+        with metrics.span('upstream_api'):
+            previous_dir = previous_release and configtree.release_dir(root, previous_release)
+            updated = _update_upstreams(nginx_config, changed, previous_dir, target_dir)
+        if updated:
+            metrics.gauge('reload', 0)
+            return "upstreams updated"
+
+    with metrics.span('reload'):
+        ret = subprocess.call(['sudo', 'nginx', '-s', 'reload'])
+        time.sleep(1)
+    metrics.gauge('reload', 1)
+    return ret
+
+
+def _upstream_settings(filename):
+    """Return the lines of upstream file 'filename' other than its servers, or None."""
+    try:
+        with open(filename) as f:
+            return [line.strip() for line in f if not line.strip().startswith('server ')]
+    except (IOError, OSError):
+        return None
+
+
+def _update_upstreams(nginx_config, changed, previous_dir, target_dir):
+    """
+    Push upstream changes to the Nginx upstream API if only the servers of existing
+    upstreams changed in the config. Returns True if successful, in which case a reload is
+    not needed.
+    """
+    url = upstream_api_url(nginx_config['data']['nginx'])
+    if not url or not previous_dir:
+        return False
+    for path in changed:
+        if not path.startswith('upstreams/'):
+            return False
+        # New upstream groups and changes to directives like the balancing method need a reload.
+        settings = _upstream_settings(os.path.join(target_dir, path))
+        if settings is None or settings != _upstream_settings(os.path.join(previous_dir, path)):
+            return False
+
+    api = UpstreamApi(url)
+    routes = nginx_config['data']['routes']
+    try:
+        for path in changed:
+            name = path[len('upstreams/'):-len('.conf')]
+            api.sync(name + '-servers', get_upstream_servers(routes[name], nginx_config['data']['nginx']))
+    except Exception:
+        log.exception("Failed to update upstreams through %s. Falling back to reload.", url)
+        return False
+
+    return True
+
+
+def fingerprint_inputs(tier_name, conf, discovery):
+    """
+    Return a stable hash of everything the config for tier 'tier_name' is generated from:
+    the Drift config tables, the discovered targets and their health, the platform, the
+    host the worker settings are derived from and the templates.
+    """
+    ts = conf.table_store
+    tables = OrderedDict()
+    for table_name, by_tier in CONFIG_TABLES.items():
+        search = {'tier_name': tier_name} if by_tier else None
+        tables[table_name] = ts.get_table(table_name).find(search)
+
+    env = _get_template('nginx.conf.jinja').environment
+    templates = [
+        env.loader.get_source(env, name)[0]
+        for name in ('nginx.conf.jinja', 'nginx.fragments.jinja')
+    ]
+
+    return digest({
+        'tier': conf.tier,
+        'domain': conf.domain.get(),
+        'tables': tables,
+        'discovery': discovery,
+        'platform': platform,
+        'host': hosttuning.get_host_info(),
+        'templates': templates,
+    })
+
+
+def run_cycle(tier_name, check_health=True, conf=None, discovery=None, skip_if_same=True, snapshots=None):
+    """
+    Run one discovery -> render -> apply cycle for tier 'tier_name'. If 'discovery' is set
+    it is used instead of discovering targets. If 'snapshots' is set the discovery is shared
+    with the other routers of the tier, see snapshot.Snapshots.get_discovery().
+
+    If the inputs are the same as for the last successfully applied config, rendering and
+    applying is skipped and "skipped" is returned. Else returns the result of
+    apply_nginx_config().
+    """
+    if conf is None:
+        with metrics.span('config_load'):
+            conf = get_drift_config(tier_name=tier_name)
+    if discovery is None:
+        def discover():
+            return discover_tier(tier_name=tier_name, check_health=check_health, conf=conf)
+        with metrics.span('discover'):
+            discovery = discover() if snapshots is None else snapshots.get_discovery(discover)
+
+    root = platform['nginx_config_dir']
+    with metrics.span('fingerprint'):
+        fingerprint = fingerprint_inputs(tier_name, conf, discovery)
+    if skip_if_same and configtree.read_fingerprint(root) == fingerprint:
+        log.info("Inputs unchanged. Fingerprint %s.", fingerprint[:12])
+        with metrics.span('log_stats'):
+            update_log_stats()
+        return "skipped"
+
+    with metrics.span('render'):
+        nginx_config = generate_nginx_config(
+            tier_name=tier_name, check_health=check_health, conf=conf, discovery=discovery)
+    metrics.gauge('bytes_rendered', sum(len(text) for text in nginx_config['fragments'].values()))
+    metrics.gauge('fragments_changed', len(nginx_config['changes']))
+
+    if 'status' in nginx_config:
+        with metrics.span('status'):
+            write_status_doc(nginx_config['status'])
+        with metrics.span('log_stats'):
+            update_log_stats()
+
+    with metrics.span('apply'):
+        ret = apply_nginx_config(nginx_config, skip_if_same=skip_if_same)
+    if ret in APPLIED:
+        configtree.write_fingerprint(root, fingerprint)
     return ret
 
 
@@ -275,25 +908,65 @@ def apply_nginx_config(nginx_config, skip_if_same=True):
 @click.option('--preview', '-p', is_flag=True, help='Preview only.')
 @click.option('--log-level', '-l', default='WARNING', help='Logging level.')
 @click.option('--skip-healthcheck', '-s', is_flag=True, help='Skip health check.')
-def cli(preview, log_level, skip_healthcheck):
+@click.option('--daemon', '-d', is_flag=True, help='Keep running and refresh the config periodically.')
+@click.option('--interval', '-i', default=DAEMON_INTERVAL, help='Seconds between refreshes in daemon mode.')
+@click.option('--jitter', '-j', default=DAEMON_JITTER, help='Max random seconds added to the interval.')
+@click.option('--events', '-e', help='Lifecycle event feed for daemon mode. An SQS queue url or a file path.')
+@click.option('--flush-cache', '-f', is_flag=True, help='Flush the discovery cache before running.')
+@click.option('--snapshot-store', help='Share discovery through a leader. An S3 url "s3://bucket/prefix" or a directory.')
+@click.option('--metrics-textfile', type=click.Path(), help='Write cycle metrics to this Prometheus textfile.')
+@click.option('--statsd', help='Send cycle metrics to this StatsD "host:port".')
+@click.option('--profile', type=click.Path(), help='Profile one cycle and write the cProfile stats to this file.')
+def cli(preview, log_level, skip_healthcheck, daemon, interval, jitter, events, flush_cache,
+        snapshot_store, metrics_textfile, statsd, profile):
     logging.basicConfig(level=log_level)
     print("Configure Drift API Router.")
-    nginx_config = generate_nginx_config(
-        tier_name=os.environ['DRIFT_TIER'],
-        check_health=not skip_healthcheck,
-    )
+    tier_name = os.environ['DRIFT_TIER']
+    metrics.configure(textfile=metrics_textfile, statsd=statsd)
+
+    if flush_cache:
+        discoverycache.invalidate()
+
+    snapshots = None
+    if snapshot_store:
+        from apirouter.snapshot import Snapshots, create_store, get_owner, LEASE_TTL
+        # The lease must outlive the time between cycles, or leadership keeps changing hands.
+        lease_ttl = LEASE_TTL if not daemon else max(LEASE_TTL, 3 * (interval + jitter))
+        snapshots = Snapshots(create_store(snapshot_store), tier_name, owner=get_owner(daemon), lease_ttl=lease_ttl)
+
+    if daemon:
+        from apirouter.daemon import Daemon
+        from apirouter.lifecycle import create_event_source
+        Daemon(
+            tier_name=tier_name,
+            interval=interval,
+            jitter=jitter,
+            check_health=not skip_healthcheck,
+            event_source=create_event_source(events) if events else None,
+            profile=profile,
+            snapshots=snapshots,
+        ).run()
+        return
 
     if preview:
+        nginx_config = generate_nginx_config(
+            tier_name=tier_name,
+            check_health=not skip_healthcheck,
+        )
         print("Nginx configuration file:")
         print(nginx_config['config'])
         print("Status file:")
         print(nginx_config['status'])
         return
 
-    if 'status' in nginx_config:
-        write_status_doc(nginx_config['status'])
+    with metrics.cycle(tier_name) as cycle_metrics:
+        if profile:
+            ret = metrics.profile_call(
+                profile, run_cycle, tier_name=tier_name, check_health=not skip_healthcheck, snapshots=snapshots)
+        else:
+            ret = run_cycle(tier_name=tier_name, check_health=not skip_healthcheck, snapshots=snapshots)
+        cycle_metrics.result = ret
 
-    ret = apply_nginx_config(nginx_config)
     if ret == "skipped":
         print("No change detected.")
     else:
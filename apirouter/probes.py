@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent Probe Engine
+
+Runs health probes in parallel on a bounded thread pool. All probes share a global
+deadline, and the number of probes running against the same host at the same time
+is capped.
+"""
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+log = logging.getLogger(__name__)
+
+
+PROBE_DEADLINE = 10.0  # Global deadline in seconds for a batch of probes.
+MAX_WORKERS = 32  # Size of the thread pool.
+MAX_PER_HOST = 2  # Max number of concurrent probes against a single host.
+
+
+def run_probes(probes, deadline=None, max_workers=None, max_per_host=None):
+    """
+    Run 'probes' concurrently and return a dict of probe key -> (status, message).
+
+    'probes' is a list of (key, host, fn) tuples where 'fn' is a callable that takes no
+    arguments and returns a (status, message) tuple. At most 'max_per_host' probes run
+    against the same 'host' at a time. Probes that have not finished when 'deadline'
+    seconds have passed are reported as ('error', 'Timeout').
+    """
+    deadline = deadline or PROBE_DEADLINE
+    max_workers = max_workers or MAX_WORKERS
+    max_per_host = max_per_host or MAX_PER_HOST
+
+    if not probes:
+        return {}
+
+    host_locks = {}
+    for key, host, fn in probes:
+        if host not in host_locks:
+            host_locks[host] = threading.BoundedSemaphore(max_per_host)
+
+    def run(host, fn):
+        with host_locks[host]:
+            try:
+                return fn()
+            except Exception as e:
+                log.exception("Probe on %s failed.", host)
+                return 'error', str(e)
+
+    t = time.time()
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(probes)))
+    try:
+        futures = {executor.submit(run, host, fn): key for key, host, fn in probes}
+        done, not_done = wait(futures, timeout=deadline)
+    finally:
+        # Don't wait for stragglers. They are reported as timed out.
+        executor.shutdown(wait=False)
+
+    results = {futures[future]: future.result() for future in done}
+    for future in not_done:
+        future.cancel()
+        results[futures[future]] = ('error', 'Timeout')
+
+    log.info(
+        "Ran %s probes in %.2f seconds, %s timed out.",
+        len(probes), time.time() - t, len(not_done)
+    )
+    return results
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+"""
+Discovery Snapshots
+
+Lets the api-routers of a tier share one discovery. The router holding a lease in a shared
+store is the leader. It discovers the targets, runs the health checks and publishes the
+result as a gzipped, versioned snapshot. The other routers, the followers, only fetch the
+latest snapshot and render and apply the config from it. AWS calls and health probes then
+stay the same however many routers there are.
+
+The lease is renewed on every cycle, and taken over by another router when it has not been
+renewed for 'lease_ttl' seconds. Expiry times are compared between hosts, so their clocks
+must be in sync. A follower that finds no snapshot, or only one older than 'max_age'
+seconds, or can't reach the store, discovers the targets itself.
+
+Keys in the store, below the tier name:
+
+    lease.json                Owner of the lease and when it expires.
+    latest.json               Version, digest and publish time of the latest snapshot.
+    snapshots/<version>.gz    The snapshots. The last KEEP_SNAPSHOTS are kept.
+
+A store is any object with 'read(key)', returning a tuple of the data and an etag, or of
+None and None if the key doesn't exist, 'write(key, data)', 'swap(key, data, etag)',
+which only writes if the etag of the key is still 'etag', or if the key doesn't exist
+when 'etag' is None, and returns False otherwise, and 'delete(key)'.
+"""
+import os
+import gzip
+import json
+import time
+import socket
+import hashlib
+import logging
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows.
+    fcntl = None
+
+import boto3
+from botocore.exceptions import ClientError
+
+from apirouter import metrics
+from apirouter.awstargets import BOTO_CONFIG
+from apirouter.fragments import digest
+
+
+log = logging.getLogger(__name__)
+
+
+LEASE_TTL = 90.0  # Seconds the lease is held without renewing it. Longer than the crontab interval.
+KEEP_SNAPSHOTS = 5  # Number of snapshots kept in the store.
+SNAPSHOT_FORMAT = 1  # Bumped if the snapshot format changes.
+
+LEASE_KEY = 'lease.json'
+LATEST_KEY = 'latest.json'
+SNAPSHOT_KEY = 'snapshots/{:08d}.gz'
+
+CONFLICT_CODES = ('PreconditionFailed', 'ConditionalRequestConflict')  # Failed S3 conditional writes.
+
+
+class LocalStore(object):
+    """A store in the local directory 'path'. For tests, and routers sharing a file system."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, key):
+        return os.path.join(self.path, *key.split('/'))
+
+    def read(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None, None
+        return data, hashlib.sha1(data).hexdigest()
+
+    def write(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def swap(self, key, data, etag):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, '.lock'), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.read(key)[1] != etag:
+                return False
+            self.write(key, data)
+            return True
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except (IOError, OSError):
+            pass
+
+
+class S3Store(object):
+    """
+    A store in S3 'bucket' with keys below 'prefix'. Swaps use S3 conditional writes, so
+    the bucket must support them, and botocore must be 1.35.69 or later.
+    """
+
+    def __init__(self, bucket, prefix='', client=None):
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = client or boto3.client('s3', config=BOTO_CONFIG)
+
+    def _key(self, key):
+        return '{}/{}'.format(self.prefix, key) if self.prefix else key
+
+    def read(self, key):
+        try:
+            ret = self.client.get_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None, None
+            raise
+        return ret['Body'].read(), ret['ETag']
+
+    def write(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data)
+
+    def swap(self, key, data, etag):
+        condition = {'IfNoneMatch': '*'} if etag is None else {'IfMatch': etag}
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data, **condition)
+        except ClientError as e:
+            if e.response['Error']['Code'] in CONFLICT_CODES:
+                return False
+            raise
+        return True
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+
+def create_store(url):
+    """Create a store from 'url'. It's either an S3 url, 's3://bucket/prefix', or a directory."""
+    parts = urlparse(url)
+    if parts.scheme == 's3':
+        return S3Store(parts.netloc, parts.path)
+    elif parts.scheme == 'file':
+        return LocalStore(parts.path)
+    elif not parts.scheme:
+        return LocalStore(url)
+    raise RuntimeError("Unsupported snapshot store url: {}".format(url))
+
+
+def _to_json(ob):
+    return json.dumps(ob, sort_keys=True, default=str).encode('utf-8')
+
+
+def get_owner(daemon=False):
+    """
+    Return the lease owner for this router. It's the host name, so each run from cron on
+    the same host renews the lease it holds. A daemon adds the process id, so a restarted
+    daemon doesn't take over a lease a running one still holds.
+    """
+    owner = socket.gethostname()
+    return '{}:{}'.format(owner, os.getpid()) if daemon else owner
+
+
+class Snapshots(object):
+    """
+    Discovery for tier 'tier_name' shared through 'store'. 'owner' identifies this router
+    in the lease, and defaults to the host name, see get_owner().
+    """
+
+    def __init__(self, store, tier_name, owner=None, lease_ttl=None, max_age=None):
+        self.store = store
+        self.tier_name = tier_name
+        self.owner = owner or get_owner()
+        self.lease_ttl = LEASE_TTL if lease_ttl is None else lease_ttl
+        self.max_age = self.lease_ttl if max_age is None else max_age
+        self.leader = False
+        self._latest = None  # The latest snapshot fetched or published, with the discovery as json.
+
+    def _key(self, key):
+        return '{}/{}'.format(self.tier_name, key)
+
+    def _read_json(self, key):
+        data, etag = self.store.read(self._key(key))
+        return (json.loads(data.decode('utf-8')) if data else None), etag
+
+    def acquire_lease(self):
+        """Take or renew the lease. Returns True if this router is the leader."""
+        lease, etag = self._read_json(LEASE_KEY)
+        now = time.time()
+        if lease and lease['owner'] != self.owner and lease['expires'] > now:
+            if self.leader:
+                log.warning("Lost the snapshot lease to %s.", lease['owner'])
+            self.leader = False
+            return False
+
+        renewing = bool(lease) and lease['owner'] == self.owner
+        new_lease = {
+            'owner': self.owner,
+            'acquired': lease['acquired'] if renewing else now,
+            'expires': now + self.lease_ttl,
+        }
+        leader = self.store.swap(self._key(LEASE_KEY), _to_json(new_lease), etag)
+        if leader and not self.leader:
+            log.info("Took the snapshot lease for tier %s.", self.tier_name)
+        self.leader = leader
+        return leader
+
+    def release(self):
+        """Give up the lease, so another router can take over right away."""
+        if not self.leader:
+            return
+        lease, etag = self._read_json(LEASE_KEY)
+        if lease and lease['owner'] == self.owner:
+            lease['expires'] = 0
+            self.store.swap(self._key(LEASE_KEY), _to_json(lease), etag)
+        self.leader = False
+
+    def publish(self, discovery):
+        """
+        Publish 'discovery' as the latest snapshot. If it's the same as the latest one only
+        the publish time is updated. Returns the version.
+        """
+        latest, etag = self._read_json(LATEST_KEY)
+        now = time.time()
+        discovery_digest = digest(discovery)
+        if latest and latest['digest'] == discovery_digest:
+            latest['published'] = now
+            self.store.swap(self._key(LATEST_KEY), _to_json(latest), etag)
+            return latest['version']
+
+        version = latest['version'] + 1 if latest else 1
+        snapshot = {
+            'format': SNAPSHOT_FORMAT,
+            'tier_name': self.tier_name,
+            'version': version,
+            'leader': self.owner,
+            'discovery': discovery,
+        }
+        data = gzip.compress(_to_json(snapshot))
+        self.store.write(self._key(SNAPSHOT_KEY.format(version)), data)
+        new_latest = {
+            'version': version,
+            'key': SNAPSHOT_KEY.format(version),
+            'digest': discovery_digest,
+            'published': now,
+            'leader': self.owner,
+        }
+        if not self.store.swap(self._key(LATEST_KEY), _to_json(new_latest), etag):
+            log.warning("Snapshot version %s was published by another router.", version)
+            return None
+
+        self._latest = dict(new_latest, data=_to_json(discovery))
+        metrics.gauge('snapshot_bytes', len(data))
+        log.info("Published snapshot version %s, %s bytes.", version, len(data))
+        if version > KEEP_SNAPSHOTS:
+            self.store.delete(self._key(SNAPSHOT_KEY.format(version - KEEP_SNAPSHOTS)))
+        return version
+
+    def fetch(self):
+        """
+        Return the discovery from the latest snapshot, or None if there is no fresh one. The
+        caller may change it, as each call decodes a new one.
+        """
+        latest, _ = self._read_json(LATEST_KEY)
+        if latest is None:
+            log.warning("No snapshot for tier %s.", self.tier_name)
+            return None
+        age = time.time() - latest['published']
+        metrics.gauge('snapshot_age', round(age, 1))
+        if age > self.max_age:
+            log.warning("Snapshot version %s from %s is %d seconds old.", latest['version'], latest['leader'], age)
+            return None
+
+        if self._latest and self._latest['digest'] == latest['digest']:
+            return json.loads(self._latest['data'].decode('utf-8'))
+
+        data, _ = self.store.read(self._key(latest['key']))
+        if data is None:
+            log.warning("Snapshot %s is missing.", latest['key'])
+            return None
+        snapshot = json.loads(gzip.decompress(data).decode('utf-8'))
+        if snapshot['format'] != SNAPSHOT_FORMAT or digest(snapshot['discovery']) != latest['digest']:
+            log.warning("Snapshot version %s doesn't match the latest one.", latest['version'])
+            return None
+
+        log.info("Fetched snapshot version %s from %s.", latest['version'], latest['leader'])
+        self._latest = dict(latest, data=_to_json(snapshot['discovery']))
+        return snapshot['discovery']
+
+    def get_discovery(self, discover):
+        """
+        Return the discovery for the tier. The leader calls 'discover' and publishes the
+        result, followers fetch the latest snapshot. If there is no fresh snapshot or the
+        store can't be reached, 'discover' is called without publishing.
+
+        The discovery is returned as it looks after a json round trip, so all routers
+        render the config from the same values.
+        """
+        try:
+            leader = self.acquire_lease()
+        except Exception:
+            log.exception("Can't reach the snapshot store.")
+            leader = None
+        metrics.gauge('leader', 1 if leader else 0)
+
+        if leader is False:
+            try:
+                discovery = self.fetch()
+            except Exception:
+                log.exception("Failed to fetch the snapshot.")
+                discovery = None
+            if discovery is not None:
+                return discovery
+            log.warning("Discovering targets for tier %s without a snapshot.", self.tier_name)
+
+        discovery = json.loads(_to_json(discover()).decode('utf-8'))
+        if leader:
+            try:
+                self.publish(discovery)
+            except Exception:
+                log.exception("Failed to publish the snapshot.")
+        return discovery
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import time
+import datetime
+import unittest
+
+import mock
+
+from apirouter import awstargets
+from apirouter.discoverycache import DiscoveryCache
+from apirouter.healthstate import HealthState
+
+
+class FakePaginator(object):
+    """Returns the pages from calling 'pages' with the arguments to paginate()."""
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kw):
+        return self.pages(**kw)
+
+
+def make_instance(i, tags=None):
+    tags = dict({
+        'Name': 'TIER-drift-base',
+        'api-status': 'online',
+        'api-target': 'drift-base',
+        'api-port': '10080',
+    }, **(tags or {}))
+    return {
+        'InstanceId': 'i-{:08d}'.format(i),
+        'ImageId': 'ami-1',
+        'InstanceType': 't2.small',
+        'LaunchTime': datetime.datetime(2018, 10, 16, 13, 5, 14),
+        'Placement': {'AvailabilityZone': 'eu-west-1b'},
+        'PrivateIpAddress': '10.0.{}.{}'.format(i // 256, i % 256),
+        'State': {'Name': 'running'},
+        'SubnetId': 'subnet-1',
+        'VpcId': 'vpc-1',
+        'Tags': [{'Key': k, 'Value': v} for k, v in tags.items()],
+    }
+
+
+class TestAwsTargets(unittest.TestCase):
+
+    def setUp(self):
+        self.ec2 = mock.MagicMock()
+        self.autoscaling = mock.MagicMock()
+        self.apigateway = mock.MagicMock()
+        clients = {'ec2': self.ec2, 'autoscaling': self.autoscaling, 'apigateway': self.apigateway}
+        patchers = [
+            mock.patch.object(awstargets, '_get_boto_client', lambda name, region_name: clients[name]),
+            mock.patch.object(awstargets, 'get_cache', lambda: DiscoveryCache()),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.conf = mock.MagicMock()
+        self.conf.tier = {'tier_name': 'TIER', 'aws': {'region': 'eu-west-1'}}
+        self.conf.table_store.get_table.return_value.find.return_value = [
+            {'deployable_name': 'drift-base'},
+        ]
+
+    def test_ec2_targets(self):
+        instances = [make_instance(i) for i in range(120)]
+        instances.append(make_instance(120, {'api-status': 'offline'}))
+        self.ec2.describe_vpcs.return_value = {'Vpcs': [{'VpcId': 'vpc-1'}]}
+
+        def describe_instances(**kw):
+            # Two pages of reservations.
+            return [
+                {'Reservations': [{'Instances': instances[:100]}]},
+                {'Reservations': [{'Instances': instances[100:]}]},
+            ]
+
+        batches = []
+
+        def describe_auto_scaling_instances(InstanceIds):
+            batches.append(len(InstanceIds))
+            return [{'AutoScalingInstances': [
+                {'InstanceId': instance_id, 'LifecycleState': 'Terminating:Wait'}
+                for instance_id in InstanceIds if instance_id == 'i-00000007'
+            ]}]
+
+        paginators = {
+            'describe_instances': FakePaginator(describe_instances),
+            'describe_auto_scaling_instances': FakePaginator(describe_auto_scaling_instances),
+        }
+        self.ec2.get_paginator.side_effect = paginators.get
+        self.autoscaling.get_paginator.side_effect = paginators.get
+
+        targets = awstargets._get_ec2_targets_from_aws('TIER', conf=self.conf)
+        self.assertEqual(len(targets['drift-base']), 120)
+        self.assertEqual(sorted(batches), [21, 50, 50])
+
+        target = targets['drift-base'][7]
+        self.assertEqual(target['instance_id'], 'i-00000007')
+        self.assertEqual(target['tags']['api-param'], 'backup')
+        self.assertEqual(target['launch_time'], '2018-10-16T13:05:14Z')
+        self.assertEqual(target['comment'], 'TIER-drift-base [t2.small] [eu-west-1b]')
+
+    def test_api_endpoints(self):
+        def get_rest_apis(**kw):
+            return [
+                {'items': [{'id': 'a{}'.format(i), 'name': 'OTHER-{}'.format(i)} for i in range(500)]},
+                {'items': [{'id': 'base', 'name': 'TIER-drift-base'}]},
+            ]
+
+        self.apigateway.get_paginator.return_value = FakePaginator(get_rest_apis)
+        self.apigateway.get_stages.return_value = {'item': [{'stageName': 'main'}]}
+
+        endpoints = awstargets._get_api_endpoints('eu-west-1', 'TIER', ['drift-base', 'drift-other'])
+        self.assertEqual(
+            [(ep['deployable_name'], ep['url']) for ep in endpoints],
+            [('drift-base', 'https://base.execute-api.eu-west-1.amazonaws.com/main')],
+        )
+        self.apigateway.get_stages.assert_called_once_with(restApiId='base')
+        self.assertIn('get_stages', awstargets.reset_call_timings())
+
+    def test_router_count(self):
+        filters = []
+
+        def describe_instances(Filters):
+            filters.append(Filters)
+            return [{'Reservations': [{'Instances': [make_instance(1), make_instance(2)]}]}]
+
+        self.ec2.get_paginator.return_value = FakePaginator(describe_instances)
+        self.assertEqual(awstargets.get_router_count('TIER', conf=self.conf), 2)
+        self.assertIn({'Name': 'tag:service-name', 'Values': ['drift-apirouter']}, filters[0])
+
+        # This api-router is always counted.
+        self.ec2.get_paginator.return_value = FakePaginator(lambda Filters: [{'Reservations': []}])
+        self.assertEqual(awstargets.get_router_count('TIER', conf=self.conf), 1)
+
+    def test_run_concurrently(self):
+        def call(result, seconds=0.2):
+            def fn():
+                time.sleep(seconds)
+                return result
+            return fn
+
+        t = time.time()
+        self.assertEqual(awstargets.run_concurrently(call(1), call(2), call(3)), [1, 2, 3])
+        self.assertLess(time.time() - t, 0.5)
+
+        def fail():
+            raise RuntimeError('throttled')
+
+        with self.assertRaises(RuntimeError):
+            awstargets.run_concurrently(call(1), fail)
+
+    def test_one_probe_batch(self):
+        targets = {'drift-base': [{'instance_id': 'i-1', 'private_ip_address': '10.0.0.1'}]}
+        endpoints = [{'deployable_name': 'drift-base', 'url': 'https://base.execute-api.eu-west-1.amazonaws.com/main'}]
+        batches = []
+
+        def run_probes(probes, deadline=None):
+            batches.append(sorted(key[0] for key, host, fn in probes))
+            return {key: fn() for key, host, fn in probes}
+
+        with mock.patch.object(awstargets, 'run_probes', run_probes), \
+                mock.patch.object(awstargets, 'get_health_state', lambda: HealthState()), \
+                mock.patch.object(awstargets, '_probe_target', lambda target: (200, 'ok')), \
+                mock.patch.object(awstargets, '_do_api_gw_health_check', lambda url, public_url: (403, 'Forbidden')):
+            healthy = awstargets.healthcheck_targets(targets, endpoints)
+
+        self.assertEqual(batches, [['apigw', 'ec2']])
+        self.assertEqual(len(healthy['drift-base']), 1)
+        self.assertEqual((endpoints[0]['health_status'], endpoints[0]['message']), (403, 'http 403'))
+
+    def test_boto_config(self):
+        config = awstargets.BOTO_CONFIG
+        self.assertEqual(config.retries['mode'], 'adaptive')
+        self.assertEqual(config.connect_timeout, awstargets.AWS_CONNECT_TIMEOUT)
+        self.assertEqual(config.read_timeout, awstargets.AWS_READ_TIMEOUT)
+
+        # Older botocore has no retry modes.
+        config = awstargets._get_boto_config(retry_mode='unknown-mode')
+        self.assertNotIn('mode', config.retries)
+        self.assertEqual(config.retries['max_attempts'], awstargets.AWS_MAX_ATTEMPTS)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+import driftconfig.relib
+
+from apirouter.benchmark import run_benchmark, compare_results
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run_and_compare(self):
+        check_integrity = driftconfig.relib.CHECK_INTEGRITY
+        result = run_benchmark('small', repeat=1)
+        self.assertIs(driftconfig.relib.CHECK_INTEGRITY, check_integrity)
+        self.assertIn('prepare', result['stages'])
+        self.assertIn('apply_incremental', result['stages'])
+        self.assertGreater(result['peak_memory'], 0)
+
+        before = {'results': [result]}
+        slower = dict(result, stages=dict(result['stages'], prepare=result['stages']['prepare'] * 2))
+        rows = compare_results(before, {'results': [slower]})
+        regressed = [(size, stage) for size, stage, _, _, _, is_regression in rows if is_regression]
+        self.assertEqual(regressed, [('small', 'prepare')])
+
+
+if __name__ == '__main__':
+    unittest.main()
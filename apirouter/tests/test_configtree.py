@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from apirouter import configtree
+
+
+class TestConfigTree(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmpdir, 'apirouter')
+        self.nginx_config = os.path.join(self.tmpdir, 'nginx.conf')
+        with open(self.nginx_config, 'w') as f:
+            f.write('# Placeholder\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_and_activate(self, release_id, files):
+        target_dir, changed = configtree.write_release(self.root, release_id, files)
+        configtree.activate_release(self.root, release_id, self.nginx_config)
+        return target_dir, changed
+
+    def test_release(self):
+        files = {'nginx.conf': 'http {}\n', 'maps/tenants.conf': 'map {}\n', 'upstreams/a.conf': 'upstream a {}\n'}
+        target_dir, changed = self.write_and_activate('one', files)
+        self.assertEqual(sorted(changed), sorted(files))
+        self.assertEqual(configtree.current_release(self.root), 'one')
+        with open(self.nginx_config) as f:
+            self.assertEqual(f.read(), 'http {}\n')
+
+        # Only the changed file is written, the others keep their inode.
+        files['upstreams/a.conf'] = 'upstream a { server x; }\n'
+        target_dir_2, changed = self.write_and_activate('two', files)
+        self.assertEqual(changed, ['upstreams/a.conf'])
+        self.assertEqual(configtree.current_release(self.root), 'two')
+        self.assertEqual(
+            os.stat(os.path.join(target_dir, 'maps/tenants.conf')).st_ino,
+            os.stat(os.path.join(target_dir_2, 'maps/tenants.conf')).st_ino,
+        )
+        self.assertNotEqual(
+            os.stat(os.path.join(target_dir, 'upstreams/a.conf')).st_ino,
+            os.stat(os.path.join(target_dir_2, 'upstreams/a.conf')).st_ino,
+        )
+
+    def test_discard_and_prune(self):
+        for i in range(4):
+            self.write_and_activate(str(i), {'nginx.conf': str(i)})
+
+        # The current release is never discarded.
+        configtree.discard_release(self.root, '3')
+        self.assertTrue(os.path.isdir(configtree.release_dir(self.root, '3')))
+        configtree.discard_release(self.root, '2')
+        self.assertFalse(os.path.isdir(configtree.release_dir(self.root, '2')))
+
+        configtree.prune_releases(self.root, keep=1)
+        self.assertEqual(len(os.listdir(os.path.join(self.root, 'releases'))), 2)
+        self.assertEqual(configtree.current_release(self.root), '3')
+
+    def test_fingerprint(self):
+        self.assertIsNone(configtree.read_fingerprint(self.root))
+        self.write_and_activate('one', {'nginx.conf': 'one'})
+        configtree.write_fingerprint(self.root, 'abc')
+        self.assertEqual(configtree.read_fingerprint(self.root), 'abc')
+
+        # The fingerprint belongs to the release it was written for.
+        self.write_and_activate('two', {'nginx.conf': 'two'})
+        self.assertIsNone(configtree.read_fingerprint(self.root))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import json
+import queue
+import signal
+import unittest
+
+import mock
+
+from apirouter import daemon, lifecycle
+from apirouter.daemon import Daemon
+
+
+def make_discovery():
+    return {
+        'ec2_targets': {
+            'drift-base': [
+                {
+                    'name': 'DEVNORTH-drift-base-auto',
+                    'instance_id': 'i-0a436fc2e66a39f35',
+                    'private_ip_address': '10.50.2.139',
+                    'tags': {'api-status': 'online', 'api-target': 'drift-base', 'api-port': '10080'},
+                },
+            ],
+        },
+        'api_endpoints': {},
+    }
+
+
+class TestDaemon(unittest.TestCase):
+
+    def setUp(self):
+        self.discoveries = []  # Discoveries made, in order.
+        self.cycles = []  # Discovery passed to each cycle.
+        self.fail_cycles = 0  # Number of cycles to fail before succeeding.
+        self.stop_after = None  # Stop the daemon after this many cycles.
+        self.daemon = None
+
+        def discover_tier(tier_name, check_health=True, conf=None):
+            self.discoveries.append(make_discovery())
+            return self.discoveries[-1]
+
+        def run_cycle(tier_name, check_health=True, conf=None, discovery=None):
+            self.cycles.append(discovery)
+            if self.stop_after is not None and len(self.cycles) >= self.stop_after:
+                self.daemon.stop()
+            if self.fail_cycles:
+                self.fail_cycles -= 1
+                raise RuntimeError('nginx -t failed')
+            return 0
+
+        self.invalidate = mock.MagicMock()
+        patchers = [
+            mock.patch.object(daemon, 'discover_tier', discover_tier),
+            mock.patch.object(daemon, 'run_cycle', run_cycle),
+            mock.patch.object(daemon, 'get_default_drift_config', lambda: object()),
+            mock.patch.object(daemon, 'get_drift_config', lambda ts, tier_name: 'conf'),
+            mock.patch.object(daemon.discoverycache, 'invalidate', self.invalidate),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        for signum in (signal.SIGHUP, signal.SIGTERM):
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+
+    def make_daemon(self, **kw):
+        kw.setdefault('interval', 0)
+        self.daemon = Daemon('DEVNORTH', jitter=0, **kw)
+        return self.daemon
+
+    def test_run_once(self):
+        d = self.make_daemon()
+        d.run_once()
+        self.assertEqual(len(self.discoveries), 1)
+        ts = d.ts
+
+        # The last discovery is used until a sweep is due.
+        d.run_once()
+        self.assertEqual(len(self.discoveries), 1)
+        self.assertIs(self.cycles[1], self.discoveries[0])
+
+        d.refresh()
+        d.run_once()
+        self.assertEqual(len(self.discoveries), 2)
+        self.assertIs(d.ts, ts)
+        self.invalidate.assert_not_called()
+
+    def test_sighup(self):
+        d = self.make_daemon()
+        self.stop_after = 1
+        with mock.patch.object(d, 'wait'):
+            d.run()
+        ts = d.ts
+
+        # SIGHUP reloads the config, flushes the cache and sweeps on the next cycle.
+        signal.getsignal(signal.SIGHUP)(signal.SIGHUP, None)
+        self.assertTrue(d._wakeup.is_set())
+        d.run_once()
+        self.assertIsNot(d.ts, ts)
+        self.invalidate.assert_called_once_with()
+        self.assertEqual(len(self.discoveries), 2)
+
+        signal.getsignal(signal.SIGTERM)(signal.SIGTERM, None)
+        self.assertFalse(d.running)
+
+    def test_failed_cycle_sweeps(self):
+        d = self.make_daemon()
+        self.stop_after = 3
+        self.fail_cycles = 1
+        with mock.patch.object(d, 'wait'):
+            d.run()
+
+        # The failed first cycle forces a sweep on the second, the third reuses it.
+        self.assertEqual(len(self.cycles), 3)
+        self.assertEqual(len(self.discoveries), 2)
+        self.assertIs(self.cycles[2], self.discoveries[1])
+
+    def test_timeout_sweeps(self):
+        d = self.make_daemon()
+        d.run_once()
+        d.running = True
+        d.wait(0)
+        self.assertTrue(d.sweep_due)
+
+    def test_events(self):
+        q = queue.Queue()
+        d = self.make_daemon(interval=60, event_source=lifecycle.QueueEventSource(q))
+        d.run_once()
+        d.running = True
+
+        # A terminating instance is marked as backup and a cycle runs right away, without
+        # a sweep.
+        q.put(json.dumps({
+            'EC2InstanceId': 'i-0a436fc2e66a39f35',
+            'LifecycleTransition': 'autoscaling:EC2_INSTANCE_TERMINATING',
+        }))
+        q.put('not json')
+        d.wait(5)
+        self.assertFalse(d.sweep_due)
+        self.assertIsNotNone(d.events_received)
+        d.run_once()
+        self.assertEqual(len(self.discoveries), 1)
+        self.assertEqual(self.cycles[-1]['ec2_targets']['drift-base'][0]['tags']['api-param'], 'backup')
+        self.assertIsNone(d.events_received)
+
+        # A launching instance needs a sweep.
+        q.put({'EC2InstanceId': 'i-1', 'LifecycleTransition': 'autoscaling:EC2_INSTANCE_LAUNCHING'})
+        d.wait(5)
+        self.assertTrue(d.sweep_due)
+        d.run_once()
+        self.assertEqual(len(self.discoveries), 2)
+
+    def test_sweep_with_events(self):
+        q = queue.Queue()
+        d = self.make_daemon(interval=60, event_source=lifecycle.QueueEventSource(q))
+        d.run_once()
+        d.running = True
+        q.put({'EC2InstanceId': 'i-0a436fc2e66a39f35', 'LifecycleTransition': 'autoscaling:EC2_INSTANCE_TERMINATING'})
+        d.wait(5)
+        self.assertFalse(d.sweep_due)
+
+        # A steady stream of events doesn't hold off the periodic sweep.
+        d.last_sweep -= 60
+        q.put({'EC2InstanceId': 'i-0a436fc2e66a39f35', 'LifecycleTransition': 'autoscaling:EC2_INSTANCE_TERMINATED'})
+        d.wait(5)
+        self.assertTrue(d.sweep_due)
+
+    def test_ack_events(self):
+        source = mock.MagicMock()
+        d = self.make_daemon(event_source=source)
+        self.fail_cycles = 1
+        with self.assertRaises(RuntimeError):
+            d.run_once()
+        source.ack.assert_not_called()
+        d.run_once()
+        source.ack.assert_called_once_with()
+
+    def test_event_source_errors(self):
+        source = mock.MagicMock()
+        source.poll.side_effect = [RuntimeError('SQS is down'), []]
+        d = self.make_daemon(event_source=source)
+        d.running = True
+        d.wait(0.05)
+        self.assertTrue(d.sweep_due)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import datetime
+import unittest
+
+import mock
+
+from apirouter.discoverycache import DiscoveryCache
+
+
+class TestDiscoveryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'state', 'cache.json')
+        self.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fetch(self):
+        self.calls += 1
+        return {'VpcId': 'vpc-{}'.format(self.calls), 'created': datetime.datetime(2018, 1, 1)}
+
+    def test_ttl(self):
+        cache = DiscoveryCache(self.path)
+        with mock.patch('time.time', return_value=1000.0):
+            value = cache.get('vpc/x', self.fetch, ttl=60)
+            self.assertEqual(value, {'VpcId': 'vpc-1', 'created': '2018-01-01 00:00:00'})
+            self.assertEqual(cache.get('vpc/x', self.fetch, ttl=60)['VpcId'], 'vpc-1')
+        with mock.patch('time.time', return_value=1061.0):
+            self.assertEqual(cache.get('vpc/x', self.fetch, ttl=60)['VpcId'], 'vpc-2')
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        # None is not cached.
+        self.assertIsNone(cache.get('vpc/y', lambda: None))
+        self.assertIsNone(cache.get('vpc/y', lambda: None))
+        self.assertEqual(cache.misses, 4)
+
+    def test_persist_and_invalidate(self):
+        DiscoveryCache(self.path).get('vpc/x', self.fetch)
+        DiscoveryCache(self.path).get('stages/a', self.fetch)
+
+        # A new instance picks up the saved entries.
+        cache = DiscoveryCache(self.path)
+        self.assertEqual(cache.get('vpc/x', self.fetch)['VpcId'], 'vpc-1')
+        self.assertEqual(cache.get('stages/a', self.fetch)['VpcId'], 'vpc-2')
+        self.assertEqual(self.calls, 2)
+
+        cache.invalidate('stages/')
+        cache = DiscoveryCache(self.path)
+        self.assertEqual(cache.get('vpc/x', self.fetch)['VpcId'], 'vpc-1')
+        self.assertEqual(cache.get('stages/a', self.fetch)['VpcId'], 'vpc-3')
+
+        cache.invalidate()
+        self.assertEqual(cache.get('vpc/x', self.fetch)['VpcId'], 'vpc-4')
+
+    def test_corrupt_file(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{not json')
+        cache = DiscoveryCache(self.path)
+        self.assertEqual(cache.get('vpc/x', self.fetch)['VpcId'], 'vpc-1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from jinja2 import Environment, DictLoader
+
+from apirouter.fragments import FragmentRenderer, ADDED, CHANGED, REMOVED
+
+
+TEMPLATE = '''
+{% macro hello(name) %}hello {{ name }}{% endmacro %}
+{% macro upper(name) %}{{ name.upper() }}{% endmacro %}
+'''
+
+
+class TestFragmentRenderer(unittest.TestCase):
+
+    def setUp(self):
+        env = Environment(loader=DictLoader({'fragments.jinja': TEMPLATE}))
+        self.renderer = FragmentRenderer(env.get_template('fragments.jinja'))
+
+    def test_render(self):
+        fragments = self.renderer.render([
+            ('a', 'hello', {'name': 'world'}),
+            ('b', 'upper', {'name': 'world'}),
+        ])
+        self.assertEqual(list(fragments.items()), [('a', 'hello world'), ('b', 'WORLD')])
+        self.assertEqual(dict(self.renderer.changes), {'a': ADDED, 'b': ADDED})
+
+        # Nothing changed.
+        self.renderer.render([
+            ('a', 'hello', {'name': 'world'}),
+            ('b', 'upper', {'name': 'world'}),
+        ])
+        self.assertEqual(dict(self.renderer.changes), {})
+
+        # Fragment 'a' changed, 'b' removed.
+        fragments = self.renderer.render([
+            ('a', 'hello', {'name': 'there'}),
+        ])
+        self.assertEqual(fragments['a'], 'hello there')
+        self.assertEqual(dict(self.renderer.changes), {'a': CHANGED, 'b': REMOVED})
+
+    def test_same_output(self):
+        # Inputs changed but the output is the same.
+        self.renderer.render([('b', 'upper', {'name': 'world'})])
+        self.renderer.render([('b', 'upper', {'name': 'WORLD'})])
+        self.assertEqual(dict(self.renderer.changes), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from apirouter import awstargets
+from apirouter.healthstate import HealthState
+
+
+class TestHealthState(unittest.TestCase):
+
+    def setUp(self):
+        self.state = HealthState(rise=2, fall=3, healthy_interval=60, transition_interval=5,
+                                 backoff_min=10, backoff_max=40, probe_budget=2)
+
+    def test_rise_and_fall(self):
+        state = self.state
+        self.assertFalse(state.update('i-1', True, now=0))
+        self.assertTrue(state.get('i-1')['healthy'])
+
+        # Two failures are not enough to fall.
+        self.assertFalse(state.update('i-1', False, 'Timeout', now=100))
+        self.assertFalse(state.update('i-1', False, 'Timeout', now=105))
+        self.assertTrue(state.get('i-1')['healthy'])
+        self.assertEqual(state.get('i-1')['next_probe'], 110)
+
+        self.assertTrue(state.update('i-1', False, 'Timeout', now=110))
+        self.assertFalse(state.get('i-1')['healthy'])
+
+        # One success is not enough to rise.
+        self.assertFalse(state.update('i-1', True, now=120))
+        self.assertFalse(state.get('i-1')['healthy'])
+        self.assertTrue(state.update('i-1', True, now=125))
+        self.assertTrue(state.get('i-1')['healthy'])
+
+        # Probed often right after the change, then at the healthy interval.
+        self.assertEqual(state.get('i-1')['next_probe'], 130)
+        state.update('i-1', True, now=200)
+        self.assertEqual(state.get('i-1')['next_probe'], 260)
+
+    def test_backoff(self):
+        state = self.state
+        state.update('i-1', False, 'Timeout', now=0)
+        intervals = []
+        for i in range(6):
+            now = state.get('i-1')['next_probe']
+            state.update('i-1', False, 'Timeout', now=now)
+            intervals.append(state.get('i-1')['next_probe'] - now)
+        self.assertEqual(intervals, [10, 10, 20, 40, 40, 40])
+
+    def test_due_and_budget(self):
+        state = self.state
+        state.update('steady', True, now=-100)
+        state.update('steady', True, now=0)
+        state.update('flux', True, now=0)
+        state.update('flux', False, 'Timeout', now=0)
+        self.assertEqual(state.due(['steady', 'flux', 'new'], now=1), ['new'])
+        self.assertEqual(state.due(['steady', 'flux', 'new'], now=100), ['new', 'flux'])
+
+        state.prune(['flux'])
+        self.assertIsNone(state.get('steady'))
+
+
+class TestHealthcheckWithState(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'health.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_probe_only_when_due(self):
+        targets = {'svc': [
+            {'instance_id': 'i-1', 'private_ip_address': '10.0.0.1'},
+            {'instance_id': 'i-2', 'private_ip_address': '10.0.0.2'},
+        ]}
+        probed = []
+
+        def probe(target):
+            probed.append(target['instance_id'])
+            return (200, 'ok') if target['instance_id'] == 'i-1' else ('error', 'Timeout')
+
+        with mock.patch.object(awstargets, '_probe_target', probe):
+            healthy = awstargets.healthcheck_tier(targets, health_state=HealthState(self.path))
+            self.assertEqual([t['instance_id'] for t in healthy['svc']], ['i-1'])
+            self.assertEqual(targets['svc'][1]['health_status'], 'timeout')
+
+            # Nothing is due right away, and the state is loaded from disk.
+            del probed[:]
+            healthy = awstargets.healthcheck_tier(targets, health_state=HealthState(self.path))
+            self.assertEqual(probed, [])
+            self.assertEqual([t['instance_id'] for t in healthy['svc']], ['i-1'])
+
+    def test_stable_reason(self):
+        targets = {'svc': [{'instance_id': 'i-1', 'private_ip_address': '10.0.0.1'}]}
+        errors = iter([
+            "HTTPConnectionPool(host='10.0.0.1', port=8080): Max retries exceeded with url: / "
+            "(Caused by NewConnectionError('<urllib3.connection.HTTPConnection object at {}>: "
+            "Failed to establish a new connection: [Errno 111] Connection refused'))".format(address)
+            for address in ('0x7f1', '0x7f2')
+        ])
+        with mock.patch.object(awstargets, '_probe_target', lambda target: ('error', next(errors))):
+            awstargets.healthcheck_tier(targets)
+            self.assertEqual(targets['svc'][0]['health_status'], 'connection refused')
+            awstargets.healthcheck_tier(targets)
+            self.assertEqual(targets['svc'][0]['health_status'], 'connection refused')
+
+        with mock.patch.object(awstargets, '_probe_target', lambda target: (503, '<html>Busy</html>')):
+            awstargets.healthcheck_tier(targets)
+            self.assertEqual(targets['svc'][0]['health_status'], 'http 503')
+
+    def test_probe_budget(self):
+        targets = {'svc': [
+            {'instance_id': 'i-{}'.format(i), 'private_ip_address': '10.0.0.{}'.format(i)}
+            for i in range(5)
+        ]}
+        probed = []
+
+        def probe(target):
+            probed.append(target['instance_id'])
+            return 'error', 'Timeout'
+
+        with mock.patch.object(awstargets, '_probe_target', probe):
+            healthy = awstargets.healthcheck_tier(targets, health_state=HealthState(self.path, probe_budget=2))
+
+        # Targets over the budget are not probed, and kept in rotation until they are.
+        self.assertEqual(len(probed), 2)
+        self.assertEqual(len(healthy['svc']), 3)
+        self.assertEqual([t['health_status'] for t in healthy['svc']], [None, None, None])
+        self.assertEqual(len(HealthState(self.path).targets), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from apirouter.hosttuning import get_host_info, get_tuning
+
+
+GB = 1024 ** 3
+
+
+def make_host(**kw):
+    host = {
+        'platform': 'linux',
+        'cpus': 4,
+        'memory': 8 * GB,
+        'somaxconn': 4096,
+        'file_max': 800000,
+        'nr_open': 1048576,
+    }
+    host.update(kw)
+    return host
+
+
+class TestHostTuning(unittest.TestCase):
+
+    def test_host_info(self):
+        host = get_host_info()
+        self.assertGreaterEqual(host['cpus'], 1)
+        self.assertIn('somaxconn', host)
+
+    def test_tuning(self):
+        tuning = get_tuning(make_host())
+        self.assertEqual(tuning['worker_processes'], 4)
+        self.assertEqual(tuning['worker_cpu_affinity'], 'auto')
+        self.assertEqual(tuning['worker_rlimit_nofile'], 60000)
+        self.assertEqual(tuning['worker_connections'], 30000)
+        self.assertEqual(tuning['listen_params'], 'reuseport backlog=4096')
+        self.assertTrue(tuning['multi_accept'])
+        self.assertFalse(tuning['accept_mutex'])
+
+        # A small host.
+        tuning = get_tuning(make_host(cpus=1, memory=GB, file_max=8192, somaxconn=128))
+        self.assertIsNone(tuning['worker_cpu_affinity'])
+        self.assertEqual(tuning['worker_rlimit_nofile'], 4096)
+        self.assertEqual(tuning['worker_connections'], 3686)
+        self.assertEqual(tuning['listen_params'], 'backlog=128')
+
+        # Memory limits the connections.
+        tuning = get_tuning(make_host(cpus=8, memory=2 * GB))
+        self.assertEqual(tuning['worker_connections'], 8192)
+
+        # Nothing known but the CPUs.
+        host = {key: None for key in make_host()}
+        tuning = get_tuning(dict(host, platform='darwin', cpus=2))
+        self.assertEqual(tuning['worker_rlimit_nofile'], 60000)
+        self.assertTrue(tuning['accept_mutex'])
+        self.assertEqual(tuning['listen_params'], '')
+
+    def test_overrides(self):
+        nginx = {'worker_processes': 2, 'worker_connections': 100, 'reuseport': False, 'worker_cpu_affinity': None}
+        tuning = get_tuning(make_host(), nginx)
+        self.assertEqual(tuning['worker_processes'], 2)
+        self.assertEqual(tuning['worker_connections'], 100)
+        self.assertEqual(tuning['listen_params'], 'backlog=4096')
+        self.assertIsNone(tuning['worker_cpu_affinity'])
+
+        # Limits the host can't honor are lowered.
+        nginx = {'worker_rlimit_nofile': 100000, 'worker_connections': 100000, 'listen_backlog': 65535}
+        tuning = get_tuning(make_host(nr_open=50000, somaxconn=1024), nginx)
+        self.assertEqual(tuning['worker_rlimit_nofile'], 50000)
+        self.assertEqual(tuning['worker_connections'], 50000)
+        self.assertEqual(tuning['listen_backlog'], 1024)
+
+        # Settings that aren't numbers are left to Nginx. 'auto' workers are one per CPU.
+        tuning = get_tuning(make_host(), {'worker_processes': 'auto', 'listen_backlog': '511'})
+        self.assertEqual(tuning['worker_processes'], 'auto')
+        self.assertEqual(tuning['worker_cpu_affinity'], 'auto')
+        self.assertEqual(tuning['worker_connections'], 30000)
+        self.assertTrue(tuning['reuseport'])
+        self.assertEqual(tuning['listen_backlog'], 511)
+
+
+if __name__ == '__main__':
+    unittest.main()
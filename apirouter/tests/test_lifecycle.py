@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import queue
+import tempfile
+import unittest
+
+import boto3
+from botocore.stub import Stubber
+
+from apirouter import lifecycle
+
+
+def make_targets():
+    return {
+        'drift-base': [
+            {
+                'name': 'DEVNORTH-drift-base-auto',
+                'instance_id': 'i-0a436fc2e66a39f35',
+                'private_ip_address': '10.50.2.139',
+                'tags': {'api-status': 'online', 'api-target': 'drift-base', 'api-port': '10080'},
+            },
+            {
+                'name': 'DEVNORTH-drift-base-auto',
+                'instance_id': 'i-0b436fc2e66a39f36',
+                'private_ip_address': '10.50.2.140',
+                'tags': {'api-status': 'online', 'api-target': 'drift-base', 'api-port': '10080'},
+            },
+        ]
+    }
+
+
+class TestLifecycleEvents(unittest.TestCase):
+
+    def test_parse_lifecycle_hook(self):
+        message = {
+            'LifecycleHookName': 'drain',
+            'AutoScalingGroupName': 'DEVNORTH-drift-base-auto',
+            'EC2InstanceId': 'i-0a436fc2e66a39f35',
+            'LifecycleTransition': 'autoscaling:EC2_INSTANCE_TERMINATING',
+        }
+        event = lifecycle.parse_event(json.dumps(message))
+        self.assertEqual(event, {'instance_id': 'i-0a436fc2e66a39f35', 'action': lifecycle.TERMINATING})
+
+        # Same thing wrapped in an SNS envelope.
+        event = lifecycle.parse_event({'Type': 'Notification', 'Message': json.dumps(message)})
+        self.assertEqual(event, {'instance_id': 'i-0a436fc2e66a39f35', 'action': lifecycle.TERMINATING})
+
+    def test_parse_eventbridge(self):
+        event = lifecycle.parse_event({
+            'detail-type': 'EC2 Instance State-change Notification',
+            'detail': {'instance-id': 'i-0a436fc2e66a39f35', 'state': 'stopping'},
+        })
+        self.assertEqual(event, {'instance_id': 'i-0a436fc2e66a39f35', 'action': lifecycle.TERMINATED})
+
+        event = lifecycle.parse_event({
+            'detail-type': 'EC2 Instance Launch Successful',
+            'detail': {'EC2InstanceId': 'i-0c436fc2e66a39f37'},
+        })
+        self.assertEqual(event, {'instance_id': 'i-0c436fc2e66a39f37', 'action': lifecycle.LAUNCHING})
+
+    def test_parse_ignored(self):
+        self.assertIsNone(lifecycle.parse_event('not json'))
+        self.assertIsNone(lifecycle.parse_event({'Event': 'autoscaling:TEST_NOTIFICATION'}))
+
+    def test_apply_event(self):
+        targets = make_targets()
+        event = {'instance_id': 'i-0a436fc2e66a39f35', 'action': lifecycle.TERMINATING}
+        self.assertEqual(lifecycle.apply_event(targets, event), lifecycle.CHANGED)
+        self.assertEqual(targets['drift-base'][0]['tags']['api-param'], 'backup')
+        # Applying it again is a no-op.
+        self.assertIsNone(lifecycle.apply_event(targets, event))
+
+        event = {'instance_id': 'i-0a436fc2e66a39f35', 'action': lifecycle.TERMINATED}
+        self.assertEqual(lifecycle.apply_event(targets, event), lifecycle.CHANGED)
+        self.assertEqual(len(targets['drift-base']), 1)
+
+        event = {'instance_id': 'i-0c436fc2e66a39f37', 'action': lifecycle.LAUNCHING}
+        self.assertEqual(lifecycle.apply_event(targets, event), lifecycle.SWEEP)
+
+        event = {'instance_id': 'i-unknown', 'action': lifecycle.TERMINATED}
+        self.assertIsNone(lifecycle.apply_event(targets, event))
+
+    def test_queue_event_source(self):
+        q = queue.Queue()
+        source = lifecycle.QueueEventSource(q)
+        self.assertEqual(source.poll(timeout=0.01), [])
+        q.put('a')
+        q.put('b')
+        self.assertEqual(source.poll(timeout=0.01), ['a', 'b'])
+
+    def test_file_event_source(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'events.log')
+            source = lifecycle.FileEventSource(path)
+            self.assertEqual(source.poll(timeout=0.01), [])
+
+            with open(path, 'a') as f:
+                f.write('{"a": 1}\n\n')
+            self.assertEqual(source.poll(timeout=0.01), ['{"a": 1}\n'])
+
+            with open(path, 'a') as f:
+                f.write('{"b": 2}\n')
+            self.assertEqual(source.poll(timeout=0.01), ['{"b": 2}\n'])
+
+            # Truncated file is read from the start.
+            with open(path, 'w') as f:
+                f.write('{"c": 3}\n')
+            self.assertEqual(source.poll(timeout=0.01), ['{"c": 3}\n'])
+
+            # Events from before the source was created are not replayed.
+            source = lifecycle.FileEventSource(path)
+            self.assertEqual(source.poll(timeout=0.01), [])
+            with open(path, 'a') as f:
+                f.write('{"d": 4}\n')
+            self.assertEqual(source.poll(timeout=0.01), ['{"d": 4}\n'])
+
+    def test_sqs_event_source(self):
+        url = 'https://sqs.eu-west-1.amazonaws.com/123456789012/DEVNORTH-apirouter-events'
+        source = lifecycle.SqsEventSource(url)
+        source.client = boto3.client('sqs', region_name='eu-west-1', aws_access_key_id='a', aws_secret_access_key='b')
+        receive = {'QueueUrl': url, 'MaxNumberOfMessages': 10, 'WaitTimeSeconds': 5}
+        messages = [{'ReceiptHandle': 'r{}'.format(i), 'Body': '{{"i": {}}}'.format(i)} for i in range(12)]
+        with Stubber(source.client) as stubber:
+            stubber.add_response('receive_message', {'Messages': messages[:10]}, receive)
+            stubber.add_response('receive_message', {'Messages': messages[10:]}, receive)
+            stubber.add_response('delete_message_batch', {'Successful': [], 'Failed': []}, {
+                'QueueUrl': url,
+                'Entries': [{'Id': str(i), 'ReceiptHandle': 'r{}'.format(i)} for i in range(10)],
+            })
+            stubber.add_response('delete_message_batch', {'Successful': [], 'Failed': []}, {
+                'QueueUrl': url,
+                'Entries': [{'Id': str(i), 'ReceiptHandle': 'r{}'.format(i + 10)} for i in range(2)],
+            })
+
+            # Messages are only deleted when acked.
+            self.assertEqual(len(source.poll(timeout=5)), 10)
+            self.assertEqual(source.poll(timeout=5), ['{"i": 10}', '{"i": 11}'])
+            source.ack()
+            source.ack()
+            stubber.assert_no_pending_responses()
+
+
+if __name__ == '__main__':
+    unittest.main()
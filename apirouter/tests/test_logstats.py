@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import time
+import unittest
+
+from apirouter import logstats
+from apirouter.logstats import (
+    cache_stats, tail_lines, Histogram, LogAnalyzer, LogTailer, bucket_index, parse_line, analyze_files,
+)
+
+
+def log_line(request, cache_status):
+    return json.dumps({'request': request, 'response_code': 200, 'cache_status': cache_status})
+
+
+def traffic_line(timestamp, path='/svc/things', status=200, request_time=0.05, tenant='tenant1',
+                 api_key='key1:1.2.3', upstream='10.0.0.1:10080', upstream_time='0.040'):
+    # The field order and spacing of the 'jsonlog' format.
+    fields = [
+        ('timestamp', '"{:.3f}"'.format(timestamp)),
+        ('remote_addr', '"10.1.0.1"'),
+        ('drift_api_key', '"{}"'.format(api_key)),
+        ('host', '"{}.dg-api.com"'.format(tenant)),
+        ('request', '"GET {} HTTP/1.1"'.format(path)),
+        ('response_code', str(status)),
+        ('request_time', str(request_time)),
+        ('upstream_response_time', '"{}"'.format(upstream_time)),
+        ('upstream_addr', '"{}"'.format(upstream)),
+        ('cache_status', '""'),
+    ]
+    return '{' + ','.join('"{}": {}'.format(name, value) for name, value in fields) + '}'
+
+
+class TestLogStats(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'access.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_log(self, lines):
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def test_cache_stats(self):
+        self.write_log([
+            log_line('GET /lb/leaderboards/top HTTP/1.1', 'MISS'),
+            log_line('GET /lb/leaderboards/top HTTP/1.1', 'HIT'),
+            log_line('GET /lb/leaderboards/top?count=10 HTTP/1.1', 'STALE'),
+            log_line('GET /lb/scores HTTP/1.1', 'EXPIRED'),
+            log_line('POST /lb/scores HTTP/1.1', ''),
+            log_line('GET /other HTTP/1.1', 'HIT'),
+            '{"request": "GET /lb/leaderboards "quoted" HTTP/1.1", "cache_status": "HIT"}',
+        ])
+        stats = cache_stats(self.path, ['/lb', '/lb/leaderboards', '/doc'])
+
+        self.assertEqual(stats['/lb/leaderboards']['requests'], 3)
+        self.assertEqual(stats['/lb/leaderboards']['hits'], 2)
+        self.assertEqual(stats['/lb/leaderboards']['hit_ratio'], 0.667)
+        self.assertEqual(stats['/lb/leaderboards']['statuses'], {'MISS': 1, 'HIT': 1, 'STALE': 1})
+        self.assertEqual(stats['/lb']['hit_ratio'], 0.0)
+        self.assertEqual(stats['/doc'], {'requests': 0, 'hits': 0, 'hit_ratio': None, 'statuses': {}})
+
+        self.assertIsNone(cache_stats(os.path.join(self.tmpdir, 'missing.log'), ['/lb']))
+
+    def test_tail_lines(self):
+        self.write_log(['a' * 10, 'b' * 10, 'c' * 10])
+        self.assertEqual(tail_lines(self.path), ['a' * 10, 'b' * 10, 'c' * 10])
+        self.assertEqual(tail_lines(self.path, max_bytes=15), ['c' * 10])
+
+    def test_histogram(self):
+        histogram = Histogram()
+        for ms in range(1, 1001):
+            histogram.add(bucket_index(ms))
+        self.assertAlmostEqual(histogram.percentile(50), 500, delta=25)
+        self.assertAlmostEqual(histogram.percentile(99), 990, delta=50)
+        self.assertLess(len(histogram.buckets), 80)
+        self.assertIsNone(Histogram().percentile(50))
+
+    def test_parse_line(self):
+        line = traffic_line(1000.0, path='/svc/things?a=1', upstream='10.0.0.1:10080, 10.0.0.2:10080',
+                            upstream_time='0.500, 0.040')
+        expected = (1000.0, 200, 50.0, 40.0, ('/svc', 'tenant1', 'key1', '10.0.0.2:10080'))
+        self.assertEqual(parse_line(line), expected)
+        # Any json with the fields will do.
+        self.assertEqual(parse_line(json.dumps(json.loads(line), indent=1).replace('\n', '')), expected)
+        self.assertIsNone(parse_line('not json'))
+
+    def test_analyzer(self):
+        analyzer = LogAnalyzer(window=120, slot=60, max_keys=2)
+        analyzer.add_lines([
+            traffic_line(0.0, path='/old'),
+            traffic_line(100.0, request_time=0.1),
+            traffic_line(130.0, status=502, request_time=0.2, tenant='tenant2', upstream_time='-'),
+            traffic_line(170.0, path='/other', tenant='tenant3'),
+            traffic_line(10.0, path='/late'),  # Older than the window, ignored.
+            'garbage',
+        ])
+        summary = analyzer.summary(now=180.0)
+
+        self.assertEqual(summary['bad_lines'], 1)
+        self.assertEqual(list(summary['route']), ['/svc', '/other'])
+        self.assertEqual(summary['route']['/svc']['requests'], 2)
+        self.assertEqual(summary['route']['/svc']['error_rate'], 0.5)
+        self.assertEqual(summary['route']['/svc']['rps'], round(2 / 120.0, 2))
+        self.assertAlmostEqual(summary['route']['/svc']['p99_ms'], 200, delta=10)
+        # Keys over the limit are counted together.
+        self.assertEqual(summary['tenant'][logstats.OTHER_KEY]['requests'], 1)
+        # The upstream time was not known for one of the requests.
+        self.assertEqual(summary['upstream']['10.0.0.1:10080']['requests'], 3)
+
+    def test_tailer(self):
+        tailer = LogTailer(self.path, initial_bytes=10)
+        self.write_log(['x' * 20, 'first'])
+        self.assertEqual(list(tailer.read()), ['first\n'])
+
+        # A line still being written is left for later.
+        with open(self.path, 'a') as f:
+            f.write('second\nthi')
+        self.assertEqual(list(tailer.read()), ['second\n'])
+
+        # Rotated, the old log is finished first.
+        with open(self.path, 'a') as f:
+            f.write('rd\n')
+        os.rename(self.path, self.path + '.1')
+        self.write_log(['fourth'])
+        self.assertEqual(list(tailer.read()), ['third\n', 'fourth\n'])
+        self.assertEqual(list(tailer.read()), [])
+
+    def test_traffic_state(self):
+        state_path = os.path.join(self.tmpdir, 'state', logstats.TRAFFIC_STATE_FILENAME)
+        now = time.time()
+        self.write_log([traffic_line(now - 10), traffic_line(now - 5, status=500)])
+        summary = logstats.update_traffic_stats(self.path, state_path)
+        self.assertEqual(summary['route']['/svc']['requests'], 2)
+
+        # The next run from cron is a new process, which carries on where the last one left,
+        # also through logrotate.
+        logstats._tailers.clear()
+        with open(self.path, 'a') as f:
+            f.write(traffic_line(now - 1) + '\n')
+        os.rename(self.path, self.path + '.1')
+        open(self.path, 'w').close()
+        summary = logstats.update_traffic_stats(self.path, state_path)
+        self.assertEqual(summary['lines'], 3)
+        self.assertEqual(summary['route']['/svc']['requests'], 3)
+        self.assertEqual(summary['route']['/svc']['error_rate'], round(1 / 3.0, 4))
+
+        # A corrupt state file starts over.
+        logstats._tailers.clear()
+        with open(state_path, 'w') as f:
+            f.write('{')
+        summary = logstats.update_traffic_stats(self.path, state_path)
+        self.assertEqual(summary['lines'], 0)
+        logstats._tailers.clear()
+
+    def test_analyze_files(self):
+        lines = [traffic_line(float(i), api_key='key{}'.format(i % 3)) for i in range(1000)]
+        self.write_log(lines)
+        gz_path = self.path + '.2.gz'
+        with gzip.open(gz_path, 'wt') as f:
+            f.write('\n'.join(lines[:100]) + '\n')
+
+        old_part_bytes = logstats.ANALYZE_PART_BYTES
+        logstats.ANALYZE_PART_BYTES = 1000  # Split in many parts, not on line boundaries.
+        try:
+            summary = analyze_files([gz_path, self.path]).summary()
+        finally:
+            logstats.ANALYZE_PART_BYTES = old_part_bytes
+
+        self.assertEqual(summary['lines'], 1100)
+        self.assertEqual(summary['bad_lines'], 0)
+        self.assertEqual(summary['route']['/svc']['requests'], 1100)
+        self.assertEqual(sorted(summary['api_key']), ['key0', 'key1', 'key2'])
+        self.assertEqual(summary['window_seconds'], 999.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
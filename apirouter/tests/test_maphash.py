@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from apirouter import maphash
+from apirouter.maphash import (
+    hash_key, element_size, hash_items, build_hash, check_map_hashes, get_map_hash_settings,
+)
+
+
+def make_keys(count, prefix):
+    # Keys of different lengths, like tenant names and api keys.
+    return ['{}-{:x}'.format(prefix, i * 7919) for i in range(count)]
+
+
+class TestMapHash(unittest.TestCase):
+
+    def test_hash_key(self):
+        self.assertEqual(hash_key('a'), 97)
+        self.assertEqual(hash_key('Ab'), 97 * 31 + 98)
+        self.assertLess(hash_key('x' * 100), 2 ** 64)
+        self.assertEqual(element_size('abc'), 16)
+        self.assertEqual(element_size('abcdefg'), 24)
+
+        items, duplicates = hash_items(['key', 'KEY', 'other'])
+        self.assertEqual(len(items), 2)
+        self.assertEqual(duplicates, ['KEY'])
+
+    def test_build_hash(self):
+        items, _ = hash_items(make_keys(100, 'tenant'))
+        size, problem = build_hash(items, 512, 64)
+        self.assertIsNone(problem)
+        self.assertTrue(maphash._fits(items, size, 64))
+
+        # Too long keys, and too small max sizes.
+        size, problem = build_hash(hash_items(['x' * 100])[0], 512, 64)
+        self.assertEqual(problem, "error: a key needs map_hash_bucket_size 128")
+        size, problem = build_hash(items, 10, 64)
+        self.assertEqual(size, 10)
+        self.assertEqual(problem, "map_hash_max_size 10 or map_hash_bucket_size 64 is too small")
+
+        checked = check_map_hashes({'keys': ['a', 'A']}, 512, 64)
+        self.assertTrue(checked['keys']['problem'].startswith('error: duplicate keys'))
+
+    def test_small_maps(self):
+        settings = get_map_hash_settings({'keys': ['a', 'b'], 'empty': []})
+        self.assertEqual(settings['max_size'], maphash.MIN_MAX_SIZE)
+        self.assertEqual(settings['bucket_size'] % maphash.CACHELINE_SIZE, 0)
+        self.assertEqual(settings['maps']['empty']['entries'], 0)
+
+        # Settings from config are checked, not changed.
+        settings = get_map_hash_settings({'keys': ['x' * 100]}, max_size=1024, bucket_size=64)
+        self.assertEqual((settings['max_size'], settings['bucket_size']), (1024, 64))
+        self.assertTrue(settings['maps']['keys']['problem'].startswith('error'))
+
+    def test_large_maps(self):
+        maps = {
+            'product_name': make_keys(50000, 'acme-superkaiju-livenorth'),
+            'api_key_to_product': make_keys(10000, 'dg-superkaiju'),
+            'bad_key': ['{0}:{0}'.format(product_name) for product_name in make_keys(500, 'product')],
+        }
+        settings = get_map_hash_settings(maps)
+        for name, checked in settings['maps'].items():
+            self.assertIsNone(checked['problem'], name)
+            self.assertEqual(checked['entries'], len(maps[name]))
+
+        # The max size has headroom, but not too much.
+        biggest = max(checked['hash_size'] for checked in settings['maps'].values())
+        self.assertLessEqual(biggest, settings['max_size'])
+        self.assertLess(settings['max_size'], biggest * 1.5)
+
+        # The old fixed settings don't fit the tenants.
+        checked = check_map_hashes(maps, 32768, 256)
+        self.assertIsNotNone(checked['product_name']['problem'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import json
+import socket
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from apirouter import metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.textfile = os.path.join(self.tmpdir, 'apirouter.prom')
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.2)
+        metrics.configure(textfile=self.textfile, statsd='127.0.0.1:{}'.format(self.sock.getsockname()[1]))
+
+    def tearDown(self):
+        metrics.configure()
+        self.sock.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_cycle(self):
+        # Nothing is recorded outside of a cycle.
+        metrics.count('probes', 10)
+        with metrics.span('render'):
+            pass
+
+        stdout = io.StringIO()
+        with mock.patch('sys.stdout', stdout):
+            with metrics.cycle('TIER') as cycle_metrics:
+                with metrics.span('render'):
+                    metrics.count('probes', 2)
+                    metrics.count('probes', 3)
+                metrics.gauge('reload', 1)
+                cycle_metrics.result = 'skipped'
+
+        self.assertIsNone(metrics.current())
+        line = stdout.getvalue()
+        self.assertTrue(line.startswith(metrics.CEE_COOKIE))
+        record = json.loads(line[len(metrics.CEE_COOKIE):])
+        self.assertEqual(record['tier'], 'TIER')
+        self.assertEqual(record['result'], 'skipped')
+        self.assertEqual(list(record['spans_ms']), ['render'])
+        self.assertEqual(record['counts'], {'probes': 5, 'reload': 1})
+
+        with open(self.textfile) as f:
+            text = f.read()
+        self.assertIn('apirouter_cycle_duration_seconds{tier="TIER",result="skipped"}', text)
+        self.assertIn('apirouter_span_duration_seconds{tier="TIER",span="render"}', text)
+        self.assertIn('apirouter_probes{tier="TIER"} 5.0', text)
+
+        lines = set()
+        while True:
+            try:
+                lines.add(self.sock.recv(1024).decode('utf-8'))
+            except socket.timeout:
+                break
+        self.assertIn('apirouter.TIER.probes:5|g', lines)
+        self.assertIn('apirouter.TIER.result.skipped:1|c', lines)
+
+    def test_error(self):
+        with mock.patch('sys.stdout', io.StringIO()) as stdout:
+            with self.assertRaises(RuntimeError):
+                with metrics.cycle('TIER'):
+                    raise RuntimeError("boom")
+        record = json.loads(stdout.getvalue()[len(metrics.CEE_COOKIE):])
+        self.assertEqual(record['result'], 'error')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,6 +12,7 @@ import subprocess
 import json
 
 from driftconfig.testhelpers import create_test_domain
+from driftconfig.util import get_drift_config
 
 
 from apirouter import nginxconf
@@ -48,7 +49,7 @@ class TestNginxConfig(unittest.TestCase):
 
     # Some patching
     @classmethod
-    def get_ec2_targets_for_tier(cls, tier_name, check_health=False):
+    def get_ec2_targets_for_tier(cls, tier_name, check_health=False, conf=None):
         tags = {
             'api-status': 'online',
             'api-target': cls.deployable_1,
@@ -70,7 +71,7 @@ class TestNginxConfig(unittest.TestCase):
         return {cls.deployable_1: targets}
 
     @classmethod
-    def get_api_endpoints_for_tier(cls, tier_name, check_health=False, public_url=None):
+    def get_api_endpoints_for_tier(cls, tier_name, check_health=False, public_url=None, conf=None):
         return {}
 
     @classmethod
@@ -100,6 +101,8 @@ class TestNginxConfig(unittest.TestCase):
         cls.patchers = [
             mock.patch('apirouter.nginxconf.get_ec2_targets_for_tier', cls.get_ec2_targets_for_tier, ts),
             mock.patch('apirouter.nginxconf.get_api_endpoints_for_tier', cls.get_api_endpoints_for_tier, ts),
+            mock.patch('apirouter.nginxconf.healthcheck_targets', lambda *args, **kw: None),
+            mock.patch('apirouter.nginxconf.get_public_url_for_tier', lambda *args, **kw: None),
         ]
 
         for patcher in cls.patchers:
@@ -168,6 +171,12 @@ class TestNginxConfig(unittest.TestCase):
             'api_key_name': cls.custom_api_key,
             'key_type': 'custom',
         })
+        # A key for a product that is not on the tier.
+        api_keys.add({
+            'api_key_name': 'a-different-product-99999999',
+            'product_name': 'a-different-product',
+            'key_type': 'product',
+        })
         # Generate 'nginx' data
         nginx = ts.get_table('nginx')
         nginx.add({
@@ -396,6 +405,19 @@ class TestNginxConfig(unittest.TestCase):
             status_code=200,
         )
 
+    def test_api_key_map(self):
+        # Only keys for products on the tier, and custom keys, are in the map.
+        api_keys = self.nginx_config['data']['api_keys']
+        self.assertEqual(list(api_keys.items()), [
+            (self.product_name, [self.product_api_key]),
+            ('_custom_api_key', [self.custom_api_key]),
+        ])
+        self.assertNotIn('a-different-product-99999999', self.nginx_config['config'])
+
+        maps = json.loads(self.nginx_config['status'])['maps']
+        self.assertEqual(maps['api_key_to_product']['entries'], 2)
+        self.assertGreater(maps['api_key_to_product']['estimated_bytes'], 0)
+
     def test_api_key_passthrough(self):
         # Test passthrough
         ret = self.get(
@@ -438,6 +460,248 @@ class TestNginxConfig(unittest.TestCase):
         self.assertEqual(ret.json()['bad_key_and_requires_key'], 'false:false')
 
 
+def make_test_config():
+    """Return a small Drift config table store with active tenants, for tests without Nginx."""
+    import driftconfig.relib
+    with mock.patch.object(driftconfig.relib, 'CHECK_INTEGRITY', []):
+        ts = create_test_domain({
+            'num_org': 5,
+            'num_tiers': 2,
+            'num_deployables': 4,
+            'num_products': 2,
+            'num_tenants': 2,
+        })
+    for tenant in ts.get_table('tenants').find():
+        tenant['state'] = 'active'
+    return ts
+
+
+class TestFingerprint(unittest.TestCase):
+
+    def setUp(self):
+        self.ts = make_test_config()
+        self.tier_name = self.ts.get_table('tiers').find()[0]['tier_name']
+        self.product_name = self.ts.get_table('products').find()[0]['product_name']
+        self.conf = get_drift_config(ts=self.ts, tier_name=self.tier_name)
+        self.discovery = {'ec2_targets': {}, 'api_endpoints': {}}
+
+    def fingerprint(self):
+        return nginxconf.fingerprint_inputs(self.tier_name, self.conf, self.discovery)
+
+    def test_stable(self):
+        fingerprint = self.fingerprint()
+        nginxconf.generate_nginx_config(self.tier_name, conf=self.conf, discovery=self.discovery)
+        self.assertEqual(self.fingerprint(), fingerprint)
+
+    def test_api_keys(self):
+        api_keys = self.ts.get_table('api-keys')
+        fingerprint = self.fingerprint()
+        api_key = api_keys.add({
+            'api_key_name': self.product_name + '-99999999',
+            'product_name': self.product_name,
+            'key_type': 'product',
+        })
+        added = self.fingerprint()
+        self.assertNotEqual(added, fingerprint)
+
+        api_key['in_use'] = False
+        self.assertNotEqual(self.fingerprint(), added)
+
+        api_keys.remove(api_key)
+        self.assertEqual(self.fingerprint(), fingerprint)
+
+
+def make_targets(deployable_name, count=2):
+    return {
+        deployable_name: [
+            {
+                'name': 'test instance',
+                'instance_id': 'test-{}'.format(i),
+                'private_ip_address': '10.0.0.{}'.format(i),
+                'instance_type': 't2.small',
+                'tags': {'api-status': 'online', 'api-target': deployable_name, 'api-port': UPSTREAM_SERVER_PORT},
+            }
+            for i in range(count)
+        ]
+    }
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.ts = make_test_config()
+        self.tier_name = self.ts.get_table('tiers').find()[0]['tier_name']
+        self.deployable_name = self.ts.get_table('deployables').find({'tier_name': self.tier_name})[0]['deployable_name']
+        self.conf = get_drift_config(ts=self.ts, tier_name=self.tier_name)
+
+    def test_policies(self):
+        route = {'deployable_name': 'drift-base', 'cache': [
+            {'path': '/leaderboards/', 'ttl': '30s', 'key': ['tenant', 'api_key'], 'stale_while_revalidate': True},
+            {'key': ['auth']},
+            {'path': 'doc', 'ignore_auth': True},
+        ]}
+        cache = nginxconf._get_cache('drift-base', route, {'cache_max_size': '5g'})
+        self.assertEqual(cache['kind'], 'uwsgi')
+        self.assertEqual(cache['zone'], 'drift-base-cache')
+        self.assertEqual(cache['max_size'], '5g')
+        self.assertEqual(cache['zone_size'], nginxconf.CACHE_ZONE_SIZE)
+
+        leaderboards, auth, doc = cache['policies']
+        self.assertEqual(leaderboards['path'], 'leaderboards')
+        self.assertEqual(leaderboards['key'], '$request_method:$request_uri:$tenant_name:$drift_api_key')
+        self.assertEqual(leaderboards['bypass'], '$http_authorization')
+        self.assertTrue(leaderboards['stale'])
+        self.assertEqual(auth['path'], '')
+        self.assertEqual(auth['ttl'], nginxconf.CACHE_TTL)
+        self.assertEqual(auth['key'], '$request_method:$request_uri:$http_authorization')
+        self.assertIsNone(auth['bypass'])
+        self.assertFalse(auth['stale'])
+        self.assertEqual(doc['key'], '$request_method:$request_uri:$tenant_name')
+        self.assertIsNone(doc['bypass'])
+
+        route = {'deployable_name': 'drift-websocket', 'cache': [{}], 'cache_max_size': '2g'}
+        cache = nginxconf._get_cache('drift-websocket', route, None)
+        self.assertEqual(cache['kind'], 'proxy')
+        self.assertEqual(cache['max_size'], '2g')
+        self.assertIsNone(nginxconf._get_cache('drift-base', {'deployable_name': 'drift-base'}, None))
+
+    def test_render(self):
+        self.ts.get_table('routing').add({
+            'tier_name': self.tier_name,
+            'deployable_name': self.deployable_name,
+            'requires_api_key': False,
+            'cache': [
+                {'path': 'leaderboards', 'ttl': '30s', 'key': ['tenant', 'color'], 'stale_while_revalidate': True},
+                {'ttl': '5m', 'ignore_auth': True},
+            ],
+        })
+        discovery = {'ec2_targets': make_targets(self.deployable_name), 'api_endpoints': {}}
+        with self.assertLogs('apirouter.nginxconf', 'WARNING') as logs:
+            nginx_config = nginxconf.generate_nginx_config(self.tier_name, conf=self.conf, discovery=discovery)
+        self.assertEqual(len([line for line in logs.output if 'color' in line]), 1)
+
+        locations = nginx_config['fragments']['locations/' + self.deployable_name]
+        self.assertIn('uwsgi_cache_key "$request_method:$request_uri:$tenant_name";', locations)
+        self.assertIn('uwsgi_cache_valid 200 30s;', locations)
+        self.assertIn('uwsgi_cache_valid 200 5m;', locations)
+        self.assertEqual(locations.count('uwsgi_cache_bypass $http_authorization;'), 1)
+        self.assertEqual(locations.count('uwsgi_cache_background_update on;'), 1)
+        self.assertIn('keys_zone={}-cache:10m'.format(self.deployable_name),
+                      nginx_config['fragments']['caches/' + self.deployable_name])
+
+        status = json.loads(nginx_config['status'])
+        service = [service for service in status['deployables'] if service['name'] == self.deployable_name][0]
+        self.assertEqual(service['cached_locations'], ['/{0}/leaderboards'.format(self.deployable_name), '/' + self.deployable_name])
+
+        # Routes without targets are not cached.
+        discovery = {'ec2_targets': {}, 'api_endpoints': {}}
+        nginx_config = nginxconf.generate_nginx_config(self.tier_name, conf=self.conf, discovery=discovery)
+        self.assertNotIn('caches/' + self.deployable_name, nginx_config['fragments'])
+
+
+class TestRateLimits(unittest.TestCase):
+
+    def make_data(self, rate_limits, router_count=1):
+        tenants = {
+            'tenant-a': {'product_name': 'product-a'},
+            'tenant-b': {'product_name': 'product-b'},
+            'tenant-c': {'product_name': 'product-c'},
+        }
+        return {'nginx': {'rate_limits': rate_limits}, 'router_count': router_count, 'tenants': tenants}
+
+    def test_per_router_rate(self):
+        self.assertEqual(nginxconf._per_router_rate(500, 1), '500r/s')
+        self.assertEqual(nginxconf._per_router_rate(500, 3), '167r/s')
+        self.assertEqual(nginxconf._per_router_rate(1, 1), '1r/s')
+        self.assertEqual(nginxconf._per_router_rate(1, 4), '15r/m')
+        self.assertEqual(nginxconf._per_router_rate(0.5, 1), '30r/m')
+
+    def test_zones(self):
+        self.assertEqual(nginxconf._get_rate_limit_zones({'nginx': None, 'router_count': 1, 'tenants': {}}), [])
+        rate_limits = {
+            'default': {'tenant': {'rate': 500, 'burst': 1000, 'connections': 200}},
+            'product-b': {'api_key': {'rate': 100, 'zone_size': '20m'}, 'tenant': None},
+            'product-c': {'tenant': {'rate': 10}},
+        }
+        zones = nginxconf._get_rate_limit_zones(self.make_data(rate_limits, router_count=4))
+        self.assertEqual([(zone['name'], zone['products']) for zone in zones], [
+            ('tenant_0', ['product-a']),
+            ('tenant_1', ['product-c']),
+            ('api_key_0', ['product-b']),
+        ])
+        tenant_a, tenant_c, api_key_b = zones
+        self.assertEqual(tenant_a['variable'], '$tenant_name')
+        self.assertEqual((tenant_a['rate'], tenant_a['burst'], tenant_a['connections']), ('125r/s', 250, 50))
+        self.assertEqual(tenant_a['zone_size'], nginxconf.RATE_LIMIT_ZONE_SIZE)
+        self.assertEqual((tenant_c['rate'], tenant_c['burst'], tenant_c['connections']), ('3r/s', 3, None))
+        self.assertEqual(api_key_b['variable'], '$limit_api_key')
+        self.assertEqual((api_key_b['rate'], api_key_b['zone_size']), ('25r/s', '20m'))
+
+        # Products with the same limits share a zone. Connection limits don't need a rate.
+        rate_limits = {'default': {'product': {'connections': 10}}}
+        zones = nginxconf._get_rate_limit_zones(self.make_data(rate_limits, router_count=3))
+        self.assertEqual(len(zones), 1)
+        self.assertEqual(zones[0]['products'], ['product-a', 'product-b', 'product-c'])
+        self.assertEqual((zones[0]['rate'], zones[0]['burst'], zones[0]['connections']), (None, None, 4))
+
+    def test_render(self):
+        ts = make_test_config()
+        tier_name = ts.get_table('tiers').find()[0]['tier_name']
+        conf = get_drift_config(ts=ts, tier_name=tier_name)
+        discovery = {'ec2_targets': {}, 'api_endpoints': {}, 'router_count': 2}
+        nginx_config = nginxconf.generate_nginx_config(tier_name, conf=conf, discovery=discovery)
+        self.assertIn('# Note: No rate limits defined.', nginx_config['fragments']['ratelimits/zones'])
+        product_name = sorted(tenant['product_name'] for tenant in nginx_config['data']['tenants'].values())[0]
+
+        ts.get_table('nginx').add({
+            'tier_name': tier_name,
+            'rate_limits': {
+                'default': {'tenant': {'rate': 1, 'burst': 5, 'connections': 20}},
+                product_name: {'api_key': {'connections': 4}},
+            },
+        })
+        nginx_config = nginxconf.generate_nginx_config(tier_name, conf=conf, discovery=discovery)
+        zones = nginx_config['fragments']['ratelimits/zones']
+        self.assertIn('map $product_name $limit_tenant_0 {', zones)
+        self.assertIn('{} $tenant_name;'.format(product_name), zones)
+        self.assertIn('limit_req_zone $limit_tenant_0 zone=req_tenant_0:10m rate=30r/m;', zones)
+        self.assertIn('limit_conn_zone $limit_tenant_0 zone=conn_tenant_0:10m;', zones)
+        self.assertIn('{} $limit_api_key;'.format(product_name), zones)
+        self.assertNotIn('zone=req_api_key_0', zones)
+        self.assertIn('limit_conn_zone $limit_api_key_0 zone=conn_api_key_0:10m;', zones)
+
+        server = nginx_config['fragments']['ratelimits/server']
+        self.assertIn('limit_req zone=req_tenant_0 burst=3 nodelay;', server)
+        self.assertIn('limit_conn conn_tenant_0 10;', server)
+        self.assertIn('limit_conn conn_api_key_0 2;', server)
+
+        status = json.loads(nginx_config['status'])
+        self.assertEqual(status['rate_limits']['router_count'], 2)
+        self.assertEqual(len(status['rate_limits']['zones']), 2)
+
+
+class TestDiscoverTier(unittest.TestCase):
+
+    def test_health_check(self):
+        ts = make_test_config()
+        tier_name = ts.get_table('tiers').find()[0]['tier_name']
+        conf = get_drift_config(ts=ts, tier_name=tier_name)
+        ec2_targets = make_targets('drift-base')
+        endpoint = {'deployable_name': 'drift-base', 'url': 'https://base.execute-api.eu-west-1.amazonaws.com/main'}
+        public_url = 'https://vpce-1.execute-api.eu-west-1.vpce.amazonaws.com/main'
+        healthcheck_targets = mock.MagicMock()
+        with mock.patch.object(nginxconf, 'get_ec2_targets_for_tier', lambda tier_name, conf: ec2_targets), \
+                mock.patch.object(nginxconf, 'get_api_endpoints_for_tier', lambda tier_name, conf: {'drift-base': endpoint}), \
+                mock.patch.object(nginxconf, 'get_public_url_for_tier', lambda tier_name, conf: public_url), \
+                mock.patch.object(nginxconf, 'healthcheck_targets', healthcheck_targets):
+            discovery = nginxconf.discover_tier(tier_name, conf=conf)
+            self.assertEqual(discovery, {'ec2_targets': ec2_targets, 'api_endpoints': {'drift-base': endpoint}})
+            nginxconf.discover_tier(tier_name, check_health=False, conf=conf)
+
+        # The API Gateway endpoints are probed through the public url of the tier.
+        healthcheck_targets.assert_called_once_with(ec2_targets, [endpoint], nginx=None, public_url=public_url)
+
+
 def _find_executable(executable, path=None):
     """Find if 'executable' can be run. Looks for it in 'path'
     (string that lists directories separated by 'os.pathsep';
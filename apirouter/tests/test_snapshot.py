@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import boto3
+import mock
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+
+from apirouter import snapshot
+from apirouter.snapshot import LocalStore, S3Store, Snapshots, create_store, get_owner
+
+
+def make_discovery(ip='10.50.2.139'):
+    return {
+        'ec2_targets': {
+            'drift-base': [{'instance_id': 'i-0a436fc2e66a39f35', 'private_ip_address': ip, 'health_status': 'ok'}],
+        },
+        'api_endpoints': [],
+    }
+
+
+class Discover(object):
+    """Stand-in for discover_tier() that counts the calls."""
+
+    def __init__(self, discovery):
+        self.discovery = discovery
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.discovery
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = LocalStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_local_store(self):
+        self.assertEqual(self.store.read('a/b'), (None, None))
+        self.assertTrue(self.store.swap('a/b', b'one', None))
+        self.assertFalse(self.store.swap('a/b', b'two', None))
+        data, etag = self.store.read('a/b')
+        self.assertEqual(data, b'one')
+        self.assertTrue(self.store.swap('a/b', b'two', etag))
+        self.assertFalse(self.store.swap('a/b', b'three', etag))
+        self.store.delete('a/b')
+        self.assertEqual(self.store.read('a/b'), (None, None))
+
+    def test_create_store(self):
+        self.assertIsInstance(create_store(self.path), LocalStore)
+        self.assertEqual(create_store('file://' + self.path).path, self.path)
+        store = create_store('s3://bucket/apirouter/snapshots/')
+        self.assertIsInstance(store, S3Store)
+        self.assertEqual(store._key('lease.json'), 'apirouter/snapshots/lease.json')
+        with self.assertRaises(RuntimeError):
+            create_store('ftp://host/path')
+
+    def test_s3_store(self):
+        # The Stubber validates the parameters against the S3 model, so this fails if
+        # botocore doesn't have the conditional writes.
+        client = boto3.client('s3', region_name='eu-west-1', aws_access_key_id='a', aws_secret_access_key='b')
+        store = S3Store('bucket', 'prefix', client=client)
+        with Stubber(client) as stubber:
+            expected = {'Bucket': 'bucket', 'Key': 'prefix/a', 'Body': b'one', 'IfNoneMatch': '*'}
+            stubber.add_response('put_object', {'ETag': '"1"'}, expected)
+            stubber.add_client_error(
+                'put_object', service_error_code='PreconditionFailed', http_status_code=412,
+                expected_params=expected,
+            )
+            expected = {'Bucket': 'bucket', 'Key': 'prefix/a', 'Body': b'two', 'IfMatch': '"1"'}
+            stubber.add_response('put_object', {'ETag': '"2"'}, expected)
+            stubber.add_client_error(
+                'put_object', service_error_code='AccessDenied', http_status_code=403,
+                expected_params=expected,
+            )
+            stubber.add_client_error(
+                'get_object', service_error_code='NoSuchKey', http_status_code=404,
+                expected_params={'Bucket': 'bucket', 'Key': 'prefix/b'},
+            )
+
+            self.assertTrue(store.swap('a', b'one', None))
+            self.assertFalse(store.swap('a', b'one', None))
+            self.assertTrue(store.swap('a', b'two', '"1"'))
+            with self.assertRaises(ClientError):
+                store.swap('a', b'two', '"1"')
+            self.assertEqual(store.read('b'), (None, None))
+            stubber.assert_no_pending_responses()
+
+    def test_leader_and_follower(self):
+        leader = Snapshots(self.store, 'DEVNORTH', owner='router-1')
+        follower = Snapshots(self.store, 'DEVNORTH', owner='router-2')
+        discover = Discover(make_discovery())
+        follower_discover = Discover(make_discovery('10.50.2.1'))
+
+        self.assertEqual(leader.get_discovery(discover), make_discovery())
+        self.assertTrue(leader.leader)
+        self.assertEqual(follower.get_discovery(follower_discover), make_discovery())
+        self.assertFalse(follower.leader)
+        self.assertEqual(follower_discover.calls, 0)
+
+        # An unchanged discovery doesn't make a new version.
+        leader.get_discovery(discover)
+        self.assertEqual(leader._read_json(snapshot.LATEST_KEY)[0]['version'], 1)
+        discover.discovery = make_discovery('10.50.2.140')
+        leader.get_discovery(discover)
+        self.assertEqual(leader._read_json(snapshot.LATEST_KEY)[0]['version'], 2)
+        self.assertEqual(follower.get_discovery(follower_discover), make_discovery('10.50.2.140'))
+        self.assertEqual(discover.calls, 3)
+
+        # The follower takes over when the lease is given up.
+        leader.release()
+        self.assertEqual(follower.get_discovery(follower_discover), make_discovery('10.50.2.1'))
+        self.assertTrue(follower.leader)
+        self.assertFalse(leader.acquire_lease())
+
+    def test_changed_discovery(self):
+        # The daemon changes the discovery it gets, which must not change the snapshot.
+        leader = Snapshots(self.store, 'DEVNORTH', owner='router-1')
+        follower = Snapshots(self.store, 'DEVNORTH', owner='router-2')
+        leader.get_discovery(Discover(make_discovery()))['ec2_targets'].clear()
+        self.assertEqual(leader.fetch(), make_discovery())
+        follower.get_discovery(Discover(None))['ec2_targets'].clear()
+        self.assertEqual(follower.get_discovery(Discover(None)), make_discovery())
+
+    def test_expired_lease(self):
+        leader = Snapshots(self.store, 'DEVNORTH', owner='router-1', lease_ttl=-1)
+        follower = Snapshots(self.store, 'DEVNORTH', owner='router-2')
+        leader.get_discovery(Discover(make_discovery()))
+        self.assertTrue(follower.acquire_lease())
+        self.assertFalse(leader.acquire_lease())
+
+    def test_same_host(self):
+        # Each cron run is a new process on the same host, and renews the lease.
+        with mock.patch.object(snapshot.socket, 'gethostname', lambda: 'router-1'):
+            first = Snapshots(self.store, 'DEVNORTH')
+            self.assertTrue(first.acquire_lease())
+            acquired = first._read_json(snapshot.LEASE_KEY)[0]['acquired']
+            second = Snapshots(self.store, 'DEVNORTH')
+            self.assertTrue(second.acquire_lease())
+            self.assertEqual(second._read_json(snapshot.LEASE_KEY)[0]['acquired'], acquired)
+
+            # A daemon on the same host is another owner.
+            self.assertEqual(get_owner(daemon=True), 'router-1:{}'.format(os.getpid()))
+            self.assertFalse(Snapshots(self.store, 'DEVNORTH', owner=get_owner(daemon=True)).acquire_lease())
+
+    def test_stale_snapshot(self):
+        leader = Snapshots(self.store, 'DEVNORTH', owner='router-1')
+        follower = Snapshots(self.store, 'DEVNORTH', owner='router-2', max_age=60)
+        discover = Discover(make_discovery('10.50.2.1'))
+
+        # No snapshot yet.
+        leader.acquire_lease()
+        self.assertEqual(follower.get_discovery(discover), make_discovery('10.50.2.1'))
+        self.assertEqual(discover.calls, 1)
+
+        leader.publish(make_discovery())
+        latest, etag = leader._read_json(snapshot.LATEST_KEY)
+        latest['published'] = time.time() - 120
+        self.store.swap('DEVNORTH/' + snapshot.LATEST_KEY, snapshot._to_json(latest), etag)
+        self.assertEqual(follower.get_discovery(discover), make_discovery('10.50.2.1'))
+        self.assertEqual(discover.calls, 2)
+
+    def test_old_snapshots_removed(self):
+        leader = Snapshots(self.store, 'DEVNORTH', owner='router-1')
+        for i in range(snapshot.KEEP_SNAPSHOTS + 2):
+            leader.publish(make_discovery('10.50.2.{}'.format(i)))
+        names = sorted(os.listdir(os.path.join(self.path, 'DEVNORTH', 'snapshots')))
+        self.assertEqual(len(names), snapshot.KEEP_SNAPSHOTS)
+        self.assertEqual(names[0], '00000003.gz')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+import json
+import re
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import mock
+
+from apirouter.upstreams import (
+    parse_server_params, format_server_params, get_upstream_servers, upstream_api_url, UpstreamApi,
+    get_balancing, instance_weight, UP, BACKUP, DOWN,
+)
+
+
+class FakeUpstreamApiHandler(BaseHTTPRequestHandler):
+    """Mimics the part of the Nginx Plus upstream API used by UpstreamApi."""
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, status, body=None):
+        content = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _route(self):
+        m = re.match(r'^/api/6/http/upstreams/([^/]+)/servers(?:/(\d+))?$', self.path)
+        if not m:
+            self._respond(404, {'error': 'not found'})
+            return None, None
+        return self.server.upstreams.setdefault(m.group(1), []), m.group(2)
+
+    def _body(self):
+        return json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+
+    def do_GET(self):
+        servers, _ = self._route()
+        if servers is not None:
+            self._respond(200, servers)
+
+    def do_POST(self):
+        servers, _ = self._route()
+        if servers is not None:
+            server = {'weight': 1, 'backup': False, 'down': False}
+            server.update(self._body())
+            server['id'] = self.server.next_id
+            self.server.next_id += 1
+            servers.append(server)
+            self._respond(201, server)
+
+    def do_PATCH(self):
+        servers, server_id = self._route()
+        if servers is not None:
+            server = [s for s in servers if s['id'] == int(server_id)][0]
+            body = self._body()
+            if 'backup' in body:
+                self._respond(400, {'error': 'backup can not be changed'})
+                return
+            server.update(body)
+            self._respond(200, server)
+
+    def do_DELETE(self):
+        servers, server_id = self._route()
+        if servers is not None:
+            servers[:] = [s for s in servers if s['id'] != int(server_id)]
+            self._respond(204)
+
+
+def make_route(*targets, **kw):
+    health = kw.pop('health', {})
+    instance_types = kw.pop('instance_types', {})
+    route = {
+        'ec2_targets': [
+            {
+                'private_ip_address': ip,
+                'instance_type': instance_types.get(ip, 't2.small'),
+                'tags': {'api-port': '10080', 'api-param': param},
+                'comment': 'test',
+                'health_status': health.get(ip, 'ok'),
+            }
+            for ip, param in targets
+        ]
+    }
+    route.update(kw)
+    return route
+
+
+class TestUpstreams(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), FakeUpstreamApiHandler)
+        cls.server.upstreams = {}
+        cls.server.next_id = 0
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        cls.api = UpstreamApi(upstream_api_url({'upstream_api_port': cls.server.server_port}))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_server_params(self):
+        params = parse_server_params('weight=100 backup')
+        self.assertEqual(dict(params), {'weight': '100', 'backup': True})
+        self.assertEqual(format_server_params(params), 'weight=100 backup')
+        self.assertEqual(format_server_params(parse_server_params(None)), '')
+
+    def test_health_policy(self):
+        nginx = {'healthcheck_targets': True}
+        targets = [('10.0.0.1', 'weight=10'), ('10.0.0.2', None), ('10.0.0.3', 'backup'), ('10.0.0.4', None)]
+
+        def states(health, nginx=nginx):
+            servers = get_upstream_servers(make_route(*targets, health=health), nginx)
+            return [(server['state'], format_server_params(server['params'])) for server in servers]
+
+        # Unhealthy targets are marked down, even draining ones.
+        self.assertEqual(states({'10.0.0.1': 'Timeout', '10.0.0.3': 'Timeout'}), [
+            (DOWN, 'weight=10 down'), (UP, ''), (DOWN, 'down'), (UP, ''),
+        ])
+
+        # Too few healthy targets, unhealthy ones are kept as backup.
+        self.assertEqual(states({'10.0.0.1': 'Timeout', '10.0.0.2': 'Timeout', '10.0.0.3': 'Timeout'}), [
+            (BACKUP, 'weight=10 backup'), (BACKUP, 'backup'), (BACKUP, 'backup'), (UP, ''),
+        ])
+
+        # No healthy targets, or filtering not enabled, all are kept as they are.
+        all_down = {ip: 'Timeout' for ip, _ in targets}
+        expected = [(UP, 'weight=10'), (UP, ''), (BACKUP, 'backup'), (UP, '')]
+        self.assertEqual(states(all_down), expected)
+        self.assertEqual(states(all_down, nginx={}), expected)
+
+    def test_balancing(self):
+        self.assertIsNone(get_balancing({}))
+        self.assertIsNone(get_balancing({'balancing': 'fastest'}))
+        self.assertEqual(get_balancing({'balancing': 'least_conn'}), 'least_conn')
+        self.assertEqual(get_balancing({}, {'upstream_balancing': 'random'}), 'random two least_conn')
+        self.assertEqual(get_balancing({'balancing': 'hash'}), 'hash $remote_addr consistent')
+        self.assertEqual(
+            get_balancing({'balancing': 'hash', 'hash_key': '$http_drift_api_key'}, {'upstream_balancing': 'least_conn'}),
+            'hash $http_drift_api_key consistent'
+        )
+
+    def test_weights(self):
+        self.assertEqual(instance_weight('t2.small'), 1)
+        self.assertEqual(instance_weight('c5.2xlarge'), 8)
+        self.assertEqual(instance_weight('m5.large'), 2)
+        self.assertIsNone(instance_weight('m5.metal'))
+        self.assertIsNone(instance_weight(None))
+
+        targets = [('10.0.0.1', None), ('10.0.0.2', None), ('10.0.0.3', 'weight=3'), ('10.0.0.4', None)]
+        instance_types = {'10.0.0.1': 'c5.2xlarge', '10.0.0.2': 'c5.xlarge', '10.0.0.3': 'c5.2xlarge'}
+
+        def params(nginx=None, **kw):
+            kw.setdefault('instance_types', instance_types)
+            route = make_route(*targets, **kw)
+            return [format_server_params(server['params']) for server in get_upstream_servers(route, nginx)]
+
+        # Weights are relative to the smallest instance, explicit weights are kept.
+        self.assertEqual(params(), ['weight=8', 'weight=4', 'weight=3', ''])
+        self.assertEqual(params(weight_by_instance_type=False), ['', '', 'weight=3', ''])
+
+        # Same sized instances get the default weight.
+        self.assertEqual(params(instance_types={}), ['', '', 'weight=3', ''])
+
+        # Failure settings from the tier, overridden by the route.
+        self.assertEqual(
+            params({'upstream_max_fails': 2, 'upstream_fail_timeout': '5s'}, max_fails=0, weight_by_instance_type=False),
+            ['max_fails=0 fail_timeout=5s', 'max_fails=0 fail_timeout=5s', 'weight=3 max_fails=0 fail_timeout=5s',
+             'max_fails=0 fail_timeout=5s'],
+        )
+
+    def test_backup_without_support(self):
+        targets = [('10.0.0.1', None), ('10.0.0.2', 'backup')]
+
+        def states(route):
+            return [(server['state'], format_server_params(server['params'])) for server in get_upstream_servers(route)]
+
+        self.assertEqual(states(make_route(*targets, balancing='least_conn')), [(UP, ''), (BACKUP, 'backup')])
+        self.assertEqual(states(make_route(*targets, balancing='hash')), [(UP, ''), (DOWN, 'down')])
+
+        # Backup servers are kept in rotation if there is nothing else.
+        self.assertEqual(states(make_route(targets[1], balancing='random')), [(UP, '')])
+
+    def test_sync(self):
+        upstream = 'drift-base-servers'
+        route = make_route(('10.0.0.1', 'weight=100'), ('10.0.0.2', None))
+        actions = self.api.sync(upstream, get_upstream_servers(route))
+        self.assertEqual(actions, [('add', '10.0.0.1:10080'), ('add', '10.0.0.2:10080')])
+
+        # In sync.
+        self.assertEqual(self.api.sync(upstream, get_upstream_servers(route)), [])
+
+        # Weight change is patched, backup flag means delete and add, and a new server is added.
+        route = make_route(('10.0.0.1', 'weight=50'), ('10.0.0.2', 'backup'), ('10.0.0.3', None))
+        actions = self.api.sync(upstream, get_upstream_servers(route))
+        self.assertEqual(actions, [
+            ('patch', '10.0.0.1:10080'),
+            ('replace', '10.0.0.2:10080'),
+            ('add', '10.0.0.3:10080'),
+        ])
+        live = {s['server']: s for s in self.api.list_servers(upstream)}
+        self.assertEqual(live['10.0.0.1:10080']['weight'], 50)
+        self.assertTrue(live['10.0.0.2:10080']['backup'])
+
+        # Servers are removed.
+        route = make_route(('10.0.0.3', None))
+        actions = self.api.sync(upstream, get_upstream_servers(route))
+        self.assertEqual(actions, [('delete', '10.0.0.1:10080'), ('delete', '10.0.0.2:10080')])
+
+    def test_sync_rollover(self):
+        upstream = 'drift-rollover-servers'
+        self.api.sync(upstream, get_upstream_servers(make_route(('10.0.0.1', None), ('10.0.0.2', 'backup'))))
+
+        # The group is never empty while all its servers are replaced.
+        sizes = []
+        delete_server = self.api.delete_server
+
+        def delete_and_count(upstream, server_id):
+            delete_server(upstream, server_id)
+            sizes.append(len(self.api.list_servers(upstream)))
+
+        route = make_route(('10.0.0.3', None), ('10.0.0.2', None))
+        with mock.patch.object(self.api, 'delete_server', delete_and_count):
+            actions = self.api.sync(upstream, get_upstream_servers(route))
+        self.assertEqual(actions, [
+            ('add', '10.0.0.3:10080'),
+            ('replace', '10.0.0.2:10080'),
+            ('delete', '10.0.0.1:10080'),
+        ])
+        self.assertEqual(sizes, [3, 2])
+        live = {s['server']: s for s in self.api.list_servers(upstream)}
+        self.assertEqual(sorted(live), ['10.0.0.2:10080', '10.0.0.3:10080'])
+        self.assertFalse(live['10.0.0.2:10080']['backup'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Upstream Servers
+
+Builds the list of upstream servers for a route from its EC2 targets, and keeps the
+upstream groups of a running Nginx in sync through its upstream management API, so
+target changes don't require a full reload.
+
+The upstream API is the one from Nginx Plus:
+http://nginx.org/en/docs/http/ngx_http_api_module.html
+"""
+import re
+import logging
+from functools import reduce
+from math import gcd
+from collections import OrderedDict
+
+import requests
+
+
+log = logging.getLogger(__name__)
+
+
+UPSTREAM_API_VERSION = 6
+UPSTREAM_API_TIMEOUT = 2.0
+
+# Server parameters that can be changed on a live server. Changing any other parameter
+# means the server is removed and added again.
+PATCHABLE_PARAMS = {'weight', 'max_conns', 'max_fails', 'fail_timeout', 'slow_start', 'down'}
+
+# Values of server parameters that are not set explicitly.
+LIVE_DEFAULTS = {'weight': 1, 'backup': False, 'down': False}
+
+# If fewer than this fraction of the targets in a pool are healthy, unhealthy targets are
+# kept as 'backup' instead of being marked 'down'.
+MIN_HEALTHY_FRACTION = 0.5
+
+# Load balancing methods a route can use, set with 'balancing' in the 'routing' config or
+# 'upstream_balancing' in the 'nginx' config. Nginx uses round robin if none is set.
+BALANCING_METHODS = {
+    'round_robin': None,
+    'least_conn': 'least_conn',
+    'random': 'random two least_conn',
+    'hash': 'hash {} consistent',  # Formatted with 'hash_key'.
+}
+DEFAULT_HASH_KEY = '$remote_addr'
+
+# Balancing methods that don't support 'backup' servers. Backup servers are marked 'down'
+# instead.
+NO_BACKUP_METHODS = {'random', 'hash'}
+
+# Relative capacity of each EC2 instance size, roughly its vCPU count. Sizes like '4xlarge'
+# are a multiple of 'xlarge'.
+INSTANCE_SIZE_WEIGHTS = {
+    'nano': 1,
+    'micro': 1,
+    'small': 1,
+    'medium': 2,
+    'large': 2,
+    'xlarge': 4,
+}
+
+# Server states.
+UP = 'up'
+BACKUP = 'backup'
+DOWN = 'down'
+
+
+def parse_server_params(s):
+    """
+    Parse Nginx 'server' parameters in 's', like "weight=100 backup", into an ordered dict.
+    Flags have the value True.
+    """
+    params = OrderedDict()
+    for param in (s or '').split():
+        key, sep, value = param.partition('=')
+        params[key] = value if sep else True
+    return params
+
+
+def format_server_params(params):
+    """Format 'params' as returned by parse_server_params() for the 'server' directive."""
+    return ' '.join(
+        key if value is True else '{}={}'.format(key, value)
+        for key, value in params.items()
+        if value is not False
+    )
+
+
+def is_healthy(target):
+    """Return False if 'target' failed its health check. Targets not checked are healthy."""
+    return target.get('health_status') in (None, 'ok')
+
+
+def route_setting(route, nginx, key, default=None):
+    """
+    Return setting 'key' for 'route' from the 'routing' config, falling back on the tier
+    wide 'upstream_<key>' in the 'nginx' config and then 'default'.
+    """
+    if route.get(key) is not None:
+        return route[key]
+    return (nginx or {}).get('upstream_' + key, default)
+
+
+def get_balancing(route, nginx=None):
+    """
+    Return the load balancing directive for the upstream group of 'route', or None for
+    round robin.
+    """
+    method = route_setting(route, nginx, 'balancing') or 'round_robin'
+    if method not in BALANCING_METHODS:
+        log.warning("Unknown balancing method '%s' for %s. Using round robin.", method, route.get('deployable_name'))
+        return None
+    directive = BALANCING_METHODS[method]
+    if method == 'hash':
+        directive = directive.format(route_setting(route, nginx, 'hash_key', DEFAULT_HASH_KEY))
+    return directive
+
+
+def instance_weight(instance_type):
+    """
+    Return the relative capacity of EC2 'instance_type', like 't2.small' or 'c5.2xlarge',
+    or None if the size is not known.
+    """
+    size = (instance_type or '').rpartition('.')[2]
+    if size in INSTANCE_SIZE_WEIGHTS:
+        return INSTANCE_SIZE_WEIGHTS[size]
+    m = re.match(r'^(\d+)xlarge$', size)
+    if m:
+        return int(m.group(1)) * INSTANCE_SIZE_WEIGHTS['xlarge']
+
+
+def get_upstream_servers(route, nginx=None):
+    """
+    Return a list of upstream servers for the EC2 targets in 'route'. Each server is a
+    dict with 'address', 'params', 'comment' and 'state', which is UP, BACKUP or DOWN.
+
+    The server 'weight' is derived from the instance type of the target, unless
+    'weight_by_instance_type' is off or the 'api-param' tag of the target sets it.
+    'max_fails' and 'fail_timeout' are taken from the route or the tier.
+
+    If 'healthcheck_targets' is set in the 'nginx' config, targets that failed their health
+    check are marked 'down'. If fewer than 'healthcheck_min_healthy_fraction' of the
+    targets are healthy, they are marked 'backup' instead so they still get traffic if the
+    healthy ones fail too. If no target is healthy, all of them are kept in rotation.
+
+    Backup servers are marked 'down' if the balancing method doesn't support them, unless
+    no other server is up.
+    """
+    nginx = nginx or {}
+    targets = route['ec2_targets']
+    method = route_setting(route, nginx, 'balancing')
+    defaults = [
+        (key, route_setting(route, nginx, key))
+        for key in ('max_fails', 'fail_timeout')
+    ]
+
+    # Weights are scaled down by their common divisor so a pool of same sized instances
+    # gets the default weight.
+    weights = {}
+    if route_setting(route, nginx, 'weight_by_instance_type', True):
+        for i, target in enumerate(targets):
+            weight = instance_weight(target.get('instance_type'))
+            if weight:
+                weights[i] = weight
+    divisor = reduce(gcd, weights.values(), 0) or 1
+
+    unhealthy_state = None
+    if nginx.get('healthcheck_targets') and targets:
+        healthy = sum(1 for target in targets if is_healthy(target))
+        min_fraction = nginx.get('healthcheck_min_healthy_fraction', MIN_HEALTHY_FRACTION)
+        if healthy == 0:
+            log.warning("No healthy targets for %s. Keeping all of them.", route.get('deployable_name'))
+        elif healthy < len(targets):
+            unhealthy_state = DOWN if healthy >= min_fraction * len(targets) else BACKUP
+
+    servers = []
+    for i, target in enumerate(targets):
+        params = parse_server_params(target['tags'].get('api-param'))
+        if 'weight' not in params and weights.get(i, divisor) != divisor:
+            params['weight'] = str(weights[i] // divisor)
+        for key, value in defaults:
+            if value is not None and key not in params:
+                params[key] = str(value)
+        state = BACKUP if params.get('backup') else UP
+        if unhealthy_state and not is_healthy(target):
+            state = unhealthy_state
+            params.pop('backup', None)
+            params.pop('down', None)
+            params[state] = True
+        servers.append({
+            'address': '{}:{}'.format(target['private_ip_address'], target['tags']['api-port']),
+            'params': params,
+            'comment': target.get('comment', ''),
+            'state': state,
+        })
+
+    if method in NO_BACKUP_METHODS:
+        fallback = DOWN if any(server['state'] == UP for server in servers) else UP
+        for server in servers:
+            if server['state'] == BACKUP:
+                server['params'].pop('backup', None)
+                if fallback == DOWN:
+                    server['params']['down'] = True
+                server['state'] = fallback
+
+    return servers
+
+
+def upstream_api_url(nginx):
+    """Return the url of the upstream API from the 'nginx' config, or None if not enabled."""
+    if nginx and nginx.get('upstream_api_port'):
+        return 'http://127.0.0.1:{}/api/{}'.format(
+            nginx['upstream_api_port'], nginx.get('upstream_api_version', UPSTREAM_API_VERSION))
+
+
+class UpstreamApi(object):
+    """Client for the Nginx upstream API at 'base_url'."""
+
+    def __init__(self, base_url, timeout=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout or UPSTREAM_API_TIMEOUT
+        self.session = requests.Session()
+
+    def _request(self, method, path, **kw):
+        url = '{}/http/upstreams/{}'.format(self.base_url, path)
+        resp = self.session.request(method, url, timeout=self.timeout, **kw)
+        resp.raise_for_status()
+        if resp.content:
+            return resp.json()
+
+    def list_servers(self, upstream):
+        return self._request('GET', '{}/servers'.format(upstream))
+
+    def add_server(self, upstream, address, params):
+        body = self._to_json(params)
+        body['server'] = address
+        return self._request('POST', '{}/servers'.format(upstream), json=body)
+
+    def patch_server(self, upstream, server_id, params):
+        return self._request('PATCH', '{}/servers/{}'.format(upstream, server_id), json=params)
+
+    def delete_server(self, upstream, server_id):
+        return self._request('DELETE', '{}/servers/{}'.format(upstream, server_id))
+
+    @staticmethod
+    def _to_json(params):
+        body = {}
+        for key, value in params.items():
+            if value is True or value is False:
+                body[key] = value
+            elif value.isdigit():
+                body[key] = int(value)
+            else:
+                body[key] = value
+        return body
+
+    def sync(self, upstream, servers):
+        """
+        Make the servers in the live 'upstream' group match 'servers' as returned by
+        get_upstream_servers(). Returns a list of (action, address) tuples.
+
+        Servers are added before any are deleted, so the group is never empty when all of
+        its servers are replaced, say after an autoscaling group rollover.
+        """
+        live = {server['server']: server for server in self.list_servers(upstream)}
+        wanted = OrderedDict((server['address'], server) for server in servers)
+        actions = []
+
+        for address, server in wanted.items():
+            params = self._to_json(server['params'])
+            for key, default in LIVE_DEFAULTS.items():
+                params.setdefault(key, default)
+            if address not in live:
+                self.add_server(upstream, address, server['params'])
+                actions.append(('add', address))
+                continue
+
+            changed = {key: value for key, value in params.items() if live[address].get(key) != value}
+            if not changed:
+                continue
+            if set(changed) <= PATCHABLE_PARAMS:
+                self.patch_server(upstream, live[address]['id'], changed)
+                actions.append(('patch', address))
+            else:
+                self.add_server(upstream, address, server['params'])
+                self.delete_server(upstream, live[address]['id'])
+                actions.append(('replace', address))
+
+        for address, server in live.items():
+            if address not in wanted:
+                self.delete_server(upstream, server['id'])
+                actions.append(('delete', address))
+
+        for action, address in actions:
+            log.info("Upstream %s: %s server %s.", upstream, action, address)
+
+        return actions
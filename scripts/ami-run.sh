@@ -14,7 +14,9 @@ else
 fi
 
 echo "Preparing nginx.conf"
-chown ubuntu /etc/nginx/nginx.conf
-echo "# Truncated. apirouter-conf will generate this file in a moment." > /etc/nginx/nginx.conf
+# apirouter-conf writes the config into /etc/nginx/apirouter and nginx.conf points to the current release.
+mkdir -p /etc/nginx/apirouter
+chown ubuntu /etc/nginx/apirouter
+ln -sfn /etc/nginx/apirouter/current/nginx.conf /etc/nginx/nginx.conf
 sudo -u ubuntu ${venv}/bin/apirouter-conf
 nginx -s reload